@@ -1,10 +1,13 @@
 from django.contrib import admin
 
-from est.models import Import
+from est.cache import invalidate_networks
+from est.models import Import, TrailNetwork
 
 
 def activate(modeladmin, request, queryset):
     queryset.update(active='True')
+    # update() skips post_save, so the cached network payloads have to be dropped here
+    invalidate_networks(TrailNetwork.objects.filter(source__in=queryset).values_list('id', flat=True))
 
 
 class ImportAdmin(admin.ModelAdmin):
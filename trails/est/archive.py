@@ -0,0 +1,149 @@
+"""Binary archives for moving an import's networks between instances.
+
+An archive is a manifest plus a series of chunks. Each chunk is self contained: a fixed header (magic, version,
+header length), a JSON header with the import record and the scalar fields and blob sizes of every network,
+then the blobs themselves (EWKB geometries and the raw graph), all zlib compressed. Chunks are loaded
+independently with `bulk_create` in a transaction and skip networks that already exist, so uploads can run in
+parallel and an interrupted transfer resumes where it stopped.
+"""
+import hashlib
+import itertools
+import json
+import struct
+import zlib
+from typing import Dict, Iterable, Iterator, List, Set, Tuple
+
+from django.contrib.gis.geos import GEOSGeometry
+from django.db import IntegrityError, transaction
+from measurement.measures import Distance
+
+from est.models import Import, TrailNetwork, NetworkGeometry
+
+MAGIC = b'TRLA'
+VERSION = 1
+HEADER = struct.Struct('<4sBxxxI')
+# Request bodies are capped at DATA_UPLOAD_MAX_MEMORY_SIZE (10MB); chunks are cut well below it
+DEFAULT_CHUNK_BYTES = 6 * 1024 * 1024
+
+NETWORK_FIELDS = ('id', 'name', 'total_length', 'area', 'digest', 'trails', 'poly', 'trailheads', 'graph')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def checksum(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def import_record(import_obj: Import) -> Dict:
+    return dict(id=str(import_obj.id), name=import_obj.name, sha256_sum=import_obj.sha256_sum,
+                complete=import_obj.complete, border=bytes(import_obj.border.ewkb).hex())
+
+
+def _network_blobs(network: TrailNetwork) -> List[bytes]:
+    return [bytes(network.trails.ewkb), bytes(network.poly.ewkb), bytes(network.trailheads.ewkb),
+            bytes(network.graph)]
+
+
+def write_chunk(record: Dict, networks: Iterable[Tuple[Dict, List[bytes]]]) -> bytes:
+    """A compressed chunk from the import record and (fields, blobs) of each network"""
+    entries, blobs = [], []
+    for fields, network_blobs in networks:
+        entries.append(dict(fields, sizes=[len(blob) for blob in network_blobs]))
+        blobs.extend(network_blobs)
+    header = json.dumps(dict(import_record=record, networks=entries)).encode('utf-8')
+    body = b''.join([HEADER.pack(MAGIC, VERSION, len(header)), header] + blobs)
+    return zlib.compress(body, 6)
+
+
+def read_chunk(data: bytes) -> Tuple[Dict, List[Tuple[Dict, List[bytes]]]]:
+    try:
+        body = zlib.decompress(data)
+    except zlib.error as ex:
+        raise ArchiveError(f'Chunk is not compressed data: {ex}')
+    magic, version, header_size = HEADER.unpack_from(body)
+    if magic != MAGIC or version != VERSION:
+        raise ArchiveError(f'Not a version {VERSION} network archive chunk')
+    offset = HEADER.size + header_size
+    header = json.loads(body[HEADER.size:offset].decode('utf-8'))
+    networks = []
+    for entry in header['networks']:
+        blobs = []
+        for size in entry.pop('sizes'):
+            blobs.append(body[offset:offset + size])
+            offset += size
+        networks.append((entry, blobs))
+    if offset != len(body):
+        raise ArchiveError('Chunk is truncated or has trailing data')
+    return header['import_record'], networks
+
+
+def export_chunks(import_obj: Import, exclude: Set[str] = frozenset(),
+                  max_bytes: int = DEFAULT_CHUNK_BYTES) -> Iterator[Tuple[List[str], bytes]]:
+    """(network ids, chunk) covering every network of the import not in `exclude`, cut at about `max_bytes`
+    of uncompressed blobs"""
+    record = import_record(import_obj)
+    networks = import_obj.networks.exclude(id__in=exclude).only(*NETWORK_FIELDS).order_by('id')
+    pending, size = [], 0
+    for network in networks.iterator():
+        fields = dict(id=str(network.id), name=network.name, total_length_m=network.total_length.m,
+                      area=network.area, digest=network.digest)
+        blobs = _network_blobs(network)
+        blobs_size = sum(len(blob) for blob in blobs)
+        if pending and size + blobs_size > max_bytes:
+            yield [fields['id'] for fields, _ in pending], write_chunk(record, pending)
+            pending, size = [], 0
+        pending.append((fields, blobs))
+        size += blobs_size
+    if pending:
+        yield [fields['id'] for fields, _ in pending], write_chunk(record, pending)
+
+
+def _geometry(ewkb: bytes) -> GEOSGeometry:
+    # GEOSGeometry only reads WKB from a memoryview; bytes are taken as WKT
+    return GEOSGeometry(memoryview(ewkb))
+
+
+def _ensure_import(record: Dict) -> Import:
+    """The import the chunk belongs to, created inactive on first sight"""
+    defaults = dict(name=record['name'], sha256_sum=record['sha256_sum'], complete=record['complete'],
+                    border=_geometry(bytes.fromhex(record['border'])), active=False)
+    try:
+        with transaction.atomic():
+            return Import.objects.get_or_create(id=record['id'], defaults=defaults)[0]
+    except IntegrityError:
+        # Another chunk of the same import created it first
+        return Import.objects.get(id=record['id'])
+
+
+def load_chunk(data: bytes, import_id: str = None) -> int:
+    """Create the chunk's networks, skipping ones that already exist. Returns how many were created."""
+    record, networks = read_chunk(data)
+    if import_id is not None and record['id'] != str(import_id):
+        raise ArchiveError(f"Chunk belongs to import {record['id']}, not {import_id}")
+    with transaction.atomic():
+        import_obj = _ensure_import(record)
+        ids = [fields['id'] for fields, _ in networks]
+        existing = {str(i) for i in TrailNetwork.objects.filter(id__in=ids).values_list('id', flat=True)}
+        created = []
+        for fields, (trails, poly, trailheads, graph) in networks:
+            if fields['id'] in existing:
+                continue
+            created.append(TrailNetwork(
+                id=fields['id'],
+                source=import_obj,
+                name=fields['name'],
+                total_length=Distance(m=fields['total_length_m']),
+                area=fields['area'],
+                digest=fields['digest'],
+                trails=_geometry(trails),
+                poly=_geometry(poly),
+                trailheads=_geometry(trailheads),
+                graph=graph,
+            ))
+        TrailNetwork.objects.bulk_create(created)
+        NetworkGeometry.objects.bulk_create(
+            itertools.chain.from_iterable(NetworkGeometry.for_network(network) for network in created)
+        )
+    return len(created)
@@ -0,0 +1,93 @@
+"""Cache for the network detail payload served by `views.get_network`.
+
+Entries live in the `networks` cache alias: local memory in development, Redis wherever `REDIS_URL` is set
+so every web worker and the celery workers that finish circuits share (and invalidate) one copy. Django 2.2
+ships no Redis backend, so a small one is defined here.
+"""
+import pickle
+from typing import Iterable, Optional
+
+import redis
+from django.core.cache import caches
+from django.core.cache.backends.base import BaseCache, DEFAULT_TIMEOUT
+
+NETWORK_CACHE = 'networks'
+
+
+class RedisCache(BaseCache):
+    """Minimal Django cache backend over redis-py. `LOCATION` is a redis URL."""
+
+    def __init__(self, server, params):
+        super().__init__(params)
+        self._url = server
+        self._client = None
+
+    @property
+    def client(self):
+        if self._client is None:
+            self._client = redis.Redis.from_url(self._url)
+        return self._client
+
+    def _ttl(self, timeout):
+        if timeout is DEFAULT_TIMEOUT:
+            timeout = self.default_timeout
+        return None if timeout is None else max(int(timeout), 1)
+
+    def add(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self.client.set(key, pickle.dumps(value), ex=self._ttl(timeout), nx=True))
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        value = self.client.get(key)
+        return default if value is None else pickle.loads(value)
+
+    def set(self, key, value, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.client.set(key, pickle.dumps(value), ex=self._ttl(timeout))
+
+    def touch(self, key, timeout=DEFAULT_TIMEOUT, version=None):
+        key = self.make_key(key, version=version)
+        ttl = self._ttl(timeout)
+        if ttl is None:
+            return bool(self.client.persist(key))
+        return bool(self.client.expire(key, ttl))
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self.client.delete(key)
+
+    def delete_many(self, keys, version=None):
+        keys = [self.make_key(key, version=version) for key in keys]
+        if keys:
+            self.client.delete(*keys)
+
+    def has_key(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        return bool(self.client.exists(key))
+
+    def clear(self):
+        prefix = self.make_key('*')
+        for key in self.client.scan_iter(match=prefix):
+            self.client.delete(key)
+
+
+def network_key(network_id) -> str:
+    return f'network-json:{network_id}'
+
+
+def get_network_payload(network_id) -> Optional[str]:
+    return caches[NETWORK_CACHE].get(network_key(network_id))
+
+
+def set_network_payload(network_id, payload: str):
+    caches[NETWORK_CACHE].set(network_key(network_id), payload)
+
+
+def invalidate_networks(network_ids: Iterable):
+    caches[NETWORK_CACHE].delete_many([network_key(network_id) for network_id in network_ids])
@@ -0,0 +1,49 @@
+"""JSON responses built from pre-encoded GeoJSON fragments.
+
+Geometries arrive as GeoJSON text (from `ST_AsGeoJSON` or written directly) and are spliced into the response
+as-is, so they are never parsed into Python objects and serialized again.
+"""
+import json
+from typing import Any, Dict, Iterable, Iterator, Optional, Tuple
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import StreamingHttpResponse
+
+JSON_CONTENT_TYPE = 'application/json'
+
+
+def encode(value: Any) -> str:
+    return json.dumps(value, cls=DjangoJSONEncoder)
+
+
+def feature(geometry: Optional[str], id=None, properties: Optional[Dict[str, Any]] = None) -> str:
+    head = dict(id=id, type='Feature') if id is not None else dict(type='Feature')
+    if properties is not None:
+        head['properties'] = properties
+    return f'{encode(head)[:-1]}, "geometry": {geometry or "null"}}}'
+
+
+def point(x: float, y: float) -> str:
+    return f'{{"type": "Point", "coordinates": [{x!r}, {y!r}]}}'
+
+
+def feature_collection(features: Iterable[str]) -> Iterator[str]:
+    yield '{"type": "FeatureCollection", "features": ['
+    for i, f in enumerate(features):
+        yield f if i == 0 else ', ' + f
+    yield ']}'
+
+
+def wrap(fragments: Iterable[str], before: str, after: str) -> Iterator[str]:
+    yield before
+    yield from fragments
+    yield after
+
+
+def join_fields(fields: Iterable[Tuple[str, str]]) -> str:
+    """A JSON object from already encoded field values"""
+    return '{' + ', '.join(f'{encode(key)}: {value}' for key, value in fields) + '}'
+
+
+def streaming_response(fragments: Iterable[str], status: int = 200) -> StreamingHttpResponse:
+    return StreamingHttpResponse(fragments, content_type=JSON_CONTENT_TYPE, status=status)
@@ -0,0 +1,74 @@
+"""GPX downloads written incrementally: route points are read from a server side cursor and rendered in
+chunks, so memory stays flat however long the circuit is."""
+from datetime import datetime, timedelta
+from typing import Iterable, Iterator, Optional, Tuple
+from xml.sax.saxutils import escape
+
+from django.db import connection
+from django.http import StreamingHttpResponse
+
+GPX_CONTENT_TYPE = 'application/gpx'
+FETCH_SIZE = 2000
+
+ROUTE_POINTS_SQL = '''
+SELECT ST_X(p.geom), ST_Y(p.geom), ST_Z(p.geom)
+FROM est_circuit c, ST_DumpPoints(c.route) p
+WHERE c.id = %s
+'''
+
+HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<gpx xmlns="http://www.topografix.com/GPX/1/1" xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance" '
+    'xsi:schemaLocation="http://www.topografix.com/GPX/1/1 http://www.topografix.com/GPX/1/1/gpx.xsd" '
+    'version="1.1" creator="everysingletrail.com">\n'
+    '  <trk>\n'
+)
+FOOTER = '    </trkseg>\n  </trk>\n</gpx>\n'
+
+Point = Tuple[float, float, Optional[float]]
+
+
+def route_points(circuit_id) -> Iterator[Point]:
+    """(lon, lat, elevation) of every vertex of the circuit's route, in order"""
+    with connection.chunked_cursor() as cursor:
+        cursor.execute(ROUTE_POINTS_SQL, [circuit_id])
+        while True:
+            rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                return
+            yield from rows
+
+
+def track_point(lon: float, lat: float, elevation: Optional[float], time: datetime) -> str:
+    ele = f'\n        <ele>{elevation!r}</ele>' if elevation is not None else ''
+    return (f'      <trkpt lat="{lat!r}" lon="{lon!r}">{ele}\n'
+            f'        <time>{time.isoformat()}Z</time>\n'
+            f'      </trkpt>\n')
+
+
+def gpx_document(points: Iterable[Point], name: Optional[str] = None, start: Optional[datetime] = None,
+                 chunk_points: int = FETCH_SIZE, elevations: bool = True) -> Iterator[str]:
+    """A single track GPX document. Points are a second apart, starting a second after `start`. Without
+    `elevations` the points' z values are left out, for routes where they are only placeholders."""
+    yield HEADER
+    if name:
+        yield f'    <name>{escape(name)}</name>\n'
+    yield '    <trkseg>\n'
+    time = start or datetime.now()
+    second = timedelta(seconds=1)
+    chunk = []
+    for lon, lat, elevation in points:
+        time += second
+        chunk.append(track_point(lon, lat, elevation if elevations else None, time))
+        if len(chunk) == chunk_points:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    yield FOOTER
+
+
+def gpx_response(fragments: Iterable[str], filename: str) -> StreamingHttpResponse:
+    response = StreamingHttpResponse(fragments, content_type=GPX_CONTENT_TYPE)
+    response["Content-Disposition"] = f"attachment; filename={filename}.gpx"
+    return response
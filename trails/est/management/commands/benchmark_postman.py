@@ -0,0 +1,58 @@
+import csv
+import time
+from tempfile import NamedTemporaryFile
+
+import djclick as click
+from measurement.measures import Distance
+from postman_problems import solver
+from postman_problems.stats import calculate_postman_solution_stats
+
+from osm import cpp
+from osm.loader import IngestSettings, DefaultQualitySettings, OSMIngestor
+
+
+def postman_problems_cpp(edges):
+    with NamedTemporaryFile(suffix='.csv', mode='w') as f:
+        writer = csv.DictWriter(f, fieldnames=['start', 'end', 'id', 'distance'])
+        writer.writeheader()
+        for start, end, edge_id, distance in edges:
+            writer.writerow(dict(start=start, end=end, id=edge_id, distance=distance))
+        f.flush()
+        circuit, _ = solver.cpp(f.name)
+    return circuit
+
+
+def timed(f, *args):
+    start = time.perf_counter()
+    result = f(*args)
+    return result, time.perf_counter() - start
+
+
+@click.command()
+@click.argument('osm-data', type=click.Path(exists=True))
+@click.option('--max-edges', type=click.INT, default=None, help='Skip the old solver on larger networks')
+@click.option('--k-nearest', type=click.INT, default=None, help='Use the sparse matching heuristic')
+def benchmark_postman(osm_data, max_edges, k_nearest):
+    """Compare osm.cpp against postman_problems on every network in an OSM extract"""
+    settings = IngestSettings(
+        max_distance=Distance(km=50),
+        max_segments=300,
+        max_concurrent=40,
+        quality_settings=DefaultQualitySettings,
+    )
+    loader = OSMIngestor(settings)
+    loader.load_osm(osm_data)
+    print('edges\told_s\tnew_s\told_km\tnew_km\tname')
+    for network in loader.trail_networks():
+        edges = []
+        for segment in network.trail_segments():
+            start, end = segment.end_points()
+            edges.append((start.derived_id, end.derived_id, segment.id, segment.length_m()))
+        new, new_s = timed(cpp.cpp, edges, None, k_nearest)
+        new_km = calculate_postman_solution_stats(new)['distance_walked'] / 1000
+        if max_edges is None or len(edges) <= max_edges:
+            old, old_s = timed(postman_problems_cpp, edges)
+            old_km = calculate_postman_solution_stats(old)['distance_walked'] / 1000
+            print(f'{len(edges)}\t{old_s:.3f}\t{new_s:.3f}\t{old_km:.3f}\t{new_km:.3f}\t{network.name}')
+        else:
+            print(f'{len(edges)}\t-\t{new_s:.3f}\t-\t{new_km:.3f}\t{network.name}')
@@ -1,32 +1,79 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
 import djclick as click
-from tqdm import tqdm
 import requests
-from django.core.serializers import serialize
+from tqdm import tqdm
 
-from django.core.paginator import Paginator
 import est.models as e
+from est import archive
+
+RETRIES = 3
+
+
+def upload_chunk(target, import_id, chunk: bytes, token: str) -> int:
+    url = f"{target}/api/import/{import_id}/chunk"
+    headers = {'Content-Type': 'application/octet-stream', 'X-Chunk-Sha256': archive.checksum(chunk),
+               'X-Import-Token': token}
+    for attempt in range(RETRIES):
+        try:
+            resp = requests.post(url, data=chunk, headers=headers, timeout=300)
+            if resp.ok:
+                return resp.json()['created']
+            error = f'{resp.status_code}: {resp.text[:200]}'
+        except requests.RequestException as ex:
+            error = str(ex)
+        tqdm.write(f'Chunk upload to {url} failed ({error}), attempt {attempt + 1}/{RETRIES}')
+    raise click.ClickException(f'Giving up on chunk for import {import_id}')
+
+
+def upload(target, import_obj, parallelism: int, chunk_bytes: int, token: str):
+    loaded = set(requests.get(f"{target}/api/import/{import_obj.id}/").json()["ids"])
+    if loaded:
+        tqdm.write(f"{len(loaded)} already loaded")
+    progress = tqdm(total=import_obj.networks.count() - len(loaded), desc=import_obj.name)
+    with ThreadPoolExecutor(parallelism) as pool:
+        # Keep a bounded number of chunks in flight so they aren't all held in memory
+        in_flight = {}
+        for network_ids, chunk in archive.export_chunks(import_obj, exclude=loaded, max_bytes=chunk_bytes):
+            if len(in_flight) >= 2 * parallelism:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+                    progress.update(in_flight.pop(future))
+            in_flight[pool.submit(upload_chunk, target, import_obj.id, chunk, token)] = len(network_ids)
+        for future, count in in_flight.items():
+            future.result()
+            progress.update(count)
+    progress.close()
+
+
+def write_archive(output, import_obj, chunk_bytes: int):
+    directory = os.path.join(output, str(import_obj.id))
+    os.makedirs(directory, exist_ok=True)
+    manifest = dict(import_record=archive.import_record(import_obj), chunks=[])
+    chunks = archive.export_chunks(import_obj, max_bytes=chunk_bytes)
+    for i, (network_ids, chunk) in enumerate(tqdm(chunks, desc=import_obj.name)):
+        filename = f'chunk-{i:05d}.trla'
+        with open(os.path.join(directory, filename), 'wb') as f:
+            f.write(chunk)
+        manifest['chunks'].append(dict(file=filename, sha256=archive.checksum(chunk), networks=network_ids))
+    with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+        json.dump(manifest, f, indent=2)
 
 
 @click.command()
 @click.argument('target', type=click.STRING, default="https://everysingletrail.com")
-def export(target):
+@click.option('--parallelism', '-p', type=click.INT, default=4, help='Chunks uploaded at once')
+@click.option('--chunk-mb', type=click.FLOAT, default=archive.DEFAULT_CHUNK_BYTES / 1024 / 1024)
+@click.option('--output', type=click.Path(file_okay=False), help='Write archives to this directory instead')
+@click.option('--token', envvar='IMPORT_TOKEN', default='', help="The target's IMPORT_TOKEN")
+def export(target, parallelism, chunk_mb, output, token):
+    chunk_bytes = int(chunk_mb * 1024 * 1024)
     imports = e.Import.objects.filter(complete=True, active=True).order_by('-updated_at')
-    for most_recent_import in tqdm(imports):
-        #if not click.confirm(
-        #        f'Importing {most_recent_import.networks.count()} networks ({most_recent_import.name}) imported {most_recent_import.created_at}'):
-        #    continue
-        loaded = requests.get(f"{target}/api/import/{most_recent_import.id}/").json()
-        # print(f'{len(loaded["ids"])} already loaded')
-        if loaded["ids"]:
-            tqdm.write(f"{len(loaded['ids'])} already loaded")
-        #ids = [network.id for network in most_recent_import.networks]
-        p = Paginator(most_recent_import.networks.exclude(id__in=loaded['ids']).order_by('id'), 32)
-        for i in p.page_range:
-            page = p.page(i)
-            networks = serialize('json', page)
-            import_obj = serialize('json', [most_recent_import])
-            resp = requests.post(f"{target}/api/import", json=dict(import_record=import_obj, networks=networks))
-            if not resp.ok:
-                import pdb;
-                pdb.set_trace()
-    # print(resp.json())
+    for most_recent_import in imports:
+        if output:
+            write_archive(output, most_recent_import, chunk_bytes)
+        else:
+            upload(target, most_recent_import, parallelism, chunk_bytes, token)
@@ -1,19 +1,40 @@
+import itertools
 import os
-import pickle
+import queue
 import subprocess
+import threading
+import time
+import uuid
+from typing import List, Set
 
 import djclick as click
 from django.contrib.gis.geos import MultiLineString, LineString, MultiPolygon, Polygon, MultiPoint
+from django.db import connection, transaction
+from kombu.exceptions import OperationalError
 from measurement.measures import Distance
 from tqdm import tqdm
 
 import est.models as e
-from osm.loader import IngestSettings, DefaultQualitySettings, OSMIngestor
+from est.postman import precompute_circuits
+from osm import incremental
+from osm.digests import FileDigest, file_digest, stored_file_digests
+from osm.loader import IngestSettings, DefaultQualitySettings, OSMIngestor, ParseCancelled
+from osm.storage import dump_graph
+from trails.settings import INGEST_STATE_DIR
 
 BASE_URL = 'https://download.geofabrik.de/north-america/us/{}-latest.osm.pbf'
 
+Settings = IngestSettings(
+    max_distance=Distance(km=50),
+    max_segments=300,
+    max_concurrent=40,
+    quality_settings=DefaultQualitySettings,
+    location_filter=None,
+)
+EXTRA_LINKS = [(885729040, 827103027)]
 
-def import_state(state):
+
+def import_state(state, parallelism: int = 1):
     print(f'Processing {state}')
     cleaned = state.strip().lower().replace(' ', '-')
     output = f'/osm/logs/{cleaned}.log'
@@ -21,52 +42,226 @@ def import_state(state):
     if not os.path.exists(data_path):
         subprocess.run(['curl', BASE_URL.format(cleaned), '-o', data_path], capture_output=True)
     with open(output, 'w') as out:
-        import_from_file(data_path, resume=True)
+        import_from_file(data_path, resume=True, rerun=False, two_pass=True, parallelism=parallelism)
         #subprocess.run(['python', 'manage.py', 'import_data', '--file', data_path], stdout=out)
     return state
 
 
-def import_states_file(states_file):
+def import_states_file(states_file, parallelism: int = 1):
     with open(states_file) as f:
         states = f.readlines()
 
     for state in states:
-        import_state(state)
+        import_state(state, parallelism)
 
 
 @click.command()
 @click.option('--file', type=click.Path(exists=True))
 @click.option('--states', type=click.Path(exists=True))
-@click.option('--parallelism', '-p', type=click.INT, default=1)
+@click.option('--parallelism', '-p', type=click.INT, default=1,
+              help='Processes for naming networks after parks; parsing is serial')
 @click.option('--resume/--no-result', default=False)
 @click.option('--rerun/--no-rerun', default=False)
-def import_data(file, resume, states, parallelism, rerun: bool):
+@click.option('--two-pass/--no-two-pass', default=False, help='Low memory ingest for large extracts')
+@click.option('--circuits/--no-circuits', default=False,
+              help='Queue circuit computation for the imported networks on the celery workers')
+@click.option('--batch-size', type=click.INT, default=50, help='Networks saved per transaction')
+@click.option('--save-state/--no-save-state', default=False,
+              help='Keep the ingest extract and fingerprints needed to apply change files to this import later. '
+                   'Takes two more passes over the extract.')
+@click.option('--changes', type=click.Path(exists=True), help='OSM change file (.osc) to apply to --previous')
+@click.option('--previous', help='Import the change file applies to')
+def import_data(file, resume, states, parallelism, rerun: bool, two_pass: bool, circuits: bool, batch_size: int,
+                save_state: bool, changes, previous):
+    if changes:
+        if not previous:
+            raise click.UsageError('--changes needs the --previous import it applies to')
+        import_changes(previous, changes, parallelism, circuits, batch_size)
     if file:
-        import_from_file(file, resume, rerun)
+        import_from_file(file, resume, rerun, two_pass, parallelism, circuits, batch_size, save_state)
     if states:
-        import_states_file(states)
+        import_states_file(states, parallelism)
+
+
+class WriterError(Exception):
+    pass
+
+
+class BatchWriter:
+    """Saves networks and their simplified geometries on a background thread, `batch_size` per transaction, so
+    building the next networks overlaps with writing the last ones. A partial batch is written once no network
+    has arrived for `FLUSH_INTERVAL_S`."""
+    FLUSH_INTERVAL_S = 5
 
+    def __init__(self, batch_size: int):
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=2 * batch_size)
+        self.written = 0
+        self.batches = 0
+        self.error = None
+        self.started = time.perf_counter()
+        self.thread = threading.Thread(target=self._run, name='network-writer', daemon=True)
+        self.thread.start()
 
-def sha256_digest(f):
-    return subprocess.run(["sha256sum", f], capture_output=True).stdout.split()[0].strip()
+    def put(self, network: e.TrailNetwork):
+        if self.error is not None:
+            raise WriterError('Saving networks failed') from self.error
+        self.queue.put(network)
 
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise WriterError('Saving networks failed') from self.error
 
-def import_from_file(osm_data, resume: bool, rerun: bool):
-    Settings = IngestSettings(
-        max_distance=Distance(km=50),
-        max_segments=300,
-        max_concurrent=40,
-        quality_settings=DefaultQualitySettings,
-        location_filter=None,
+    def rate(self) -> float:
+        return self.written / max(time.perf_counter() - self.started, 1e-9)
+
+    def _run(self):
+        batch = []
+        try:
+            while True:
+                try:
+                    network = self.queue.get(timeout=self.FLUSH_INTERVAL_S)
+                except queue.Empty:
+                    if batch:
+                        self._write(batch)
+                        batch = []
+                    continue
+                if network is None:
+                    if batch:
+                        self._write(batch)
+                    return
+                batch.append(network)
+                if len(batch) >= self.batch_size:
+                    self._write(batch)
+                    batch = []
+        finally:
+            connection.close()
+
+    def _write(self, batch):
+        if self.error is not None:
+            # Keep draining so the producer never blocks on a full queue
+            return
+        try:
+            with transaction.atomic():
+                e.TrailNetwork.objects.bulk_create(batch)
+                e.NetworkGeometry.objects.bulk_create(
+                    itertools.chain.from_iterable(e.NetworkGeometry.for_network(network) for network in batch)
+                )
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as ex:
+            self.error = ex
+
+
+def network_record(network, import_obj: e.Import) -> e.TrailNetwork:
+    multiline_strs = MultiLineString([LineString(trail.points()) for trail in network.trail_segments()])
+
+    border = multiline_strs.convex_hull
+    simplified = multiline_strs  # .simplify(tolerance=0.01)
+    if isinstance(simplified, LineString):
+        simplified = MultiLineString([simplified])
+    # TODO: look for polygons that intersect this one
+
+    trailheads = MultiPoint([t.node.to_point() for t in network.trailheads])
+
+    return e.TrailNetwork(
+        name=network.name or '',
+        source=import_obj,
+        trails=simplified,
+        poly=border,
+        total_length=network.total_length(),
+        graph=dump_graph(network.graph, compress=True),
+        area=border.area,
+        trailheads=trailheads,
+        digest=network.digest
     )
-    digest = sha256_digest(osm_data)
+
+
+def write_networks(networks, import_obj: e.Import, batch_size: int) -> List[Polygon]:
+    """Build and save the records of `networks`. Returns their borders."""
+    borders = []
+    skipped = 0
+    writer = BatchWriter(batch_size)
+    progress = tqdm(networks)
+    try:
+        for network in progress:
+            try:
+                est_network = network_record(network, import_obj)
+            except Exception as ex:
+                skipped += 1
+                tqdm.write(f'Skipping network {network.digest}: {ex!r}')
+                continue
+            writer.put(est_network)
+            borders.append(est_network.poly)
+            progress.set_postfix(saved=writer.written, saved_per_s=f'{writer.rate():.1f}')
+    finally:
+        writer.close()
+    print(f'Saved {writer.written} networks in {writer.batches} transactions ({writer.rate():.1f}/s), '
+          f'skipped {skipped}')
+    return borders
+
+
+def queue_circuits(import_obj: e.Import, circuits: bool):
+    hint = 'compute them with `python manage.py precompute_circuits`'
+    if not circuits:
+        print(f'Circuits not queued, {hint}')
+        return
+    try:
+        precompute_circuits.delay(str(import_obj.id))
+    except OperationalError as ex:
+        print(f'Could not queue circuits ({ex}), {hint}')
+
+
+def save_ingest_state(osm_data, loader: OSMIngestor, import_obj: e.Import):
+    extract, state = incremental.state_paths(INGEST_STATE_DIR, import_obj.id)
+    incremental.write_ingest_extract(osm_data, extract)
+    incremental.ingest_state(loader).save(state)
+    print(f'Saved ingest state to {extract}')
+
+
+def already_imported(digest: str, resume: bool) -> bool:
+    """Whether the extract with this digest has a complete import, and no incomplete one to resume"""
+    same_file = e.Import.objects.filter(sha256_sum__in=stored_file_digests(digest))
+    return same_file.filter(complete=True).exists() and not (resume and same_file.filter(complete=False).exists())
+
+
+def cancel_if_imported(extract_digest: FileDigest, resume: bool, cancel: threading.Event):
+    """Stop the parse as soon as the hash shows there's nothing to import"""
+    try:
+        if already_imported(extract_digest.hexdigest(), resume):
+            cancel.set()
+    except Exception:
+        # Surfaces again when the import checks the digest itself
+        pass
+    finally:
+        connection.close()
+
+
+def import_from_file(osm_data, resume: bool, rerun: bool, two_pass: bool = False, parallelism: int = 1,
+                     circuits: bool = False, batch_size: int = 50, save_state: bool = False):
+    # The extract is hashed while it's parsed, which stops early if the hash turns out to be imported already
+    extract_digest = FileDigest(osm_data)
+    cancel = threading.Event()
+    if not rerun:
+        threading.Thread(target=cancel_if_imported, args=(extract_digest, resume, cancel), name='import-check',
+                         daemon=True).start()
+    loader = OSMIngestor(Settings, parallelism=parallelism)
+    try:
+        loader.load_osm(osm_data, extra_links=EXTRA_LINKS, two_pass=two_pass, cancel=cancel)
+    except ParseCancelled:
+        print(f'Import already done! Digest: {extract_digest.hexdigest()}')
+        return
+    digest = extract_digest.hexdigest()
     print('Digest: ', digest)
-    previous_import = e.Import.objects.filter(complete=False, sha256_sum=digest).order_by('-updated_at').first()
+    same_file = e.Import.objects.filter(sha256_sum__in=stored_file_digests(digest))
+    previous_import = same_file.filter(complete=False).order_by('-updated_at').first()
     if not resume or previous_import is None:
-        if e.Import.objects.filter(sha256_sum=digest, complete=True):
+        if same_file.filter(complete=True):
             print('Import already done!')
             if rerun:
-                e.Import.objects.filter(sha256_sum=digest, complete=True).delete()
+                same_file.filter(complete=True).delete()
             else:
                 return
         #e.Import.objects.all().update(active=False)
@@ -78,43 +273,92 @@ def import_from_file(osm_data, resume: bool, rerun: bool):
         if not click.confirm(
                 f'Resuming import {import_obj.name}, last modified {import_obj.updated_at} currently containing {import_obj.networks.count()} trail networks'):
             return 1
-        # TODO: probably n queries
-        digests = {n.digest for n in import_obj.networks.all()}
+        digests = set(import_obj.networks.values_list('digest', flat=True))
     print(f'{len(digests)} loaded')
-    loader = OSMIngestor(Settings)
-    loader.load_osm(osm_data, extra_links=[(885729040, 827103027)])
-    networks = []
-    for network in tqdm(loader.trail_networks(already_processed=digests)):
-        try:
-            multiline_strs = MultiLineString([LineString(trail.points()) for trail in network.trail_segments()])
-
-            border = multiline_strs.convex_hull
-            simplified = multiline_strs  # .simplify(tolerance=0.01)
-            if isinstance(simplified, LineString):
-                simplified = MultiLineString([simplified])
-            # TODO: look for polygons that intersect this one
-
-            trailheads = MultiPoint([t.node.to_point() for t in network.trailheads])
-
-            est_network = e.TrailNetwork(
-                name=network.name or '',
-                source=import_obj,
-                trails=simplified,
-                poly=border,
-                total_length=network.total_length(),
-                graph=pickle.dumps(network.graph),
-                area=border.area,
-                trailheads=trailheads,
-                digest=network.digest
-            )
-            est_network.save()
-            networks.append(est_network)
-        except Exception as ex:
-            import pdb;
-            pdb.set_trace()
-            print(ex)
+    borders = write_networks(loader.trail_networks(already_processed=digests), import_obj, batch_size)
     import_obj.complete = True
-    if networks:
-        import_border = MultiPolygon([n.poly for n in networks])
+    if borders:
+        import_border = MultiPolygon(borders)
         import_obj.border = import_border.convex_hull
         import_obj.save()
+    if save_state:
+        save_ingest_state(osm_data, loader, import_obj)
+    queue_circuits(import_obj, circuits)
+
+
+def carry_over(previous: e.Import, import_obj: e.Import, digests: Set[str], batch_size: int) -> List[Polygon]:
+    """Copy the networks of `previous` with these digests to `import_obj`, along with their simplified geometries
+    and complete circuits. Returns their borders."""
+    borders = []
+    networks = (
+        network for network in previous.networks.order_by('digest', 'id').distinct('digest').iterator()
+        if network.digest in digests
+    )
+    progress = tqdm(total=len(digests))
+    while True:
+        batch = list(itertools.islice(networks, batch_size))
+        if not batch:
+            break
+        copies = {}
+        for network in batch:
+            copies[network.id] = network
+            network.id = uuid.uuid4()
+            network.source = import_obj
+        geometries = list(e.NetworkGeometry.objects.filter(network_id__in=copies))
+        for geometry in geometries:
+            geometry.id = uuid.uuid4()
+            geometry.network = copies[geometry.network_id]
+        circuits = list(e.Circuit.objects.filter(network_id__in=copies, status=e.Complete)
+                        .order_by('network_id', '-created_at').distinct('network_id'))
+        for circuit in circuits:
+            circuit.id = uuid.uuid4()
+            circuit.network = copies[circuit.network_id]
+            circuit.task_id, circuit.lease_expires, circuit.eta = '', None, None
+        with transaction.atomic():
+            e.TrailNetwork.objects.bulk_create(copies.values())
+            e.NetworkGeometry.objects.bulk_create(geometries)
+            e.Circuit.objects.bulk_create(circuits)
+        borders.extend(network.poly for network in batch)
+        progress.update(len(batch))
+    progress.close()
+    return borders
+
+
+def import_changes(previous_id: str, change_file, parallelism: int = 1, circuits: bool = False,
+                   batch_size: int = 50):
+    """Apply an OSM change file to a previous import. Only the networks the changes touch are rebuilt; the
+    rest are carried over, circuits included. The new import replaces the previous one once it's complete."""
+    previous = e.Import.objects.get(id=previous_id)
+    previous_extract, previous_state = incremental.state_paths(INGEST_STATE_DIR, previous.id)
+    if not os.path.exists(previous_state):
+        raise click.ClickException(f'No ingest state for import {previous.id} in {INGEST_STATE_DIR}')
+    import_obj = e.Import(active=False, complete=False, border=Polygon(), name=f'{previous.name} + {change_file}',
+                          sha256_sum=file_digest(change_file))
+    import_obj.save()
+    extract, state_path = incremental.state_paths(INGEST_STATE_DIR, import_obj.id)
+    incremental.apply_changes(previous_extract, change_file, extract)
+
+    loader = OSMIngestor(Settings, parallelism=parallelism)
+    loader.load_osm(extract, extra_links=EXTRA_LINKS)
+    state = incremental.ingest_state(loader)
+    previous_digests = set(previous.networks.values_list('digest', flat=True))
+    unchanged = incremental.unchanged_networks(incremental.IngestState.load(previous_state), state) & previous_digests
+    print(f'{len(unchanged)} of {len(state.networks)} networks unchanged')
+
+    borders = carry_over(previous, import_obj, unchanged, batch_size)
+    borders += write_networks(loader.trail_networks(already_processed=unchanged), import_obj, batch_size)
+    import_obj.complete = True
+    if borders:
+        import_obj.border = MultiPolygon(borders).convex_hull
+    with transaction.atomic():
+        previous.active = False
+        previous.save()
+        import_obj.active = True
+        import_obj.save()
+    state.save(state_path)
+    # Only the newest import in a chain of changes is ever applied to again
+    for path in (previous_extract, previous_state):
+        os.remove(path)
+    print(f'Import {import_obj.id}: {len(unchanged)} networks carried over, '
+          f'{import_obj.networks.count() - len(unchanged)} rebuilt')
+    queue_circuits(import_obj, circuits)
@@ -0,0 +1,24 @@
+import json
+import os
+
+import djclick as click
+from tqdm import tqdm
+
+from est import archive
+
+
+@click.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+def load_archive(directory):
+    """Load an import archive written by `export_networks --output`. Networks already present are skipped."""
+    with open(os.path.join(directory, 'manifest.json')) as f:
+        manifest = json.load(f)
+    import_id = manifest['import_record']['id']
+    created = 0
+    for entry in tqdm(manifest['chunks']):
+        with open(os.path.join(directory, entry['file']), 'rb') as f:
+            chunk = f.read()
+        if archive.checksum(chunk) != entry['sha256']:
+            raise click.ClickException(f"Checksum mismatch in {entry['file']}")
+        created += archive.load_chunk(chunk, import_id)
+    print(f"Loaded {created} networks into import {import_id} (inactive)")
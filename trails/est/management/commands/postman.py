@@ -1,5 +1,3 @@
-import collections
-import csv
 from datetime import datetime, timedelta
 
 import djclick as click
@@ -7,14 +5,11 @@ import gmplot as gmplot
 import gpxpy
 import gpxpy.gpx
 from measurement.measures import Distance
-from networkx.readwrite import sparse6, nx_yaml, write_gpickle, read_gpickle
 
+from osm.cpp import cpp
 from osm.loader import IngestSettings, DefaultQualitySettings, OSMIngestor
-from postman_problems.solver import cpp
 from postman_problems.stats import calculate_postman_solution_stats
 
-from osm.model import Trail
-
 
 def circuit_to_gpx(circuit, edge_map):
     gpx = gpxpy.gpx.GPX()
@@ -74,16 +69,14 @@ def postman(osm_data):
             edge_map[segment.id] = segment.nodes
         clean_name = (network.name or f'no-name-{i}').replace(' ', '').replace("\'", '')
         gmap.draw(f"{clean_name}-{i}.html")
-        with open('edges.csv', 'w') as csv_file:
-            writer = csv.DictWriter(csv_file, fieldnames=['start', 'end', 'id', 'distance'])
-            writer.writeheader()
-            for segment in network.trail_segments():
-                writer.writerow(dict(start=segment.nodes[0].id, end=segment.nodes[-1].id, id=segment.id,
-                                     distance=segment.length_m()))
+        edges = []
+        for segment in network.trail_segments():
+            start, end = segment.end_points()
+            edges.append((start.id, end.id, segment.id, segment.length_m()))
 
         try:
             s = datetime.now()
-            circuit, graph = cpp('edges.csv')
+            circuit = cpp(edges)
             e = datetime.now()
             print(f'Time: {e-s}')
             for k, v in calculate_postman_solution_stats(circuit).items():
@@ -0,0 +1,77 @@
+import os
+import time
+import uuid
+from multiprocessing import Pool
+
+import djclick as click
+from django.db import connections
+from tqdm import tqdm
+
+from est.models import TrailNetwork
+from est.postman import pending_networks, claim_circuit, compute_circuit, precompute_circuits as queue_circuits
+
+
+def compute(network_id):
+    """Trail length, solve seconds and error of one network. Length is None if someone else has its circuit."""
+    network = TrailNetwork.objects.get(id=network_id)
+    task_id = f'precompute-{uuid.uuid4()}'
+    circuit = claim_circuit(network_id, task_id)
+    if circuit is None:
+        return None, 0, None
+    start = time.perf_counter()
+    try:
+        compute_circuit(network, circuit, task_id)
+        error = None
+    except Exception as ex:
+        error = f'{network.name or network_id}: {ex}'
+    return network.total_length.m, time.perf_counter() - start, error
+
+
+def init_worker():
+    # Connections inherited from the parent can't be shared, each worker opens its own
+    connections.close_all()
+
+
+@click.command()
+@click.option('--parallelism', '-p', type=click.INT, default=os.cpu_count())
+@click.option('--limit', type=click.INT, default=None, help='Only compute the N cheapest pending circuits')
+@click.option('--retry-errors/--skip-errors', default=False)
+@click.option('--celery/--no-celery', default=False, help='Queue the circuits on the celery workers instead')
+def precompute_circuits(parallelism, limit, retry_errors, celery):
+    """Compute the circuit of every active network that doesn't have one yet.
+
+    Networks are scheduled smallest first so most of them are ready early. Interrupting is safe: circuits that
+    didn't finish are picked up again on the next run.
+    """
+    if celery:
+        print(f'Queued {queue_circuits(retry_errors=retry_errors)} circuits')
+        return
+
+    network_ids = list(pending_networks(retry_errors=retry_errors).values_list('id', flat=True)[:limit])
+    print(f'{len(network_ids)} circuits to compute')
+    if not network_ids:
+        return
+
+    connections.close_all()
+    start = time.perf_counter()
+    done = failed = skipped = 0
+    trail_km = solve_s = 0.
+    with Pool(parallelism, initializer=init_worker) as pool:
+        progress = tqdm(pool.imap_unordered(compute, network_ids), total=len(network_ids))
+        for length_m, seconds, error in progress:
+            if length_m is None:
+                skipped += 1
+            elif error:
+                failed += 1
+                tqdm.write(f'Failed: {error}')
+            else:
+                done += 1
+                trail_km += length_m / 1000
+                solve_s += seconds
+            elapsed = time.perf_counter() - start
+            progress.set_postfix(per_min=f'{(done + failed) * 60 / elapsed:.1f}', km_per_s=f'{trail_km / elapsed:.1f}')
+
+    elapsed = time.perf_counter() - start
+    print(f'{done} circuits computed, {failed} failed, {skipped} already in flight in {elapsed:.0f}s: '
+          f'{done * 60 / elapsed:.1f} circuits/min, {trail_km / elapsed:.1f} km of trail/s, '
+          f'{solve_s / max(done, 1):.2f}s average solve')
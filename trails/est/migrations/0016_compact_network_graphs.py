@@ -0,0 +1,32 @@
+import pickle
+
+from django.db import migrations
+
+from osm.model import load_graph
+from osm.storage import dump_graph, is_compact, read_graph
+
+
+def to_compact(apps, schema_editor):
+    TrailNetwork = apps.get_model('est', 'TrailNetwork')
+    for network in TrailNetwork.objects.only('id', 'graph').iterator():
+        if not is_compact(network.graph):
+            network.graph = dump_graph(load_graph(bytes(network.graph)), compress=True)
+            network.save(update_fields=['graph'])
+
+
+def to_pickle(apps, schema_editor):
+    TrailNetwork = apps.get_model('est', 'TrailNetwork')
+    for network in TrailNetwork.objects.only('id', 'graph').iterator():
+        if is_compact(network.graph):
+            network.graph = pickle.dumps(read_graph(network.graph).graph)
+            network.save(update_fields=['graph'])
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('est', '0015_auto_20200706_2142'),
+    ]
+
+    operations = [
+        migrations.RunPython(to_compact, to_pickle)
+    ]
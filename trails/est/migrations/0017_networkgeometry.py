@@ -0,0 +1,48 @@
+import uuid
+
+import django.contrib.gis.db.models.fields
+import django.db.models.deletion
+from django.contrib.gis.geos import LineString, MultiLineString
+from django.db import migrations, models
+
+SIMPLIFICATION_TOLERANCES = [0.05, 0.01, 0.002, 0.0004]
+
+
+def simplify_existing(apps, schema_editor):
+    TrailNetwork = apps.get_model('est', 'TrailNetwork')
+    NetworkGeometry = apps.get_model('est', 'NetworkGeometry')
+    for network in TrailNetwork.objects.only('id', 'trails', 'poly').iterator():
+        levels = []
+        for level, tolerance in enumerate(SIMPLIFICATION_TOLERANCES):
+            trails = network.trails.simplify(tolerance, preserve_topology=True)
+            if isinstance(trails, LineString):
+                trails = MultiLineString([trails])
+            poly = network.poly.simplify(tolerance, preserve_topology=True)
+            levels.append(NetworkGeometry(network=network, level=level, trails=trails, poly=poly))
+        NetworkGeometry.objects.bulk_create(levels)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('est', '0016_compact_network_graphs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='NetworkGeometry',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('level', models.IntegerField(db_index=True)),
+                ('trails', django.contrib.gis.db.models.fields.MultiLineStringField(srid=4326)),
+                ('poly', django.contrib.gis.db.models.fields.PolygonField(srid=4326)),
+                ('network', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='geometries', to='est.TrailNetwork')),
+            ],
+            options={
+                'unique_together': {('network', 'level')},
+            },
+        ),
+        migrations.RunPython(simplify_existing, migrations.RunPython.noop),
+    ]
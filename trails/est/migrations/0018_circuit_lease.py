@@ -0,0 +1,31 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('est', '0017_networkgeometry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='circuit',
+            name='task_id',
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name='circuit',
+            name='lease_expires',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='circuit',
+            name='phase',
+            field=models.IntegerField(
+                choices=[(0, 'queued'), (1, 'loading_graph'), (2, 'solving'), (3, 'building_route')], default=0),
+        ),
+        migrations.AddField(
+            model_name='circuit',
+            name='eta',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
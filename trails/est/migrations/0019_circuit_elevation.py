@@ -0,0 +1,24 @@
+import django_measurement.models
+from django.db import migrations
+import measurement.measures.distance
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('est', '0018_circuit_lease'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='circuit',
+            name='elevation_gain',
+            field=django_measurement.models.MeasurementField(measurement=measurement.measures.distance.Distance,
+                                                             null=True),
+        ),
+        migrations.AddField(
+            model_name='circuit',
+            name='elevation_loss',
+            field=django_measurement.models.MeasurementField(measurement=measurement.measures.distance.Distance,
+                                                             null=True),
+        ),
+    ]
@@ -0,0 +1,17 @@
+from django.db import migrations
+
+import est.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('est', '0019_circuit_elevation'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='circuit',
+            name='route',
+            field=est.models.RouteField(dim=3, null=True, srid=4326),
+        ),
+    ]
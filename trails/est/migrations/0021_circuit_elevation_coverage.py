@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ('est', '0020_circuit_route_optional_z'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='circuit',
+            name='elevation_coverage',
+            field=models.FloatField(null=True),
+        ),
+    ]
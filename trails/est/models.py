@@ -1,16 +1,23 @@
 import re
 import uuid
-from datetime import datetime, timedelta
+from datetime import datetime
+from typing import List, Optional, Tuple
 
 import geopy.distance
-import gpxpy
-import gpxpy.gpx
+import numpy as np
 from django.contrib.gis.db import models
-from django.contrib.gis.geos import Point
+from django.contrib.gis.geos import Point, LineString, MultiLineString
+from django.db import transaction
+from django.db.models.signals import post_save
+from django.dispatch import receiver
+from django.utils import timezone
 from django_measurement.models import MeasurementField
 from measurement.measures import Distance
 
+import osm.elevations
 import osm.model
+import osm.storage
+from est.cache import invalidate_networks
 
 
 class BaseModel(models.Model):
@@ -42,12 +49,15 @@ class TrailNetwork(BaseModel):
 
     trailheads = models.MultiPointField(dim=2)
 
-    # Pickled representation of the networkx graph
+    # Columnar encoding of the networkx graph, see osm.storage
     graph = models.BinaryField()
 
     # Hex digest of the input nodes
     digest = models.TextField(default='')
 
+    def compact_graph(self) -> osm.storage.CompactGraph:
+        return osm.storage.read_graph(self.graph)
+
     def clean_name(self):
         return re.sub(r'\W+', '', self.name)
 
@@ -56,6 +66,43 @@ class TrailNetwork(BaseModel):
         return TrailNetwork.objects.filter(source__active=True)
 
 
+# Douglas-Peucker tolerance, in degrees, of each precomputed geometry level. Level i is used from the zoom where
+# a 256px tile pixel is at least that wide; past the last level the full resolution geometry is served.
+SIMPLIFICATION_TOLERANCES = [0.05, 0.01, 0.002, 0.0004]
+
+
+def simplification_level(zoom: Optional[float]) -> Optional[int]:
+    if zoom is None:
+        return None
+    pixel_degrees = 360 / (256 * 2 ** max(zoom, 0))
+    for level, tolerance in enumerate(SIMPLIFICATION_TOLERANCES):
+        if tolerance <= pixel_degrees:
+            return level
+    return None
+
+
+class NetworkGeometry(BaseModel):
+    """A topology preserving simplification of a network's trails and polygon"""
+    network = models.ForeignKey(TrailNetwork, on_delete=models.CASCADE, related_name='geometries')
+    level = models.IntegerField(db_index=True)
+    trails = models.MultiLineStringField(dim=2)
+    poly = models.PolygonField(dim=2, srid=4326)
+
+    class Meta:
+        unique_together = ('network', 'level')
+
+    @classmethod
+    def for_network(cls, network: TrailNetwork) -> List['NetworkGeometry']:
+        levels = []
+        for level, tolerance in enumerate(SIMPLIFICATION_TOLERANCES):
+            trails = network.trails.simplify(tolerance, preserve_topology=True)
+            if isinstance(trails, LineString):
+                trails = MultiLineString([trails])
+            poly = network.poly.simplify(tolerance, preserve_topology=True)
+            levels.append(cls(network=network, level=level, trails=trails, poly=poly))
+        return levels
+
+
 class Node(models.Model):
     point = models.PointField(geography=True)
     osm_id = models.BigIntegerField(primary_key=True)
@@ -87,10 +134,28 @@ InProgress = 1
 Complete = 2
 Error = 3
 
+# Coarse progress of an in-flight circuit
+Queued = 0
+LoadingGraph = 1
+Solving = 2
+BuildingRoute = 3
+
+
+class RouteField(models.LineStringField):
+    """A line string column that takes (lon, lat, elevation) points, or just (lon, lat) when there's no
+    elevation data. PostGIS only mixes both in a column without a type modifier."""
+
+    def db_type(self, connection):
+        return 'geometry'
+
 
 class Circuit(BaseModel):
-    route = models.LineStringField(dim=3, null=True)
+    route = RouteField(dim=3, null=True)
     total_length = MeasurementField(measurement=Distance, null=True)
+    elevation_gain = MeasurementField(measurement=Distance, null=True)
+    elevation_loss = MeasurementField(measurement=Distance, null=True)
+    # Fraction of the route's points covered by DEM tiles; the rest are interpolated
+    elevation_coverage = models.FloatField(null=True)
     network = models.ForeignKey(TrailNetwork, on_delete=models.CASCADE)
 
     status = models.IntegerField(
@@ -98,22 +163,33 @@ class Circuit(BaseModel):
         default=2)
     error = models.TextField(blank=True)
 
-    def to_gpx(self):
-        gpx = gpxpy.gpx.GPX()
-
-        # Create first track in our GPX:
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(gpx_track)
-
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-        # Create first segment in our GPX track:
-
-        # Create points:
-        t = datetime.now()
-        for (lng, lat, _) in self.route:
-            t += timedelta(seconds=1)
-            gpx_segment.points.append(
-                gpxpy.gpx.GPXTrackPoint(latitude=lat, longitude=lng, time=t)
-            )
-        return gpx.to_xml()
+    # At most one task computes a network's circuit: the one named here, while its lease is live. Leases are
+    # renewed at every phase and by a heartbeat in between, so a crashed worker's circuit can be reclaimed once it
+    # expires.
+    task_id = models.TextField(blank=True)
+    lease_expires = models.DateTimeField(null=True)
+    phase = models.IntegerField(
+        choices=[(Queued, "queued"), (LoadingGraph, "loading_graph"), (Solving, "solving"),
+                 (BuildingRoute, "building_route")],
+        default=Queued)
+    eta = models.DateTimeField(null=True)
+
+    def leased(self, now: datetime = None) -> bool:
+        return self.lease_expires is not None and self.lease_expires > (now or timezone.now())
+
+    def elevation_profile(self, samples: int = 200) -> Tuple[np.ndarray, np.ndarray]:
+        """Distance in meters and elevation at evenly spaced points along the route"""
+        route = self.route.array
+        return osm.elevations.profile(route[:, 1], route[:, 0], route[:, 2], samples)
+
+
+@receiver(post_save, sender=Import)
+def invalidate_import(sender, instance: Import, **kwargs):
+    # Only once the save commits: until then another request could read the old row and cache it again
+    transaction.on_commit(lambda: invalidate_networks(instance.networks.values_list('id', flat=True)))
+
+
+@receiver(post_save, sender=Circuit)
+def invalidate_circuit(sender, instance: Circuit, **kwargs):
+    network_id = instance.network_id
+    transaction.on_commit(lambda: invalidate_networks([network_id]))
@@ -1,80 +1,241 @@
-import csv
-from io import BytesIO
-from tempfile import NamedTemporaryFile
+import threading
+import uuid
+from datetime import timedelta
+from typing import Dict, Optional, Tuple
 
-from django.contrib.gis.geos import Point, LineString
+import numpy as np
+from django.contrib.gis.geos import LineString
+from django.db import connection, transaction
+from django.db.models import DateTimeField, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
 from measurement.measures import Distance
-from networkx import read_gpickle
-from postman_problems import solver
 from postman_problems.stats import calculate_postman_solution_stats
 
-from est.models import TrailNetwork, Circuit, Complete, Error, InProgress
-from osm.model import segments_for_graph
+from est.models import TrailNetwork, Circuit, Complete, Error, InProgress, Queued, LoadingGraph, Solving, \
+    BuildingRoute
+from osm import elevations
+from osm.cpp import cpp, expected_solve_s
 from trails.celery import app
 
 
-def circuit_to_line_string(circuit, edge_map):
-    line_string = []
-    for i, segment in enumerate(circuit):
-        start, end, _, meta = segment
-        nodes = edge_map[meta['id']]
-        if end == nodes[0].derived_id:
-            nodes = reversed(nodes)
-        line_string += [Point(x=node.lon, y=node.lat, z=0) for node in nodes]
-    return LineString(line_string)
+def circuit_coordinates(circuit, edge_map) -> np.ndarray:
+    """(lon, lat) of every vertex along the circuit. `edge_map` maps segment ids to their first node's id and
+    (lat, lon) array."""
+    parts = []
+    for start, end, _, meta in circuit:
+        first_id, coords = edge_map[meta['id']]
+        if end == first_id:
+            coords = coords[::-1]
+        parts.append(coords[:, ::-1])
+    return np.concatenate(parts) if parts else np.empty((0, 2))
 
 
-def find_or_compute_circuit(network: TrailNetwork):
-    existing_circuits = Circuit.objects.filter(network=network)
-    if existing_circuits.exists():
-        circuit = existing_circuits.first()
-        if circuit.status == Complete:
-            return existing_circuits.first()
-        else:
-            status = create_circuit.delay(network.id, circuit.id)
-            print(status)
-            return circuit
-    else:
-        circuit = Circuit.objects.create(
-            network=network,
-            status=1
-        )
-        status = create_circuit.delay(network.id, circuit.id)
-        print(status)
+def circuit_route(circuit, edge_map) -> Tuple[np.ndarray, elevations.Elevations]:
+    """(lon, lat, elevation) of every vertex along the circuit, elevations looked up in one batch, and the
+    lookup itself for its coverage. Just (lon, lat) if no DEM tile covers any of the route."""
+    coords = circuit_coordinates(circuit, edge_map)
+    elevated = elevations.elevate(coords[:, 1], coords[:, 0], smooth=False)
+    if elevated.missing_tiles:
+        print(f"No elevation data in {', '.join(elevated.missing_tiles)}")
+    if elevated.missing.all():
+        return coords, elevated
+    return np.column_stack((coords, elevated.elevations)), elevated
+
+
+def circuit_to_line_string(circuit, edge_map) -> LineString:
+    return LineString(circuit_route(circuit, edge_map)[0])
+
+
+# Long enough to wait out a busy queue; once the task starts it holds the shorter running lease, renewed by a
+# heartbeat for as long as the task runs
+QUEUED_LEASE = timedelta(hours=1)
+RUNNING_LEASE = timedelta(minutes=5)
+HEARTBEAT_INTERVAL = RUNNING_LEASE / 5
+
+
+class LeaseLost(Exception):
+    """The circuit was reclaimed by another task after this one's lease expired"""
+
+
+def current_circuit(network_id) -> Optional[Circuit]:
+    """The network's complete circuit if there is one, otherwise its latest attempt"""
+    circuits = Circuit.objects.filter(network_id=network_id)
+    return circuits.filter(status=Complete).first() or circuits.order_by('-created_at').first()
+
+
+def claim_circuit(network_id, task_id: str) -> Optional[Circuit]:
+    """Hand the network's circuit to `task_id`. Returns None if it's complete or another task holds it."""
+    with transaction.atomic():
+        # Locking the network row serializes claims, including the ones that have to create the circuit
+        list(TrailNetwork.objects.select_for_update().filter(id=network_id).values_list('id', flat=True))
+        circuits = Circuit.objects.select_for_update().filter(network_id=network_id)
+        if circuits.filter(status=Complete).exists():
+            return None
+        circuit = circuits.order_by('-created_at').first()
+        now = timezone.now()
+        if circuit is None:
+            circuit = Circuit(network_id=network_id)
+        elif circuit.leased(now):
+            return None
+        circuit.status = InProgress
+        circuit.phase = Queued
+        circuit.error = ""
+        circuit.task_id = task_id
+        circuit.lease_expires = now + QUEUED_LEASE
+        circuit.eta = None
+        circuit.save()
         return circuit
 
 
+def dispatch_circuit(network_id) -> bool:
+    """Queue a `create_circuit` unless the circuit is complete or already in flight"""
+    task_id = str(uuid.uuid4())
+    circuit = claim_circuit(network_id, task_id)
+    if circuit is None:
+        return False
+    try:
+        create_circuit.apply_async((str(network_id), str(circuit.id)), task_id=task_id)
+    except Exception:
+        # Nothing will ever run under this claim, so let the next request dispatch it again
+        release_claim(circuit, task_id)
+        raise
+    return True
+
+
+def release_claim(circuit: Circuit, task_id: str):
+    Circuit.objects.filter(id=circuit.id, task_id=task_id).update(task_id='', lease_expires=None, eta=None)
+
+
+def find_or_compute_circuit(network: TrailNetwork):
+    """The network's circuit, starting its computation if needed. Repeat requests attach to the one in flight."""
+    dispatch_circuit(network.id)
+    return current_circuit(network.id)
+
+
+def update_owned(circuit: Circuit, task_id: str, **fields):
+    """Save `fields` on the circuit if `task_id` still holds it"""
+    with transaction.atomic():
+        owner = Circuit.objects.select_for_update().values_list('task_id', flat=True).get(id=circuit.id)
+        if owner != task_id:
+            raise LeaseLost(f'Circuit {circuit.id} was reclaimed by {owner}')
+        for field, value in fields.items():
+            setattr(circuit, field, value)
+        circuit.save(update_fields=list(fields))
+
+
+def report_progress(circuit: Circuit, task_id: str, phase: int, expected_s: float = 0):
+    now = timezone.now()
+    eta = now + timedelta(seconds=expected_s)
+    update_owned(circuit, task_id, status=InProgress, phase=phase, eta=eta,
+                 lease_expires=max(now, eta) + RUNNING_LEASE)
+
+
+def renew_lease(circuit_id, task_id: str) -> bool:
+    """Push the lease to at least RUNNING_LEASE from now. False if `task_id` no longer holds the circuit."""
+    lease = timezone.now() + RUNNING_LEASE
+    return bool(Circuit.objects.filter(id=circuit_id, task_id=task_id).update(
+        lease_expires=Greatest('lease_expires', Value(lease, output_field=DateTimeField()))
+    ))
+
+
+class LeaseHeartbeat:
+    """Renews a running task's lease every `interval` on a background thread, so a solve that runs past its ETA
+    isn't reclaimed by another task while this one is still working on it"""
+
+    def __init__(self, circuit: Circuit, task_id: str, interval: timedelta = HEARTBEAT_INTERVAL):
+        self.circuit_id = circuit.id
+        self.task_id = task_id
+        self.interval = interval
+        self.lost = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        try:
+            while not self._stop.wait(self.interval.total_seconds()):
+                if not renew_lease(self.circuit_id, self.task_id):
+                    # Nothing to renew any more; the task finds out when it next saves its progress
+                    self.lost = True
+                    return
+        finally:
+            connection.close()
+
+
 @app.task(bind=True)
 def create_circuit(self, network_id: str, circuit_id: str):
     network = TrailNetwork.objects.get(id=network_id)
     circuit = Circuit.objects.get(id=circuit_id)
-    circuit.status = InProgress
-    circuit.error = ""
-    circuit.save()
     try:
-        graph = read_gpickle(BytesIO(network.graph.tobytes()))
-        with NamedTemporaryFile(suffix='.csv', mode='w') as f:
-            writer = csv.DictWriter(f, fieldnames=['start', 'end', 'id', 'distance'])
-            writer.writeheader()
-            edge_map = {}
-            for segment in segments_for_graph(graph):
-                writer.writerow(dict(start=segment.nodes[0].derived_id, end=segment.nodes[-1].derived_id, id=segment.id,
-                                     distance=segment.length_m()))
-                edge_map[segment.id] = segment.nodes
-            f.flush()
-            circuit_nodes, _ = solver.cpp(f.name)
-            stats = calculate_postman_solution_stats(circuit_nodes)
-            walked_twice = Distance(m=stats['distance_doublebacked'])
-            walked_total = Distance(m=stats['distance_walked_required'])
-
-            line_string = circuit_to_line_string(circuit_nodes, edge_map)
-            circuit.route = line_string
-            circuit.total_length = walked_total
-            circuit.status = Complete
-            circuit.error = ""
+        compute_circuit(network, circuit, self.request.id)
+    except LeaseLost as ex:
+        print(ex)
+
+
+def compute_circuit(network: TrailNetwork, circuit: Circuit, task_id: str):
+    report_progress(circuit, task_id, LoadingGraph)
+    try:
+        with LeaseHeartbeat(circuit, task_id):
+            result = solve_circuit(network, circuit, task_id)
+    except LeaseLost:
+        raise
     except Exception as ex:
-        circuit.status = Error
-        circuit.error = ex
+        update_owned(circuit, task_id, status=Error, error=str(ex), lease_expires=None, eta=None)
         raise
-    finally:
-        circuit.save()
+    update_owned(circuit, task_id, lease_expires=None, eta=None, **result)
+
+
+def solve_circuit(network: TrailNetwork, circuit: Circuit, task_id: str) -> Dict:
+    """The fields of the complete circuit"""
+    graph = network.compact_graph()
+    edges = []
+    edge_map = {}
+    for segment in graph.segments():
+        start, end = segment.end_points()
+        edges.append((start.derived_id, end.derived_id, segment.id, segment.length_m()))
+        edge_map[segment.id] = (start.derived_id, segment.coords())
+    report_progress(circuit, task_id, Solving, expected_s=expected_solve_s(edges))
+    circuit_nodes = cpp(edges)
+    report_progress(circuit, task_id, BuildingRoute)
+    stats = calculate_postman_solution_stats(circuit_nodes)
+    walked_total = Distance(m=stats['distance_walked_required'])
+
+    route, elevated = circuit_route(circuit_nodes, edge_map)
+    result = dict(route=LineString(route), total_length=walked_total, elevation_gain=None,
+                  elevation_loss=None, elevation_coverage=elevated.coverage, status=Complete, error="")
+    if route.shape[1] == 3:
+        gain, loss = elevations.uphill_downhill(route[:, 2])
+        result.update(elevation_gain=Distance(m=gain), elevation_loss=Distance(m=loss))
+    return result
+
+
+def pending_networks(networks=None, retry_errors: bool = False):
+    """Networks without a complete circuit, cheapest first.
+
+    Solve time grows with the size of the network, so total trail length stands in for the cost. Networks
+    whose last attempt failed are skipped unless `retry_errors` is set.
+    """
+    networks = TrailNetwork.active() if networks is None else networks
+    networks = networks.exclude(circuit__status=Complete)
+    if not retry_errors:
+        networks = networks.exclude(circuit__status=Error)
+    return networks.order_by('total_length', 'id')
+
+
+@app.task
+def precompute_circuits(import_id: str = None, retry_errors: bool = False):
+    """Queue a `create_circuit` for every active network (of one import, if given) lacking a complete circuit,
+    smallest first"""
+    networks = None if import_id is None else TrailNetwork.objects.filter(source_id=import_id)
+    queued = 0
+    for network_id in pending_networks(networks, retry_errors).values_list('id', flat=True):
+        queued += dispatch_circuit(network_id)
+    return queued
@@ -1,3 +1,265 @@
-from django.test import TestCase
+import threading
+import time
+import uuid
+import zlib
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from django.contrib.gis.geos import MultiLineString, LineString, MultiPoint, Point, Polygon
+from django.contrib.auth.models import AnonymousUser
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from kombu.exceptions import OperationalError
+from measurement.measures import Distance
+
+from est import archive, gpx, models, postman, views
+from est.management.commands import import_data
+from est.models import Import, TrailNetwork, Circuit, Complete, Error, InProgress, Solving
+
+SQUARE = Polygon(((0, 0), (0, 1), (1, 1), (1, 0), (0, 0)))
+
+
+def make_network(source: Import = None, length_km: float = 1) -> TrailNetwork:
+    source = source or Import.objects.create(border=SQUARE, active=True)
+    return TrailNetwork.objects.create(
+        source=source, name='Test Park', trails=MultiLineString(LineString((0, 0), (1, 1))), poly=SQUARE,
+        total_length=Distance(km=length_km), area=1, trailheads=MultiPoint(Point(0, 0)), graph=b''
+    )
+
+
+class CircuitLeaseTests(TestCase):
+    def setUp(self):
+        self.network = make_network()
+
+    def test_claim(self):
+        circuit = postman.claim_circuit(self.network.id, 'a')
+        self.assertIsNotNone(circuit)
+        self.assertEqual(circuit.status, InProgress)
+        self.assertEqual(circuit.task_id, 'a')
+        self.assertTrue(circuit.leased())
+        # Held by `a` until its lease runs out
+        self.assertIsNone(postman.claim_circuit(self.network.id, 'b'))
+
+    def test_no_claim_once_complete(self):
+        Circuit.objects.create(network=self.network, status=Complete)
+        self.assertIsNone(postman.claim_circuit(self.network.id, 'a'))
+
+    def test_reclaim_after_expiry(self):
+        circuit = postman.claim_circuit(self.network.id, 'a')
+        Circuit.objects.filter(id=circuit.id).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        reclaimed = postman.claim_circuit(self.network.id, 'b')
+        self.assertEqual(reclaimed.id, circuit.id)
+        self.assertEqual(reclaimed.task_id, 'b')
+
+    def test_lease_lost(self):
+        circuit = postman.claim_circuit(self.network.id, 'a')
+        Circuit.objects.filter(id=circuit.id).update(lease_expires=timezone.now() - timedelta(seconds=1))
+        postman.claim_circuit(self.network.id, 'b')
+        with self.assertRaises(postman.LeaseLost):
+            postman.report_progress(circuit, 'a', Solving)
+        self.assertFalse(postman.renew_lease(circuit.id, 'a'))
+
+    def test_dispatch_without_broker(self):
+        with mock.patch.object(postman.create_circuit, 'apply_async', side_effect=OperationalError('refused')):
+            with self.assertRaises(OperationalError):
+                postman.dispatch_circuit(self.network.id)
+        # The failed dispatch doesn't hold on to the circuit
+        self.assertIsNotNone(postman.claim_circuit(self.network.id, 'a'))
+
+    def test_renew_lease(self):
+        circuit = postman.claim_circuit(self.network.id, 'a')
+        postman.report_progress(circuit, 'a', Solving)
+        # Past the ETA of a solve that's taking longer than expected
+        Circuit.objects.filter(id=circuit.id).update(lease_expires=timezone.now() + timedelta(seconds=1))
+        self.assertTrue(postman.renew_lease(circuit.id, 'a'))
+        circuit.refresh_from_db()
+        self.assertGreater(circuit.lease_expires, timezone.now() + postman.RUNNING_LEASE - timedelta(minutes=1))
+        # Never shortened
+        self.assertTrue(postman.renew_lease(circuit.id, 'a'))
+        Circuit.objects.filter(id=circuit.id).update(lease_expires=timezone.now() + timedelta(days=1))
+        self.assertTrue(postman.renew_lease(circuit.id, 'a'))
+        circuit.refresh_from_db()
+        self.assertGreater(circuit.lease_expires, timezone.now() + timedelta(hours=23))
+
+
+class PrecomputeCircuitsTests(TestCase):
+    def setUp(self):
+        self.source = Import.objects.create(border=SQUARE, active=True)
+        self.large, self.small, self.medium = (make_network(self.source, km) for km in (30, 1, 5))
+
+    def test_smallest_first(self):
+        self.assertEqual(list(postman.pending_networks()), [self.small, self.medium, self.large])
+
+    def test_skips_networks_with_circuits(self):
+        Circuit.objects.create(network=self.small, status=Complete)
+        Circuit.objects.create(network=self.medium, status=Error)
+        self.assertEqual(list(postman.pending_networks()), [self.large])
+        self.assertEqual(list(postman.pending_networks(retry_errors=True)), [self.medium, self.large])
+
+    def test_resume(self):
+        Circuit.objects.create(network=self.medium, status=Complete)
+        with mock.patch.object(postman.create_circuit, 'apply_async') as apply_async:
+            self.assertEqual(postman.precompute_circuits(str(self.source.id)), 2)
+            queued = [args[0][0] for args, _ in apply_async.call_args_list]
+            self.assertEqual(queued, [str(self.small.id), str(self.large.id)])
+            # An interrupted run picks up where it left off, without queueing the circuits in flight again
+            self.assertEqual(postman.precompute_circuits(str(self.source.id)), 0)
+            Circuit.objects.filter(network=self.small).update(status=Complete, lease_expires=None)
+            Circuit.objects.filter(network=self.large).update(lease_expires=timezone.now() - timedelta(seconds=1))
+            self.assertEqual(postman.precompute_circuits(str(self.source.id)), 1)
+            self.assertEqual(apply_async.call_args[0][0][0], str(self.large.id))
+
+
+class QueueCircuitsTests(SimpleTestCase):
+    def test_no_broker(self):
+        import_obj = Import(border=SQUARE, active=True)
+        with mock.patch.object(import_data.precompute_circuits, 'delay', side_effect=OperationalError('refused')), \
+                mock.patch('builtins.print') as print_:
+            import_data.queue_circuits(import_obj, circuits=True)
+        self.assertIn('manage.py precompute_circuits', print_.call_args[0][0])
+
+
+class BatchWriterTests(SimpleTestCase):
+    def setUp(self):
+        self.batches = []
+        self.saved = threading.Event()
+        patches = [
+            mock.patch.object(import_data.e.TrailNetwork.objects, 'bulk_create', side_effect=self.bulk_create),
+            mock.patch.object(import_data.e.NetworkGeometry.objects, 'bulk_create'),
+            mock.patch.object(import_data.e.NetworkGeometry, 'for_network', return_value=[]),
+            mock.patch.object(import_data, 'transaction'),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def bulk_create(self, batch):
+        self.batches.append(list(batch))
+        self.saved.set()
+
+    def test_batches(self):
+        writer = import_data.BatchWriter(batch_size=3)
+        for network in range(7):
+            writer.put(network)
+        writer.close()
+        self.assertEqual(self.batches, [[0, 1, 2], [3, 4, 5], [6]])
+        self.assertEqual((writer.written, writer.batches), (7, 3))
+
+    @mock.patch.object(import_data.BatchWriter, 'FLUSH_INTERVAL_S', 0.05)
+    def test_idle_flush(self):
+        writer = import_data.BatchWriter(batch_size=10)
+        writer.put(0)
+        writer.put(1)
+        # The partial batch is saved without waiting for more networks or the close
+        self.assertTrue(self.saved.wait(timeout=5))
+        self.assertEqual(self.batches, [[0, 1]])
+        writer.close()
+        self.assertEqual(writer.batches, 1)
+
+    def test_failed_write(self):
+        import_data.e.TrailNetwork.objects.bulk_create.side_effect = ValueError('no database')
+        writer = import_data.BatchWriter(batch_size=1)
+        writer.put(0)
+        deadline = time.monotonic() + 5
+        while writer.error is None and time.monotonic() < deadline:
+            time.sleep(0.01)
+        with self.assertRaises(import_data.WriterError):
+            writer.put(1)
+        with self.assertRaises(import_data.WriterError) as raised:
+            writer.close()
+        self.assertIsInstance(raised.exception.__cause__, ValueError)
+        self.assertEqual(writer.written, 0)
+
+
+def network_chunk(network: TrailNetwork) -> bytes:
+    fields = dict(id=str(network.id), name=network.name, total_length_m=network.total_length.m, area=network.area,
+                  digest=network.digest)
+    return archive.write_chunk(archive.import_record(network.source), [(fields, archive._network_blobs(network))])
+
+
+class ArchiveChunkTests(SimpleTestCase):
+    def test_round_trip(self):
+        source = Import(border=SQUARE, active=True, name='Huddart', sha256_sum='abc')
+        network = TrailNetwork(source=source, name='Test Park', trails=MultiLineString(LineString((0, 0), (1, 1))),
+                               poly=SQUARE, total_length=Distance(km=1), area=1, trailheads=MultiPoint(Point(0, 0)),
+                               graph=b'graph', digest='d1')
+        record, networks = archive.read_chunk(network_chunk(network))
+        self.assertEqual(record, archive.import_record(source))
+        [(fields, blobs)] = networks
+        self.assertEqual(fields['id'], str(network.id))
+        self.assertEqual(fields['digest'], 'd1')
+        self.assertEqual(blobs, archive._network_blobs(network))
+        self.assertTrue(archive._geometry(blobs[1]).equals(SQUARE))
+
+    def test_corrupt(self):
+        with self.assertRaises(archive.ArchiveError):
+            archive.read_chunk(b'not a chunk')
+        chunk = archive.write_chunk(dict(id='1'), [(dict(id='n'), [b'blob'])])
+        with self.assertRaises(archive.ArchiveError):
+            archive.read_chunk(zlib.compress(zlib.decompress(chunk)[:-1]))
+
+
+class LoadChunkTests(TestCase):
+    def test_load(self):
+        network = make_network()
+        chunk = network_chunk(network)
+        source_id = network.source_id
+        TrailNetwork.objects.all().delete()
+        Import.objects.all().delete()
+        self.assertEqual(archive.load_chunk(chunk, source_id), 1)
+        loaded = TrailNetwork.objects.get(id=network.id)
+        self.assertEqual(loaded.source_id, source_id)
+        self.assertFalse(loaded.source.active)
+        self.assertEqual(bytes(loaded.graph), bytes(network.graph))
+        self.assertTrue(loaded.poly.equals(SQUARE))
+        # Resent chunks are skipped
+        self.assertEqual(archive.load_chunk(chunk, source_id), 0)
+        with self.assertRaises(archive.ArchiveError):
+            archive.load_chunk(chunk, uuid.uuid4())
+
+
+class ImportAuthorizationTests(SimpleTestCase):
+    def post(self, user=AnonymousUser(), **headers):
+        request = RequestFactory().post('/api/import/1/chunk', data=b'chunk', content_type='application/octet-stream',
+                                        **headers)
+        request.user = user
+        with mock.patch.object(archive, 'load_chunk', return_value=1) as load_chunk:
+            response = views.import_chunk(request, '1')
+        return response.status_code, load_chunk.called
+
+    @override_settings(IMPORT_TOKEN='secret')
+    def test_token(self):
+        self.assertEqual(self.post(), (403, False))
+        self.assertEqual(self.post(HTTP_X_IMPORT_TOKEN='wrong'), (403, False))
+        self.assertEqual(self.post(HTTP_X_IMPORT_TOKEN='secret'), (200, True))
+
+    @override_settings(IMPORT_TOKEN='')
+    def test_no_token_configured(self):
+        self.assertEqual(self.post(HTTP_X_IMPORT_TOKEN=''), (403, False))
+        self.assertEqual(self.post(mock.Mock(is_staff=True)), (200, True))
+
+
+class GpxTests(SimpleTestCase):
+    def test_elevations(self):
+        points = [(-122.1, 37.1, 0.0), (-122.2, 37.2, 12.5), (-122.3, 37.3, None)]
+        document = ''.join(gpx.gpx_document(points, name='Sea & Shore'))
+        self.assertIn('<name>Sea &amp; Shore</name>', document)
+        self.assertEqual(document.count('<trkpt'), 3)
+        # Sea level is an elevation too
+        self.assertEqual(document.count('<ele>'), 2)
+        self.assertIn('<ele>0.0</ele>', document)
+
+    def test_placeholder_elevations(self):
+        points = [(-122.1, 37.1, 0.0), (-122.2, 37.2, 0.0)]
+        self.assertNotIn('<ele>', ''.join(gpx.gpx_document(points, elevations=False)))
+
+
+class CacheInvalidationTests(SimpleTestCase):
+    def test_after_commit(self):
+        network_id = uuid.uuid4()
+        with mock.patch.object(models.transaction, 'on_commit') as on_commit, \
+                mock.patch.object(models, 'invalidate_networks') as invalidate_networks:
+            models.invalidate_circuit(Circuit, Circuit(network_id=network_id))
+            invalidate_networks.assert_not_called()
+            on_commit.call_args[0][0]()
+        invalidate_networks.assert_called_once_with([network_id])
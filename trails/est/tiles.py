@@ -0,0 +1,101 @@
+"""Mapbox vector tiles of the active trail networks, rendered by PostGIS and cached per active import set."""
+import hashlib
+import math
+from typing import Tuple
+
+from django.core.cache import caches
+from django.db import connection
+
+from est.models import Import, simplification_level
+
+TILE_CACHE = 'tiles'
+MAX_ZOOM = 22
+EXTENT = 4096
+BUFFER = 64
+# Half the width of the web mercator square, in meters
+ORIGIN_SHIFT = math.pi * 6378137
+
+# Same color and feature id choices as `views.areas`, done in SQL from the uuid's integer value
+UUID_INT = '''(
+    ('x' || substr(h, 1, 8))::bit(32)::bigint::numeric * 79228162514264337593543950336
+    + ('x' || substr(h, 9, 8))::bit(32)::bigint::numeric * 18446744073709551616
+    + ('x' || substr(h, 17, 8))::bit(32)::bigint::numeric * 4294967296
+    + ('x' || substr(h, 25, 8))::bit(32)::bigint::numeric
+)'''
+
+TILE_SQL = f'''
+WITH bounds AS (
+    SELECT ST_MakeEnvelope(%(xmin)s, %(ymin)s, %(xmax)s, %(ymax)s, 3857) AS geom
+), visible AS (
+    -- Simplified geometries where the zoom has a level, full resolution otherwise
+    SELECT
+        n.id, n.poly AS extent, COALESCE(g.poly, n.poly) AS poly, COALESCE(g.trails, n.trails) AS trails,
+        replace(n.id::text, '-', '') AS h
+    FROM est_trailnetwork n
+    JOIN est_import i ON i.id = n.source_id
+    LEFT JOIN est_networkgeometry g ON g.network_id = n.id AND g.level = %(level)s
+    WHERE i.active AND n.poly && ST_Transform((SELECT geom FROM bounds), 4326)
+), networks AS (
+    SELECT
+        mod({UUID_INT}, %(max_areas)s)::bigint AS fid,
+        id::text AS id,
+        '#' || (%(colors)s::text[])[mod({UUID_INT}, %(num_colors)s)::int + 1] AS fill_color,
+        json_build_array(
+            json_build_array(ST_XMin(extent), ST_YMin(extent)),
+            json_build_array(ST_XMax(extent), ST_YMax(extent))
+        )::text AS bb,
+        ST_AsMVTGeom(ST_Transform(poly, 3857), (SELECT geom FROM bounds), {EXTENT}, {BUFFER}, true) AS geom
+    FROM visible
+), trails AS (
+    SELECT
+        id::text AS id,
+        ST_AsMVTGeom(ST_Transform(trails, 3857), (SELECT geom FROM bounds), {EXTENT}, {BUFFER}, true) AS geom
+    FROM visible
+)
+SELECT
+    (SELECT COALESCE(ST_AsMVT(networks, 'networks', {EXTENT}, 'geom'), ''::bytea) FROM networks WHERE geom IS NOT NULL)
+    || (SELECT COALESCE(ST_AsMVT(trails, 'trails', {EXTENT}, 'geom'), ''::bytea) FROM trails WHERE geom IS NOT NULL)
+'''
+
+
+def valid_tile(z: int, x: int, y: int) -> bool:
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def tile_bounds(z: int, x: int, y: int) -> Tuple[float, float, float, float]:
+    """Web mercator (EPSG:3857) bounds of an XYZ tile"""
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def active_import_digest() -> str:
+    """Changes whenever an import is activated, deactivated or re-saved, so cached tiles never outlive it"""
+    imports = Import.objects.filter(active=True).order_by('id').values_list('id', 'updated_at')
+    return hashlib.sha1(repr(list(imports)).encode('utf-8')).hexdigest()[:16]
+
+
+def render_tile(z: int, x: int, y: int, colors, max_areas: int) -> bytes:
+    xmin, ymin, xmax, ymax = tile_bounds(z, x, y)
+    # Vector tiles are drawn 512 pixels wide, twice the 256 `simplification_level` assumes
+    level = simplification_level(z + 1)
+    with connection.cursor() as cursor:
+        cursor.execute(TILE_SQL, dict(
+            xmin=xmin, ymin=ymin, xmax=xmax, ymax=ymax, level=level,
+            colors=list(colors), num_colors=len(colors), max_areas=max_areas
+        ))
+        tile, = cursor.fetchone()
+    return bytes(tile or b'')
+
+
+def get_tile(z: int, x: int, y: int, colors, max_areas: int, digest: str = None) -> Tuple[bytes, str]:
+    """The tile's bytes and the import set digest they were rendered for"""
+    digest = digest or active_import_digest()
+    key = f'tile:{digest}:{z}/{x}/{y}'
+    cache = caches[TILE_CACHE]
+    tile = cache.get(key)
+    if tile is None:
+        tile = render_tile(z, x, y, colors, max_areas)
+        cache.set(key, tile)
+    return tile, digest
@@ -8,11 +8,14 @@ urlpatterns = [
     path('about', views.about, name='about'),
     path('api/default', views.base_map, name='default'),
     path('api/areas', views.areas, name='areas'),
+    path('tiles/<int:z>/<int:x>/<int:y>.mvt', views.tile, name='tile'),
     path('api/circuit/<str:network_id>/', views.compute_circuit, name='circuits'),
     path('api/circuit/<str:circuit_id>/gpx', views.gpx, name='gpx'),
     path('api/circuit/<str:circuit_id>/json', views.circuit_json, name='circuit-json'),
+    path('api/circuit/<str:circuit_id>/profile', views.elevation_profile, name='circuit-profile'),
     path('api/network/<str:network_id>/', views.get_network, name='network'),
     path('api/import', csrf_exempt(views.external_import), name='import'),
     path('api/import/<str:import_id>/', views.import_ids, name='import-ids'),
+    path('api/import/<str:import_id>/chunk', csrf_exempt(views.import_chunk), name='import-chunk'),
     path('api/status', views.status, name='status')
 ]
@@ -1,22 +1,30 @@
+import hmac
 import json
-from io import BytesIO
+from functools import wraps
 from json import JSONDecodeError
-from typing import Any, Dict, List
+from typing import Optional
 
 import attr
 import cattr
+from django.conf import settings
+from django.contrib.gis.db.models.functions import AsGeoJSON, Envelope, Intersection
 from django.contrib.gis.geos import MultiPolygon, Polygon
 from django.contrib.humanize.templatetags.humanize import naturaltime
 from django.core.serializers import deserialize, serialize
+from django.db.models import FilteredRelation, Q
+from django.db.models.functions import Coalesce
 from django.http import JsonResponse, HttpResponse
 from django.shortcuts import render
 from django.urls import reverse
 from django.views.decorators.csrf import ensure_csrf_cookie
 from measurement.measures import Distance
-from networkx import read_gpickle
 
-from est.models import TrailNetwork, Import, Circuit, Complete, InProgress, Error
-from est.postman import find_or_compute_circuit
+from est import archive, geojson, tiles
+from est.gpx import gpx_document, gpx_response, route_points
+from est.cache import get_network_payload, set_network_payload
+from est.models import TrailNetwork, Import, Circuit, Complete, InProgress, Error, NetworkGeometry, \
+    simplification_level
+from est.postman import find_or_compute_circuit, current_circuit
 
 
 @ensure_csrf_cookie
@@ -41,11 +49,14 @@ class LatLng:
 class AreasRequest:
     sw: LatLng
     ne: LatLng
+    zoom: Optional[float] = None
 
     def to_poly(self):
-        return Polygon.from_bbox(
+        poly = Polygon.from_bbox(
             (*attr.astuple(self.sw), *attr.astuple(self.ne))
         )
+        poly.srid = 4326
+        return poly
 
 
 @attr.s(auto_attribs=True, frozen=True)
@@ -54,6 +65,18 @@ class ExternalImport:
     networks: str
 
 
+def import_authorized(view):
+    """Only staff or another instance holding the shared IMPORT_TOKEN may write networks. Network graphs are
+    deserialized on read, so they must come from a trusted source."""
+    @wraps(view)
+    def authorized(request, *args, **kwargs):
+        token = request.META.get('HTTP_X_IMPORT_TOKEN', '')
+        if not (request.user.is_staff or (settings.IMPORT_TOKEN and hmac.compare_digest(token, settings.IMPORT_TOKEN))):
+            return JsonResponse(status=403, data=dict(msg="Not authorized to import"))
+        return view(request, *args, **kwargs)
+    return authorized
+
+
 def import_ids(request, import_id):
     import_obj = Import.objects.prefetch_related('networks').filter(id=import_id).first()
     if import_obj is None:
@@ -62,6 +85,7 @@ def import_ids(request, import_id):
         return JsonResponse(data=dict(ids=[network.id for network in import_obj.networks.all()]))
 
 
+@import_authorized
 def external_import(request):
     data: ExternalImport = cattr.structure(json.loads(request.body), ExternalImport)
     import_record = deserialize('json', data.import_record)
@@ -71,9 +95,26 @@ def external_import(request):
         rec.save()
     for network in networks:
         network.save()
+        # Resent networks are saved over, their simplifications with them
+        NetworkGeometry.objects.filter(network=network.object).delete()
+        NetworkGeometry.objects.bulk_create(NetworkGeometry.for_network(network.object))
     return JsonResponse(data=dict(status="ok"))
 
 
+@import_authorized
+def import_chunk(request, import_id: str) -> JsonResponse:
+    """Load one chunk of a network archive, see est.archive"""
+    data = request.body
+    expected = request.META.get('HTTP_X_CHUNK_SHA256')
+    if expected is not None and archive.checksum(data) != expected:
+        return JsonResponse(status=400, data=dict(msg="Chunk checksum mismatch"))
+    try:
+        created = archive.load_chunk(data, import_id)
+    except archive.ArchiveError as ex:
+        return JsonResponse(status=400, data=dict(msg=str(ex)))
+    return JsonResponse(data=dict(status="ok", created=created))
+
+
 COLORS = ["5bc0eb", "fde74c", "9bc53d", "c3423f", "404e4d"]
 
 
@@ -91,46 +132,52 @@ def circuit_dict(circuit):
         status=circuit.get_status_display(),
         error=circuit.error
     )
+    if circuit.status == InProgress:
+        ret['phase'] = circuit.get_phase_display()
+        ret['eta'] = naturaltime(circuit.eta) if circuit.eta else None
     if circuit.status == Complete:
         ret['total_length'] = humanize(circuit.total_length.mi)
         ret['download_url'] = reverse('gpx', kwargs=dict(circuit_id=circuit.id))
+        if circuit.elevation_gain is not None:
+            ret['elevation_gain'] = humanize(circuit.elevation_gain.ft)
+            ret['elevation_loss'] = humanize(circuit.elevation_loss.ft)
+            ret['profile_url'] = reverse('circuit-profile', kwargs=dict(circuit_id=circuit.id))
+            if circuit.elevation_coverage is not None and circuit.elevation_coverage < 1:
+                ret['elevation_coverage'] = round(circuit.elevation_coverage * 100)
     return ret
 
 
-LENGTH_CACHE = {}
-
-
 def get_network(request, network_id: str):
-    try:
-        network = TrailNetwork.objects.get(id=network_id)
-    except TrailNetwork.DoesNotExist:
-        return JsonResponse(status=404, data=dict(msg=f"Network {network_id} does not exist"))
-    existing_circuit = Circuit.objects.filter(network=network).first()
+    payload = get_network_payload(network_id)
+    if payload is None:
+        try:
+            network = TrailNetwork.objects.get(id=network_id)
+        except TrailNetwork.DoesNotExist:
+            return JsonResponse(status=404, data=dict(msg=f"Network {network_id} does not exist"))
+        payload = network_payload(network)
+        set_network_payload(network_id, payload)
+    return HttpResponse(payload, content_type=geojson.JSON_CONTENT_TYPE)
+
+
+def network_payload(network: TrailNetwork) -> str:
+    """The encoded network detail response"""
+    existing_circuit = current_circuit(network.id)
     circuit = None
     if existing_circuit:
         circuit = circuit_dict(existing_circuit)
-    if network_id in LENGTH_CACHE:
-        print('cache hit')
-        calculated = LENGTH_CACHE[network_id]
-    else:
-        graph = read_gpickle(BytesIO(network.graph.tobytes()))
-        calculated = sum([w.length() for _, _, w in graph.edges.data('trail')], Distance(m=0))
-        LENGTH_CACHE[network_id] = calculated
+    calculated = Distance(m=network.compact_graph().total_length_m())
+    trailheads = (
+        geojson.feature(geojson.point(trailhead.x, trailhead.y), id=i)
+        for i, trailhead in enumerate(network.trailheads)
+    )
 
-    return JsonResponse(data=dict(
-        id=network.id,
-        name=network.name,
-        milage=humanize(calculated.mi),
-        circuit=circuit,
-        trailheads=dict(
-            type='FeatureCollection',
-            features=[dict(
-                id=i,
-                type='Feature',
-                geometry=json.loads(trailhead.json)
-            ) for i, trailhead in enumerate(network.trailheads)]
-        ),
-    ))
+    return geojson.join_fields([
+        ('id', geojson.encode(network.id)),
+        ('name', geojson.encode(network.name)),
+        ('milage', geojson.encode(humanize(calculated.mi))),
+        ('circuit', geojson.encode(circuit)),
+        ('trailheads', ''.join(geojson.feature_collection(trailheads))),
+    ])
 
 
 MAX_AREAS = 1000000
@@ -159,37 +206,84 @@ def areas(request):
     except JSONDecodeError:
         return JsonResponse(status=400, data=dict(status=400, error="Invalid JSON"))
     bounds = data.to_poly()
-    networks = TrailNetwork.active().filter(poly__bboverlaps=bounds).order_by('-area')[:MAX_TO_RETURN].only('id',
-                                                                                                            'poly')
-    geojson = dict(
-        type='FeatureCollection',
-        features=[
-            dict(
-                id=network.id.int % MAX_AREAS,
-                type='Feature',
-                properties=dict(
-                    id=network.id,
-                    fill_color='#' + COLORS[network.id.int % len(COLORS)],
-                    bb=[network.poly.extent[0:2], network.poly.extent[2:4]],
-                ), geometry=json.loads(network.poly.json)
-            )
-            for network in networks
-        ]
+    level = simplification_level(data.zoom)
+    if data.zoom is None:
+        rows = TrailNetwork.active().filter(poly__bboverlaps=bounds).annotate(
+            geojson=AsGeoJSON('poly'), envelope=Envelope('poly')
+        ).order_by('-area').values_list('id', 'geojson', 'envelope')
+    elif level is None:
+        rows = TrailNetwork.active().filter(poly__intersects=bounds).annotate(
+            geojson=AsGeoJSON(Intersection('poly', bounds)), envelope=Envelope('poly')
+        ).order_by('-area').values_list('id', 'geojson', 'envelope')
+    else:
+        # Simplified polygons, clipped to the viewport, at a resolution that matches the zoom. Networks without
+        # simplified geometries fall back to their full polygon, like the tiles do.
+        rows = TrailNetwork.active().annotate(
+            simplified=FilteredRelation('geometries', condition=Q(geometries__level=level))
+        ).annotate(shape=Coalesce('simplified__poly', 'poly')).filter(shape__intersects=bounds).annotate(
+            geojson=AsGeoJSON(Intersection('shape', bounds)), envelope=Envelope('poly')
+        ).order_by('-area').values_list('id', 'geojson', 'envelope')
+    features = (
+        area_feature(network_id, geometry, envelope.extent)
+        for network_id, geometry, envelope in rows[:MAX_TO_RETURN].iterator()
+    )
+    return geojson.streaming_response(
+        geojson.wrap(geojson.feature_collection(features), '{"ok": true, "data": ', '}')
     )
 
-    return JsonResponse(dict(ok=True, data=geojson))
+
+def area_feature(network_id, geometry: str, extent) -> str:
+    return geojson.feature(geometry, id=network_id.int % MAX_AREAS, properties=dict(
+        id=network_id,
+        fill_color='#' + COLORS[network_id.int % len(COLORS)],
+        bb=[extent[0:2], extent[2:4]],
+    ))
+
+
+TILE_MAX_AGE_S = 60 * 60
+
+
+def tile(request, z: int, x: int, y: int) -> HttpResponse:
+    if not tiles.valid_tile(z, x, y):
+        return JsonResponse(status=404, data=dict(msg=f"No tile {z}/{x}/{y}"))
+    # The ETag only depends on the active imports, so a match never needs the tile itself
+    digest = tiles.active_import_digest()
+    etag = f'"{digest}"'
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        return HttpResponse(status=304)
+    data, _ = tiles.get_tile(z, x, y, COLORS, MAX_AREAS, digest)
+    response = HttpResponse(data, content_type="application/vnd.mapbox-vector-tile")
+    response["Cache-Control"] = f"public, max-age={TILE_MAX_AGE_S}"
+    response["ETag"] = etag
+    return response
 
 
 def circuit_json(request, circuit_id: str) -> HttpResponse:
-    circuit = Circuit.objects.get(id=circuit_id)
-    return JsonResponse(data=dict(json=json.loads(circuit.route.json)))
+    route = Circuit.objects.annotate(geojson=AsGeoJSON('route')).values_list('geojson', flat=True).get(id=circuit_id)
+    return HttpResponse(geojson.join_fields([('json', route or 'null')]), content_type=geojson.JSON_CONTENT_TYPE)
+
+
+PROFILE_SAMPLES = 200
+
+
+def elevation_profile(request, circuit_id: str) -> JsonResponse:
+    circuit = Circuit.objects.only('route', 'elevation_gain').get(id=circuit_id)
+    if circuit.route is None:
+        return JsonResponse(status=404, data=dict(msg=f"Circuit {circuit_id} has no route yet"))
+    if circuit.elevation_gain is None:
+        return JsonResponse(status=404, data=dict(msg=f"No elevation data for circuit {circuit_id}"))
+    distance, elevation = circuit.elevation_profile(PROFILE_SAMPLES)
+    return JsonResponse(dict(
+        distance_mi=[round(Distance(m=d).mi, 3) for d in distance],
+        elevation_ft=[round(Distance(m=e).ft) for e in elevation],
+    ))
 
 
 def gpx(request, circuit_id: str) -> HttpResponse:
-    circuit = Circuit.objects.get(id=circuit_id)
-    response = HttpResponse(circuit.to_gpx(), content_type="application/gpx")
-    response["Content-Disposition"] = f"attachment; filename={circuit.network.name}.gpx"
-    return response
+    name, gain = Circuit.objects.values_list('network__name', 'elevation_gain').get(id=circuit_id)
+    # Routes computed before elevations were looked up have z=0 everywhere, and no gain
+    points = gpx_document(route_points(circuit_id), name=name, elevations=gain is not None)
+    return gpx_response(points, filename=name)
 
 
 def compute_circuit(request, network_id: str) -> JsonResponse:
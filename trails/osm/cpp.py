@@ -0,0 +1,182 @@
+"""Chinese Postman solver that works on the trail network in memory.
+
+Same approach as `postman_problems.solver.cpp`: pair up the odd degree nodes with a minimum weight perfect
+matching, walk the shortest path between each pair a second time and take an Euler circuit. By default the
+matching is exact, over the shortest path distances between every pair of odd nodes, so circuits are as long
+as `postman_problems`' without building its intermediate graphs.
+
+The exact matching still grows with the cube of the number of odd nodes: on the largest test network (387 edges,
+208 odd nodes) it takes 21s against 43s for `postman_problems`, and a network with 1000 odd nodes would take
+most of an hour. Networks that large are out of scope for the default; they need `k_nearest`.
+
+`k_nearest` opts into a heuristic for large networks: each odd node's Dijkstra stops once it has settled its
+`k_nearest` closest odd nodes, and the matching runs on that sparse candidate graph, widened only until it has
+*a* perfect matching. That matching is not necessarily the minimum one, so circuits can come out longer.
+
+The circuit has the shape `postman_problems` returns, `(start, end, key, attributes)`, so
+`calculate_postman_solution_stats` and `est.postman.circuit_to_line_string` read it unchanged.
+"""
+import heapq
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import networkx as nx
+
+Edge = Tuple[str, str, Any, float]
+CircuitEdge = Tuple[str, str, int, Dict[str, Any]]
+
+# Fitted to the exact solve times of the test networks, see `expected_solve_s`
+SECONDS_PER_ODD_NODE_CUBED = 2.3e-6
+
+
+class EdgeList:
+    """Edges of a multigraph as parallel lists, with an adjacency list of (neighbour, edge index) per node"""
+
+    def __init__(self, edges: Iterable[Edge]):
+        self.names: List[str] = []
+        index: Dict[str, int] = {}
+        self.starts: List[int] = []
+        self.ends: List[int] = []
+        self.ids: List[Any] = []
+        self.distances: List[float] = []
+        for start, end, edge_id, distance in edges:
+            for name in (start, end):
+                if name not in index:
+                    index[name] = len(self.names)
+                    self.names.append(name)
+            self.starts.append(index[start])
+            self.ends.append(index[end])
+            self.ids.append(edge_id)
+            self.distances.append(float(distance))
+        self.adjacency: List[List[Tuple[int, int]]] = [[] for _ in self.names]
+        for e, (u, v) in enumerate(zip(self.starts, self.ends)):
+            self.adjacency[u].append((v, e))
+            self.adjacency[v].append((u, e))
+
+    def odd_nodes(self) -> List[int]:
+        return [n for n, adjacent in enumerate(self.adjacency) if len(adjacent) % 2 == 1]
+
+
+def nearest_targets(edges: EdgeList, source: int, targets: set, k: int) -> Tuple[Dict[int, float], Dict[int, int]]:
+    """Dijkstra from `source` until `k` of `targets` are settled. Returns their distances and the predecessor
+    edge of every settled node."""
+    dist = {source: 0.}
+    pred: Dict[int, int] = {}
+    found: Dict[int, float] = {}
+    settled = set()
+    heap = [(0., source)]
+    while heap and len(found) < k:
+        d, u = heapq.heappop(heap)
+        if u in settled:
+            continue
+        settled.add(u)
+        if u != source and u in targets:
+            found[u] = d
+        for v, e in edges.adjacency[u]:
+            nd = d + edges.distances[e]
+            if v not in settled and nd < dist.get(v, float('inf')):
+                dist[v] = nd
+                pred[v] = e
+                heapq.heappush(heap, (nd, v))
+    return found, {node: pred[node] for node in settled if node in pred}
+
+
+def path_edges(edges: EdgeList, pred: Dict[int, int], source: int, target: int) -> List[int]:
+    path = []
+    node = target
+    while node != source:
+        e = pred[node]
+        path.append(e)
+        node = edges.starts[e] if edges.ends[e] == node else edges.ends[e]
+    return path
+
+
+def _matched_pairs(matching) -> List[Tuple[int, int]]:
+    # networkx returns a mate dict before 2.1 and a set of pairs after
+    pairs = matching.items() if isinstance(matching, dict) else matching
+    return sorted({tuple(sorted(pair)) for pair in pairs})
+
+
+def min_weight_matching(edges: EdgeList, odd: List[int], k_nearest: Optional[int] = None
+                        ) -> Tuple[List[Tuple[int, int]], Dict[int, Dict[int, int]]]:
+    """Perfect matching of `odd` over shortest path distances, and the predecessor edges needed to walk each
+    matched pair. Minimum weight unless `k_nearest` restricts the candidates (see the module docstring)."""
+    targets = set(odd)
+    k = len(odd) - 1 if k_nearest is None else min(k_nearest, len(odd) - 1)
+    while True:
+        candidates = nx.Graph()
+        candidates.add_nodes_from(odd)
+        preds = {}
+        for source in odd:
+            found, preds[source] = nearest_targets(edges, source, targets, k)
+            for target, d in found.items():
+                candidates.add_edge(source, target, weight=-d)
+        matching = _matched_pairs(nx.max_weight_matching(candidates, maxcardinality=True))
+        if 2 * len(matching) == len(odd) or k >= len(odd) - 1:
+            return matching, preds
+        k = min(2 * k, len(odd) - 1)
+
+
+def euler_circuit(num_nodes: int, starts: List[int], ends: List[int], start: int) -> List[Tuple[int, int, int]]:
+    """Hierholzer's algorithm over an edge list in which every node has even degree. Returns (from, to, edge)."""
+    adjacency: List[List[Tuple[int, int]]] = [[] for _ in range(num_nodes)]
+    for e, (u, v) in enumerate(zip(starts, ends)):
+        adjacency[u].append((v, e))
+        adjacency[v].append((u, e))
+    used = [False] * len(starts)
+    cursor = [0] * num_nodes
+    stack: List[Tuple[int, Optional[Tuple[int, int, int]]]] = [(start, None)]
+    circuit = []
+    while stack:
+        u, via = stack[-1]
+        adjacent = adjacency[u]
+        while cursor[u] < len(adjacent) and used[adjacent[cursor[u]][1]]:
+            cursor[u] += 1
+        if cursor[u] == len(adjacent):
+            stack.pop()
+            if via is not None:
+                circuit.append(via)
+        else:
+            v, e = adjacent[cursor[u]]
+            used[e] = True
+            stack.append((v, (u, v, e)))
+    circuit.reverse()
+    return circuit
+
+
+def expected_solve_s(edges: Iterable[Edge]) -> float:
+    """Rough time `cpp` takes with the exact matching"""
+    return SECONDS_PER_ODD_NODE_CUBED * len(EdgeList(edges).odd_nodes()) ** 3
+
+
+def cpp(edges: Iterable[Edge], start_node: Optional[str] = None,
+        k_nearest: Optional[int] = None) -> List[CircuitEdge]:
+    """Shortest closed walk covering every edge of a connected multigraph.
+
+    `edges` are `(start, end, id, distance)`. Edges walked a second time to fix up odd nodes are marked
+    `augmented`, like in `postman_problems`. With `k_nearest` the walk is only approximately shortest.
+    """
+    graph = EdgeList(edges)
+    if not graph.ids:
+        return []
+    starts, ends = list(graph.starts), list(graph.ends)
+    # Every walk edge is a copy of an original edge
+    originals = list(range(len(graph.ids)))
+    odd = graph.odd_nodes()
+    if odd:
+        matching, preds = min_weight_matching(graph, odd, k_nearest)
+        for a, b in matching:
+            source, target = (a, b) if b in preds[a] else (b, a)
+            for e in path_edges(graph, preds[source], source, target):
+                starts.append(graph.starts[e])
+                ends.append(graph.ends[e])
+                originals.append(e)
+
+    start = graph.starts[0] if start_node is None else graph.names.index(start_node)
+    circuit = []
+    for u, v, copy in euler_circuit(len(graph.names), starts, ends, start):
+        e = originals[copy]
+        attributes = dict(distance=graph.distances[e], id=graph.ids[e])
+        if copy >= len(graph.ids):
+            attributes['augmented'] = True
+        circuit.append((graph.names[u], graph.names[v], copy, attributes))
+    return circuit
@@ -0,0 +1,85 @@
+"""Content addresses for OSM extracts and trail networks.
+
+Extracts are identified by their SHA-256, hashed in process on a background thread so it overlaps with parsing
+(hashlib releases the GIL on large updates). Networks are identified by their nodes: a BLAKE2b of the sorted osm
+ids, plus the derived ids of the few road crossings that were rewritten.
+
+Before that, network digests were the SHA-256 of every node's `str()`, sorted and joined, and extract digests were
+stored as the `repr` of the `sha256sum` output. Both are still recognised so existing imports can be resumed.
+"""
+import hashlib
+import threading
+from functools import partial
+from typing import Collection, List, Optional, Set
+
+import numpy as np
+
+from osm.model import Node
+
+CHUNK_BYTES = 4 * 1024 * 1024
+NETWORK_DIGEST_BYTES = 16
+
+
+class FileDigest:
+    """SHA-256 of a file, computed on a background thread from the moment it's created"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._hash = hashlib.sha256()
+        self._error: Optional[Exception] = None
+        self._thread = threading.Thread(target=self._run, name='file-digest', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            with open(self.path, 'rb') as f:
+                for chunk in iter(partial(f.read, CHUNK_BYTES), b''):
+                    self._hash.update(chunk)
+        except Exception as ex:
+            self._error = ex
+
+    def hexdigest(self) -> str:
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self._hash.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    return FileDigest(path).hexdigest()
+
+
+def stored_file_digests(digest: str) -> List[str]:
+    """Every form `digest` may have been stored in as an `Import.sha256_sum`"""
+    return [digest, str(digest.encode('ascii'))]
+
+
+def network_digest(component: Collection[Node]) -> str:
+    ids = np.fromiter((n.osm_id for n in component), dtype=np.int64, count=len(component))
+    ids.sort()
+    h = hashlib.blake2b(ids.tobytes(), digest_size=NETWORK_DIGEST_BYTES)
+    derived = sorted(n.derived_id for n in component if n.derived_id != str(n.osm_id))
+    if derived:
+        h.update('\0'.join(derived).encode('utf-8'))
+    return h.hexdigest()
+
+
+def legacy_network_digest(component: Collection[Node]) -> str:
+    return hashlib.sha256(''.join(sorted(str(n) for n in component)).encode('utf-8')).hexdigest()
+
+
+def is_legacy(digest: str) -> bool:
+    return len(digest) == 2 * hashlib.sha256().digest_size
+
+
+class ProcessedNetworks:
+    """The networks an import already has, whichever format their digests were stored in. The legacy digest is
+    only computed if some stored digest needs it."""
+
+    def __init__(self, digests: Set[str]):
+        self.digests = digests
+        self.has_legacy = any(is_legacy(digest) for digest in digests)
+
+    def __contains__(self, item) -> bool:
+        digest, component = item
+        return digest in self.digests or (self.has_legacy and legacy_network_digest(component) in self.digests)
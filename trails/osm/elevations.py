@@ -1,10 +1,24 @@
+"""Elevations from the CGIAR SRTMv4 GeoTIFFs in `SRTMV4_BASE_DIR`.
+
+Each 5x5 degree tile is opened once and kept in an LRU bounded by `SRTM_TILE_CACHE_MB`. Uncompressed, stripped
+tiles (the CGIAR distribution) are memory-mapped straight from the file; anything else is decoded by rasterio.
+Points are sampled in bulk with bilinear interpolation between pixel centers.
+"""
 import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, List, NamedTuple, Optional, Tuple
 
+import numpy as np
 import rasterio
 
-from trails.settings import SRTMV4_BASE_DIR
+from osm.util import great_circle_m
+from trails.settings import SRTMV4_BASE_DIR, SRTM_TILE_CACHE_MB
 
 BASE = SRTMV4_BASE_DIR
+NODATA = -32768
 
 
 def srtm1_tile_ilonlat(lon, lat):
@@ -16,11 +30,209 @@ def srtm3_tile_ilonlat(lon, lat):
     return (ilon + 180) // 5 + 1, (64 - ilat) // 5
 
 
+def tile_name(index_lon: int, index_lat: int) -> str:
+    return f"srtm_{index_lon:02d}_{index_lat:02d}.tif"
+
+
+class Tile:
+    """A single band raster and the affine transform (x0, dx, y0, dy) of its pixel corners"""
+
+    def __init__(self, data: np.ndarray, transform: Tuple[float, float, float, float], nodata: Optional[float]):
+        self.data = data
+        self.transform = transform
+        self.nodata = nodata
+
+    @property
+    def nbytes(self) -> int:
+        return self.data.nbytes
+
+    @classmethod
+    def open(cls, path: str) -> 'Tile':
+        with rasterio.open(path) as ds:
+            t = ds.transform
+            data = _memmap(ds, path)
+            if data is None:
+                data = ds.read(1)
+            return cls(data, (t.c, t.a, t.f, t.e), ds.nodata)
+
+    def sample(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Bilinear interpolation between the four surrounding pixel centers. NaN where any of them is nodata."""
+        x0, dx, y0, dy = self.transform
+        height, width = self.data.shape
+        col = np.clip((lons - x0) / dx - 0.5, 0, width - 1)
+        row = np.clip((lats - y0) / dy - 0.5, 0, height - 1)
+        c0 = np.minimum(col.astype(np.intp), max(width - 2, 0))
+        r0 = np.minimum(row.astype(np.intp), max(height - 2, 0))
+        c1 = np.minimum(c0 + 1, width - 1)
+        r1 = np.minimum(r0 + 1, height - 1)
+        fx = col - c0
+        fy = row - r0
+
+        corners = [self.data[r, c].astype(np.float64) for r, c in ((r0, c0), (r0, c1), (r1, c0), (r1, c1))]
+        if self.nodata is not None:
+            for corner in corners:
+                corner[corner == self.nodata] = np.nan
+        top = corners[0] * (1 - fx) + corners[1] * fx
+        bottom = corners[2] * (1 - fx) + corners[3] * fx
+        return top * (1 - fy) + bottom * fy
+
+
+def _memmap(ds, path: str) -> Optional[np.ndarray]:
+    """The band as a read-only memory map if it's stored uncompressed in contiguous strips, else None"""
+    if ds.count != 1 or ds.compression is not None:
+        return None
+    block_height, block_width = ds.block_shapes[0]
+    if block_width != ds.width:
+        return None
+    blocks = -(-ds.height // block_height)
+    offsets = [ds.get_tag_item(f'BLOCK_OFFSET_0_{i}', 'TIFF', bidx=1) for i in (0, blocks - 1)]
+    if None in offsets:
+        return None
+    dtype = np.dtype(ds.dtypes[0])
+    first, last = (int(offset) for offset in offsets)
+    if last != first + (blocks - 1) * block_height * ds.width * dtype.itemsize:
+        return None
+    with open(path, 'rb') as f:
+        byte_order = f.read(2)
+    dtype = dtype.newbyteorder('<' if byte_order == b'II' else '>')
+    return np.memmap(path, dtype=dtype, mode='r', offset=first, shape=(ds.height, ds.width))
+
+
+class TileCache:
+    """LRU of open tiles, evicting the least recently used once their data exceeds `max_bytes`. Tiles that
+    aren't on disk are looked for again after `missing_ttl_s`, so downloading one doesn't need a restart."""
+
+    def __init__(self, base_dir: str, max_bytes: int, missing_ttl_s: float = 60):
+        self.base_dir = base_dir
+        self.max_bytes = max_bytes
+        self.missing_ttl_s = missing_ttl_s
+        self._tiles: Dict[str, Tile] = OrderedDict()
+        # Name -> when it was found missing
+        self._missing: Dict[str, float] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> Optional[Tile]:
+        with self._lock:
+            if name in self._tiles:
+                self._tiles.move_to_end(name)
+                return self._tiles[name]
+            if time.monotonic() - self._missing.get(name, -math.inf) < self.missing_ttl_s:
+                return None
+        path = os.path.join(self.base_dir, name)
+        if not os.path.exists(path):
+            with self._lock:
+                self._missing[name] = time.monotonic()
+            return None
+        tile = Tile.open(path)
+        with self._lock:
+            if name not in self._tiles:
+                self._tiles[name] = tile
+                self._bytes += tile.nbytes
+                while self._bytes > self.max_bytes and len(self._tiles) > 1:
+                    _, evicted = self._tiles.popitem(last=False)
+                    self._bytes -= evicted.nbytes
+            return self._tiles[name]
+
+    def elevations(self, lats, lons) -> np.ndarray:
+        """Elevation in meters of each point, NaN where it's unknown (no tile, or nodata)"""
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        result = np.full(lats.shape, np.nan)
+        for name, in_tile in tile_groups(lats, lons):
+            tile = self.get(name)
+            if tile is not None:
+                result[in_tile] = tile.sample(lats[in_tile], lons[in_tile])
+        return result
+
+    def missing_tiles(self, lats, lons) -> List[str]:
+        return [name for name, _ in tile_groups(lats, lons) if self.get(name) is None]
+
+
+def tile_groups(lats: np.ndarray, lons: np.ndarray):
+    """(tile name, mask of the points in it) for every tile the points fall in"""
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    if not lats.size:
+        return
+    index_lon = (np.floor(lons).astype(np.intp) + 180) // 5 + 1
+    index_lat = (64 - np.floor(lats).astype(np.intp)) // 5
+    keys = index_lon * 1000 + index_lat
+    for key in np.unique(keys):
+        yield tile_name(key // 1000, key % 1000), keys == key
+
+
+_tiles = TileCache(BASE, SRTM_TILE_CACHE_MB * 1024 * 1024)
+
+
+def get_elevations(lats, lons) -> np.ndarray:
+    return _tiles.elevations(lats, lons)
+
+
 def get_elevation(lat, lon):
-    index_lon, index_lat = srtm3_tile_ilonlat(lon, lat)
-    tile_file = f"srtm_{index_lon:02d}_{index_lat:02d}.tif"
-    coords = ((lon, lat), (lon, lat))
-    elev = next(rasterio.open(tile_file).sample(coords))[0]
-    if elev == -32768:
+    elev = get_elevations([lat], [lon])[0]
+    if np.isnan(elev):
         raise Exception("Elevation undefined at point")
     return elev
+
+
+class Elevations(NamedTuple):
+    """Elevations of a path, gaps filled and smoothed, with the points that had no DEM coverage"""
+    elevations: np.ndarray
+    missing: np.ndarray
+    missing_tiles: List[str]
+
+    @property
+    def coverage(self) -> float:
+        return 1 - self.missing.mean() if len(self.missing) else 1.
+
+
+def elevate(lats, lons, smooth: bool = True) -> Elevations:
+    """Elevations of the points of a path, looked up tile by tile in one pass"""
+    raw = _tiles.elevations(lats, lons)
+    missing = np.isnan(raw)
+    filled = fill_gaps(raw)
+    missing_tiles = _tiles.missing_tiles(lats, lons) if missing.any() else []
+    return Elevations(smooth_vertical(filled) if smooth else filled, missing, missing_tiles)
+
+
+def smooth_vertical(elevations: np.ndarray) -> np.ndarray:
+    """One pass of `gpxpy`'s vertical smoothing: each inner point becomes .4 prev + .2 itself + .4 next"""
+    elevations = np.asarray(elevations, dtype=np.float64)
+    if len(elevations) <= 3:
+        return elevations
+    smoothed = elevations.copy()
+    smoothed[1:-1] = elevations[:-2] * .4 + elevations[1:-1] * .2 + elevations[2:] * .4
+    return smoothed
+
+
+def fill_gaps(elevations: np.ndarray) -> np.ndarray:
+    """Linear interpolation over the NaNs of a run of elevations (zeros if none are known)"""
+    elevations = np.asarray(elevations, dtype=np.float64)
+    known = ~np.isnan(elevations)
+    if known.all():
+        return elevations
+    if not known.any():
+        return np.zeros_like(elevations)
+    indices = np.arange(len(elevations))
+    return np.interp(indices, indices[known], elevations[known])
+
+
+def uphill_downhill(elevations: np.ndarray) -> Tuple[float, float]:
+    """Total climb and descent, smoothed like `gpxpy.geo.calculate_uphill_downhill`"""
+    elevations = np.asarray(elevations, dtype=np.float64)
+    if len(elevations) < 2:
+        return 0., 0.
+    smoothed = elevations.copy()
+    smoothed[1:-1] = elevations[:-2] * .3 + elevations[1:-1] * .4 + elevations[2:] * .3
+    deltas = np.diff(smoothed)
+    return float(deltas[deltas > 0].sum()), float(-deltas[deltas < 0].sum())
+
+
+def profile(lats, lons, elevations, samples: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Distance along the path in meters and elevation at `samples` evenly spaced points"""
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    if not len(lats):
+        return np.empty(0), np.empty(0)
+    distance = np.concatenate(([0.], np.cumsum(great_circle_m(lats[:-1], lons[:-1], lats[1:], lons[1:]))))
+    at = np.linspace(0, distance[-1], samples)
+    return at, np.interp(at, distance, elevations)
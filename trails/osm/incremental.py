@@ -0,0 +1,226 @@
+"""Incremental ingest from OSM change files.
+
+A full ingest reads a whole state extract, but only highways, parking lots and parks matter to it. After an
+import, those objects and the nodes they reference are written to a much smaller *ingest extract*, alongside an
+`IngestState` fingerprinting every park and trail network. A change file (.osc) is later merged into that
+extract and the merged extract is ingested as usual. Networks built from the same nodes, trails and road
+crossings as before, and near no changed park, are carried over from the previous import instead of rebuilt.
+
+New ways that reference nodes outside the previous extract (for instance, an existing building corner) can't
+be resolved from the extract and are dropped like any incomplete way.
+"""
+import hashlib
+import json
+import os
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, NamedTuple, Set, Tuple
+
+import networkx as nx
+import numpy as np
+import osmium as o
+
+from osm.digests import network_digest
+from osm.loader import OSMIngestor, Park, drivable, is_park
+
+Extent = Tuple[float, float, float, float]
+
+
+class _References(o.SimpleHandler):
+    """Ways and relations the ingest reads, and the nodes they reference"""
+
+    def __init__(self):
+        super(_References, self).__init__()
+        self.ways: Set[int] = set()
+        self.relations: Set[int] = set()
+        self.member_ways: Set[int] = set()
+        self.refs = array('q')
+
+    def way(self, w):
+        if "highway" in w.tags or drivable(w) or (w.is_closed() and is_park(w.tags)):
+            self.ways.add(w.id)
+            self.refs.extend(n.ref for n in w.nodes)
+
+    def relation(self, r):
+        if r.tags.get('type') in ('multipolygon', 'boundary') and is_park(r.tags):
+            self.relations.add(r.id)
+            self.member_ways.update(m.ref for m in r.members if m.type == 'w')
+
+
+class _MemberWays(o.SimpleHandler):
+    """Untagged outer ways of park relations; relations come after ways, so they need a second pass"""
+
+    def __init__(self, references: _References):
+        super(_MemberWays, self).__init__()
+        self.references = references
+        self.missing = references.member_ways - references.ways
+
+    def way(self, w):
+        if w.id in self.missing:
+            self.references.ways.add(w.id)
+            self.references.refs.extend(n.ref for n in w.nodes)
+
+
+class _ExtractWriter(o.SimpleHandler):
+    def __init__(self, references: _References, writer):
+        super(_ExtractWriter, self).__init__()
+        self.references = references
+        self.writer = writer
+        self._node_ids = array('q', np.unique(np.frombuffer(references.refs, dtype=np.int64)).tobytes())
+        self._cursor = 0
+
+    def node(self, n):
+        ids = self._node_ids
+        i = self._cursor
+        # Same cursor walk as `loader.LocationResolver`: extracts are sorted by id
+        if i > 0 and ids[i - 1] >= n.id:
+            i = bisect_left(ids, n.id)
+        while i < len(ids) and ids[i] < n.id:
+            i += 1
+        self._cursor = i
+        if i < len(ids) and ids[i] == n.id:
+            self.writer.add_node(n)
+            self._cursor = i + 1
+
+    def way(self, w):
+        if w.id in self.references.ways:
+            self.writer.add_way(w)
+
+    def relation(self, r):
+        if r.id in self.references.relations:
+            self.writer.add_relation(r)
+
+
+def _new_file(path: str):
+    # osmium refuses to overwrite files
+    if os.path.exists(path):
+        os.remove(path)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+
+def write_ingest_extract(source: str, target: str):
+    """Copy the highways, parks and their nodes from `source` to `target`"""
+    references = _References()
+    references.apply_file(source)
+    members = _MemberWays(references)
+    if members.missing:
+        members.apply_file(source)
+    _new_file(target)
+    writer = o.SimpleWriter(target)
+    try:
+        _ExtractWriter(references, writer).apply_file(source)
+    finally:
+        writer.close()
+
+
+def apply_changes(extract: str, change_file: str, target: str):
+    """Merge an .osc into an ingest extract, writing the new ingest extract to `target`"""
+    merged = f'{target}.merged.osm.pbf'
+    _new_file(merged)
+    changes = o.MergeInputReader()
+    changes.add_file(change_file)
+    reader, writer = o.io.Reader(extract), o.io.Writer(merged)
+    try:
+        changes.apply_to_reader(reader, writer)
+    finally:
+        writer.close()
+        reader.close()
+    # Changes bring in buildings, shops and the like; filter them back out
+    write_ingest_extract(merged, target)
+    os.remove(merged)
+
+
+class ParkFingerprint(NamedTuple):
+    digest: str
+    extent: Extent
+
+
+class NetworkFingerprint(NamedTuple):
+    """What a network is built from beyond its node digest: its trails and the roads that cross them"""
+    digest: str
+    extent: Extent
+
+
+class IngestState(NamedTuple):
+    parks: Dict[str, ParkFingerprint]
+    # By network (node) digest
+    networks: Dict[str, NetworkFingerprint]
+
+    def save(self, path: str):
+        with open(path, 'w') as f:
+            json.dump(dict(parks=self.parks, networks=self.networks), f)
+
+    @classmethod
+    def load(cls, path: str) -> 'IngestState':
+        with open(path) as f:
+            state = json.load(f)
+        return cls(
+            parks={k: ParkFingerprint(digest, tuple(extent)) for k, (digest, extent) in state['parks'].items()},
+            networks={k: NetworkFingerprint(digest, tuple(extent)) for k, (digest, extent) in
+                      state['networks'].items()},
+        )
+
+
+def park_fingerprints(parks: Dict[int, Park]) -> Dict[str, ParkFingerprint]:
+    fingerprints = {}
+    for area_id, park in parks.items():
+        digest = hashlib.sha1(bytes(park.border.ewkb) + (park.name or '').encode('utf-8')).hexdigest()
+        fingerprints[str(area_id)] = ParkFingerprint(digest, park.border.extent)
+    return fingerprints
+
+
+def network_fingerprint(graph: nx.MultiGraph, non_trail_nodes: Dict[int, str]) -> NetworkFingerprint:
+    h = hashlib.sha1()
+    for trail in sorted((trail for _, _, trail in graph.edges(data='trail')), key=lambda t: str(t.id)):
+        h.update(f'{trail.id}\0{trail.name}\0'.encode('utf-8'))
+        h.update(trail.node_ids.tobytes())
+        h.update(trail.coords().tobytes())
+    crossings = sorted((n.osm_id, non_trail_nodes[n.osm_id]) for n in graph if n.osm_id in non_trail_nodes)
+    h.update(repr(crossings).encode('utf-8'))
+    lats = [n.lat for n in graph]
+    lons = [n.lon for n in graph]
+    return NetworkFingerprint(h.hexdigest(), (min(lons), min(lats), max(lons), max(lats)))
+
+
+def ingest_state(loader: OSMIngestor) -> IngestState:
+    """Fingerprints of the parks and trail networks of a loaded extract"""
+    graph = loader.global_graph
+    networks = {}
+    for c in nx.connected_components(graph):
+        if len(c) < 3:
+            continue
+        networks[network_digest(c)] = network_fingerprint(graph.subgraph(c), loader.non_trail_nodes)
+    return IngestState(park_fingerprints(loader.parks), networks)
+
+
+def changed_park_extents(old: Dict[str, ParkFingerprint], new: Dict[str, ParkFingerprint]) -> List[Extent]:
+    """Extents of the parks that were added, removed or changed, before and after the change"""
+    extents = []
+    for area_id in old.keys() | new.keys():
+        before, after = old.get(area_id), new.get(area_id)
+        if before is not None and after is not None and before.digest == after.digest:
+            continue
+        extents += [park.extent for park in (before, after) if park is not None]
+    return extents
+
+
+def touches(extents: Iterable[Extent], extent: Extent) -> bool:
+    xmin, ymin, xmax, ymax = extent
+    return any(xmin <= e_xmax and e_xmin <= xmax and ymin <= e_ymax and e_ymin <= ymax
+               for e_xmin, e_ymin, e_xmax, e_ymax in extents)
+
+
+def unchanged_networks(previous: IngestState, current: IngestState) -> Set[str]:
+    """Digests of the networks that are built exactly as before: same nodes, trails and road crossings, and no
+    park that could name them has changed"""
+    changed_parks = changed_park_extents(previous.parks, current.parks)
+    return {
+        digest for digest, network in current.networks.items()
+        if digest in previous.networks and previous.networks[digest].digest == network.digest
+        and not touches(changed_parks, network.extent)
+    }
+
+
+def state_paths(directory: str, key) -> Tuple[str, str]:
+    """Where the ingest extract and ingest state of an import are kept"""
+    return os.path.join(directory, f'{key}.osm.pbf'), os.path.join(directory, f'{key}.state.json')
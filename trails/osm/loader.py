@@ -1,17 +1,24 @@
 import hashlib
-import itertools
+import random
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from collections import defaultdict
 from multiprocessing.pool import Pool
 from pathlib import Path
-from typing import List, Dict, NamedTuple, Iterator, Optional, Set, Tuple
+from typing import List, Dict, NamedTuple, Iterator, Optional, Set, Tuple, Iterable
 
 import geopy.distance
 import networkx as nx
+import numpy as np
 import osmium as o
 from django.contrib.gis.geos import Polygon, MultiPolygon, Point, MultiPoint, GEOSException
 from measurement.measures import Distance
 
 from osm import util
-from osm.model import Trail, InverseGraph, TrailNetwork, Subpath, Trailhead, Node, NodeId
+from osm.digests import ProcessedNetworks, network_digest
+from osm.model import Trail, TrailNetwork, Subpath, Trailhead, Node, NodeId, OUT_AND_BACK_QUALITY, SPUR_PENALTY
 
 TRAIL = {"path", "footway", "track", "trail", "pedestrian", "steps"}
 INACCESSIBLE = {"service"}
@@ -94,21 +101,268 @@ class Park(NamedTuple):
         return 'Unnamed park'
 
 
+def is_park(tags):
+    return tags.get('leisure') in PARKS or tags.get("boundary") in PARKISH_BOUNDARIES
+
+
 def tags_to_dict(tags):
     return {t.k: t.v for t in tags}
 
 
-class OsmiumTrailLoader(o.SimpleHandler):
-    def __init__(self, location_filter: Optional[LocationFilter] = None):
-        super(OsmiumTrailLoader, self).__init__()
+class TrailWay(NamedTuple):
+    way_id: int
+    name: Optional[str]
+    refs: array
+
+
+class ParkOutline(NamedTuple):
+    tags: Dict[str, str]
+    # Node ref sequences of the outer ways, stitched into rings once locations are known
+    ways: List[array]
+    # Number of member ways; like osmium, relations missing any member are not assembled
+    num_members: int = 1
+
+
+class ParseCancelled(Exception):
+    """Raised out of a pass over an OSM file once its `cancel` event is set"""
+
+
+class CancellableHandler(o.SimpleHandler):
+    """A handler whose pass over the file stops at the next callback once `cancel` is set"""
+
+    def __init__(self, cancel: Optional[threading.Event] = None):
+        super(CancellableHandler, self).__init__()
+        self.cancel = cancel or threading.Event()
+
+    def check_cancelled(self):
+        if self.cancel.is_set():
+            raise ParseCancelled()
+
+
+class ReferenceCollector(CancellableHandler):
+    """First pass of the two-pass ingest: records which node ids trails and parks reference.
+
+    Only ways and relations are read; no node locations are needed or stored."""
+
+    def __init__(self, cancel: Optional[threading.Event] = None):
+        super(ReferenceCollector, self).__init__(cancel)
+        self.trails: List[TrailWay] = []
+        self.parks: Dict[int, ParkOutline] = {}
+        self.member_ways: Dict[int, List[Tuple[int, bool]]] = defaultdict(list)
+        self.members_found: Dict[int, int] = defaultdict(int)
+
+    def way(self, w):
+        self.check_cancelled()
+        if "highway" in w.tags and is_trail(w):
+            name = w.tags.get("name") or None
+            self.trails.append(TrailWay(w.id, name, array('q', (n.ref for n in w.nodes))))
+        if w.is_closed() and is_park(w.tags):
+            # Mirror osmium's area ids: ways are 2 * id, relations 2 * id + 1
+            self.parks[w.id * 2] = ParkOutline(tags_to_dict(w.tags), [array('q', (n.ref for n in w.nodes))])
+
+    def relation(self, r):
+        self.check_cancelled()
+        if r.tags.get('type') in ('multipolygon', 'boundary') and is_park(r.tags):
+            area_id = r.id * 2 + 1
+            way_members = [m for m in r.members if m.type == 'w']
+            self.parks[area_id] = ParkOutline(tags_to_dict(r.tags), [], len(way_members))
+            for member in way_members:
+                self.member_ways[member.ref].append((area_id, member.role in ('outer', '')))
+
+
+ROAD_REF_BATCH = 1 << 20
+
+
+class RoadNodeCollector(CancellableHandler):
+    """Second reference pass: keeps only the drivable nodes that are also trail nodes.
+
+    Drivable refs are buffered and intersected with the (sorted) trail node ids in batches so that
+    the full set of road nodes in the extract is never held at once."""
+
+    def __init__(self, trail_node_ids: np.ndarray, references: ReferenceCollector,
+                 cancel: Optional[threading.Event] = None):
+        super(RoadNodeCollector, self).__init__(cancel)
+        self.trail_node_ids = trail_node_ids
+        self.references = references
+        self.non_trail_nodes: Dict[int, str] = {}
+        self._refs = array('q')
+        self._names: List[str] = []
+        self._name_idx = array('l')
+
+    def way(self, w):
+        self.check_cancelled()
+        if w.id in self.references.member_ways:
+            refs = array('q', (n.ref for n in w.nodes))
+            for area_id, outer in self.references.member_ways[w.id]:
+                self.references.members_found[area_id] += 1
+                if outer:
+                    self.references.parks[area_id].ways.append(refs)
+        if drivable(w):
+            self._names.append(w.tags.get("name", "No name"))
+            for n in w.nodes:
+                self._refs.append(n.ref)
+                self._name_idx.append(len(self._names) - 1)
+            if len(self._refs) > ROAD_REF_BATCH:
+                self.flush()
+
+    def flush(self):
+        if not self._refs:
+            return
+        refs = np.frombuffer(self._refs, dtype=np.int64)
+        for i in np.flatnonzero(np.isin(refs, self.trail_node_ids)):
+            # Later ways win, exactly like dict.update in the single pass loader
+            self.non_trail_nodes[int(refs[i])] = self._names[self._name_idx[i]]
+        self._refs = array('q')
+        self._names = []
+        self._name_idx = array('l')
+
+
+class NodeLocations:
+    """Array-backed lat/lon storage for a sorted subset of node ids"""
+
+    def __init__(self, node_ids: np.ndarray):
+        self.ids = node_ids
+        self.lats = np.full(len(node_ids), np.nan)
+        self.lons = np.full(len(node_ids), np.nan)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, refs: array) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """Returns the (lats, lons) of `refs` or None if any of them is unknown"""
+        refs = np.frombuffer(refs, dtype=np.int64)
+        idx = np.searchsorted(self.ids, refs)
+        if len(self.ids) == 0 or np.any(idx >= len(self.ids)) or np.any(self.ids[idx] != refs):
+            return None
+        lats, lons = self.lats[idx], self.lons[idx]
+        if np.isnan(lats).any():
+            return None
+        return lats, lons
+
+
+class LocationResolver(CancellableHandler):
+    """Second pass of the two-pass ingest: reads node locations for the referenced ids only"""
+
+    def __init__(self, locations: NodeLocations, cancel: Optional[threading.Event] = None):
+        super(LocationResolver, self).__init__(cancel)
+        self.locations = locations
+        self._ids = array('q', locations.ids.tobytes())
+        self._cursor = 0
+
+    def node(self, n):
+        self.check_cancelled()
+        ids = self._ids
+        i = self._cursor
+        # Extracts are sorted by id so a cursor usually suffices; fall back to bisection otherwise
+        if i > 0 and ids[i - 1] >= n.id:
+            i = bisect_left(ids, n.id)
+        while i < len(ids) and ids[i] < n.id:
+            i += 1
+        self._cursor = i
+        if i < len(ids) and ids[i] == n.id:
+            self.locations.lats[i] = n.location.lat
+            self.locations.lons[i] = n.location.lon
+            self._cursor = i + 1
+
+
+def assemble_rings(ways: List[array]) -> List[List[int]]:
+    """Joins way ref sequences end to end into closed rings. Ways that never close are dropped."""
+    pending = [list(w) for w in ways if len(w) > 1]
+    rings = []
+    while pending:
+        ring = pending.pop(0)
+        while ring[0] != ring[-1]:
+            for i, candidate in enumerate(pending):
+                if candidate[0] == ring[-1]:
+                    ring += candidate[1:]
+                elif candidate[-1] == ring[-1]:
+                    ring += candidate[-2::-1]
+                else:
+                    continue
+                del pending[i]
+                break
+            else:
+                break
+        if ring[0] == ring[-1]:
+            rings.append(ring)
+    return rings
+
+
+class OsmiumTrailLoader(CancellableHandler):
+    def __init__(self, location_filter: Optional[LocationFilter] = None, cancel: Optional[threading.Event] = None):
+        super(OsmiumTrailLoader, self).__init__(cancel)
         self.trails: Dict[int, Trail] = {}
         self.non_trail_nodes: Dict[int, str] = {}
-        self.trail_nodes: Dict[int, Node] = {}
         self.location_filter = location_filter
         self.areas: Dict[int, Park] = {}
 
+    def find_trail_node(self, node_id: int) -> Optional[Node]:
+        for trail in self.trails.values():
+            idxs = np.flatnonzero(trail.node_ids == node_id)
+            if len(idxs):
+                return trail.node(int(idxs[0]))
+        return None
+
+    def stream_file(self, filename: str):
+        """Low memory alternative to `apply_file(filename, locations=True)`.
+
+        Reference passes read only ways and relations and record the node ids used by trails, parks
+        and drivable ways that touch trails. A single location pass then resolves that subset into a
+        `NodeLocations` store. No index over every node in the file is ever built, so peak memory
+        scales with trail density rather than with the size of the extract."""
+        references = ReferenceCollector(self.cancel)
+        references.apply_file(filename)
+        trail_node_ids = np.unique(np.concatenate(
+            [np.frombuffer(t.refs, dtype=np.int64) for t in references.trails] or [np.empty(0, np.int64)]
+        ))
+
+        roads = RoadNodeCollector(trail_node_ids, references, self.cancel)
+        roads.apply_file(filename)
+        roads.flush()
+        self.non_trail_nodes.update(roads.non_trail_nodes)
+
+        park_node_ids = [np.frombuffer(w, dtype=np.int64) for p in references.parks.values() for w in p.ways]
+        locations = NodeLocations(np.unique(np.concatenate([trail_node_ids] + park_node_ids)))
+        LocationResolver(locations, self.cancel).apply_file(filename)
+        print(f"Resolved {len(locations)} node locations")
+
+        for trail_way in references.trails:
+            resolved = locations.lookup(trail_way.refs)
+            if resolved is None:
+                print("WARNING: way %d incomplete. Ignoring." % trail_way.way_id)
+                continue
+            lats, lons = resolved
+            if self.location_filter:
+                dist_from_here = geopy.distance.great_circle(
+                    self.location_filter.tup(), (lats[0], lons[0])
+                ).km
+                if dist_from_here > self.location_filter.radius_km:
+                    continue
+            if trail_way.way_id in self.trails:
+                raise Exception('duplicate id!')
+            self.trails[trail_way.way_id] = Trail.from_arrays(
+                np.frombuffer(trail_way.refs, dtype=np.int64),
+                np.column_stack([lats, lons]),
+                way_id=str(trail_way.way_id),
+                name=trail_way.name
+            )
+
+        for area_id, outline in references.parks.items():
+            if area_id % 2 == 1 and references.members_found[area_id] < outline.num_members:
+                continue
+            polygons = []
+            for ring in assemble_rings(outline.ways):
+                resolved = locations.lookup(array('q', ring))
+                if resolved is None or len(ring) < 4:
+                    polygons = []
+                    break
+                polygons.append(Polygon([Point(lon, lat) for lat, lon in zip(*resolved)]))
+            if polygons:
+                self.areas[area_id] = Park(MultiPolygon(polygons), Park.name_from_tags(outline.tags), outline.tags)
+
     def area(self, area):
-        if area.tags.get('leisure') in PARKS or area.tags.get("boundary") in PARKISH_BOUNDARIES:
+        self.check_cancelled()
+        if is_park(area.tags):
             # print('name :', area.tags.get('name'))
             # print(area.num_rings())
             border = MultiPolygon([Polygon([Point(n.lon, n.lat) for n in ring]) for ring in area.outer_rings()])
@@ -117,6 +371,7 @@ class OsmiumTrailLoader(o.SimpleHandler):
                 self.areas[area.id] = Park(border, Park.name_from_tags(tag_map), tag_map)
 
     def way(self, w):
+        self.check_cancelled()
         if drivable(w):
             node_ids: Dict[int, str] = {n.ref: w.tags.get("name", "No name") for n in w.nodes}
             self.non_trail_nodes.update(node_ids)
@@ -134,8 +389,6 @@ class OsmiumTrailLoader(o.SimpleHandler):
                     if w.id in self.trails:
                         raise Exception('duplicate id!')
                     self.trails[w.id] = Trail.from_way(w)
-                    for n in self.trails[w.id].nodes:
-                        self.trail_nodes[n.id] = n
                 except o.InvalidLocationError:
                     # A location error might occur if the osm file is an extract
                     # where nodes of ways near the boundary are missing.
@@ -186,8 +439,36 @@ def worth_keeping(loop: Subpath):
         return loop.quality() > MIN_QUALITY and loop.num_spurs() < 1
 
 
+def diversity(loops: List[Subpath], sample_size: Optional[int] = None) -> float:
+    """Mean of `1 - a.similarity(b)` over all pairs of loops.
+
+    Loops become rows of a loop-by-segment distance matrix so each pairwise L1 distance is one row
+    operation. With more than `sample_size` loops, the mean is estimated from a fixed random subset of them.
+    """
+    if len(loops) < 2:
+        return 1
+    if sample_size is not None and len(loops) > max(sample_size, 2):
+        loops = random.Random(len(loops)).sample(loops, max(sample_size, 2))
+    columns: Dict[str, int] = {}
+    entries = [
+        (row, columns.setdefault(segment_id, len(columns)), dist)
+        for row, loop in enumerate(loops)
+        for segment_id, dist in loop.segment_dist.items()
+    ]
+    rows, cols, dists = zip(*entries)
+    matrix = np.zeros((len(loops), len(columns)))
+    np.add.at(matrix, (np.array(rows), np.array(cols)), np.array(dists, dtype=np.float64))
+    lengths = np.array([loop.length_m for loop in loops], dtype=np.float64)
+
+    total = 0.
+    for i in range(len(loops) - 1):
+        unique_distance = np.abs(matrix[i + 1:] - matrix[i]).sum(axis=1)
+        total += (unique_distance / (lengths[i + 1:] + lengths[i])).sum()
+    return total / (len(loops) * (len(loops) - 1) / 2)
+
+
 def meta(
-        trail_network: TrailNetwork, loops: List[Subpath], time: float
+        trail_network: TrailNetwork, loops: List[Subpath], time: float, sample_size: Optional[int] = None
 ) -> TrailheadMeta:
     num_loops = len(loops)
     if num_loops == 0:
@@ -197,12 +478,7 @@ def meta(
         shortest_loop = 0.
     else:
         loop_quality = sum([loop.quality() for loop in loops]) / num_loops
-        pairs = list(itertools.combinations(loops, 2))
-        loop_diversity = (
-            1
-            if not pairs
-            else sum([1 - a.similarity(b) for (a, b) in pairs]) / len(pairs)
-        )
+        loop_diversity = diversity(loops, sample_size)
         longest_loop = max([loop.length_m for loop in loops])
         shortest_loop = min([loop.length_m for loop in loops])
     network_length = trail_network.total_length()
@@ -231,6 +507,8 @@ class IngestSettings(NamedTuple):
     trailhead_distance_threshold: Distance = Distance(m=300)
     timeout_s: int = 10
     stop_searching_cutoff: Distance = Distance(mi=8)
+    # Above this many loops per trailhead, loop diversity is estimated from a sample of this size
+    diversity_sample_size: int = 200
 
 
 DefaultQualitySettings = QualitySettings(repeat_node_weight=1)
@@ -243,6 +521,114 @@ DefaultIngestSettings = IngestSettings(
 )
 
 
+def oriented_adjacency(graph: nx.MultiGraph) -> Dict[Node, List[Trail]]:
+    """For every node, the trails leaving it, each oriented to start at that node"""
+    adjacency: Dict[Node, List[Trail]] = defaultdict(list)
+    for start, end, trail in graph.edges.data('trail'):
+        forward = trail if trail.node(0) == start else trail.reverse()
+        adjacency[start].append(forward)
+        if start != end:
+            adjacency[end].append(forward.reverse())
+    return adjacency
+
+
+def can_still_close(path: Subpath, start: Node, ingest_settings: IngestSettings) -> bool:
+    """Admissible pruning: False only if no extension of `path` can become a loop worth keeping"""
+    max_m = ingest_settings.max_distance.m
+    # Getting home takes at least the great circle distance back to the trailhead
+    if path.length_m + path.last_node().distance(start).m > max_m:
+        return False
+    # Quality is bounded by unique / total length, which is best if the rest of the budget is all new trail.
+    # Pure out and backs are kept at a lower quality than other loops, so the bound has to admit them too.
+    repeated_m = path.length_m - path.unique_length_m
+    return (max_m - repeated_m) / max_m > min(MIN_QUALITY, OUT_AND_BACK_QUALITY - SPUR_PENALTY)
+
+
+def out_and_back(path: Subpath) -> Subpath:
+    """`path` followed by its way back to the start"""
+    loop = path
+    for segment in reversed(path.trail_segments):
+        loop = loop.add_node(segment)
+    return loop
+
+
+def loop_key(path: Subpath) -> Tuple[str, ...]:
+    ids = tuple(segment.id for segment in path.trail_segments)
+    return min(ids, ids[::-1])
+
+
+def trailhead_loops(trail_network: TrailNetwork, trailhead: Trailhead, ingest_settings: IngestSettings,
+                    adjacency: Optional[Dict[Node, List[Trail]]] = None) -> TrailheadResult:
+    """Breadth first search for loops starting and ending at `trailhead`.
+
+    Each round extends every live path by one segment, up to `max_segments` rounds. Between rounds only
+    the `max_concurrent` best paths survive, paths longer than `stop_searching_cutoff` are dropped once a
+    loop has been found, and the search gives up after `timeout_s`.
+    """
+    start_time = time.monotonic()
+    deadline = start_time + ingest_settings.timeout_s
+    if adjacency is None:
+        adjacency = oriented_adjacency(trail_network.graph)
+    start = trailhead.node
+    cutoff_m = ingest_settings.stop_searching_cutoff.m
+
+    loops: Dict[Tuple[str, ...], Subpath] = {}
+    frontier = [Subpath([segment], segment.length_m(), segment.length_m()) for segment in adjacency[start]]
+    for _ in range(ingest_settings.max_segments):
+        next_frontier = []
+        for path in frontier:
+            if path.is_complete():
+                if worth_keeping(path):
+                    loops.setdefault(loop_key(path), path)
+                continue
+            if not can_still_close(path, start, ingest_settings):
+                continue
+            if loops and path.length_m > cutoff_m:
+                continue
+            last_segment = path.last_segment()
+            onward = adjacency[path.last_node()]
+            if len(onward) == 1 and path.length_m * 2 <= ingest_settings.max_distance.m:
+                # A dead end: the only way on is straight back, which can only close as an out and back
+                loop = out_and_back(path)
+                if worth_keeping(loop):
+                    loops.setdefault(loop_key(loop), loop)
+            for segment in onward:
+                # Out and backs only turn around at dead ends; turning straight back anywhere else is a spur
+                if segment.id != last_segment.id:
+                    next_frontier.append(path.add_node(segment))
+        if not next_frontier:
+            break
+        next_frontier.sort(key=lambda p: (p.length_m - p.unique_length_m, p.length_m))
+        frontier = next_frontier[:ingest_settings.max_concurrent]
+        if time.monotonic() > deadline:
+            # Keep the loops this round closed before giving up
+            for path in frontier:
+                if path.is_complete() and worth_keeping(path):
+                    loops.setdefault(loop_key(path), path)
+            break
+
+    found = list(loops.values())
+    return TrailheadResult(
+        found, meta(trail_network, found, time.monotonic() - start_time, ingest_settings.diversity_sample_size)
+    )
+
+
+_worker_network: Optional[TrailNetwork] = None
+_worker_adjacency: Dict[Node, List[Trail]] = {}
+_worker_settings: Optional[IngestSettings] = None
+
+
+def _init_loop_worker(trail_network: TrailNetwork, ingest_settings: IngestSettings):
+    global _worker_network, _worker_adjacency, _worker_settings
+    _worker_network = trail_network
+    _worker_adjacency = oriented_adjacency(trail_network.graph)
+    _worker_settings = ingest_settings
+
+
+def _worker_trailhead_loops(trailhead: Trailhead) -> TrailheadResult:
+    return trailhead_loops(_worker_network, trailhead, _worker_settings, _worker_adjacency)
+
+
 def trail_length_km(trail):
     try:
         return trail.length_m() / 1000
@@ -251,8 +637,75 @@ def trail_length_km(trail):
         return 1
 
 
+class ParkIndex:
+    """Bounding box index over park borders.
+
+    Naming a network only needs exact GEOS work for the parks whose bounding boxes overlap it; those
+    candidates are checked with prepared geometries in their original order so ties resolve the
+    same way as a linear scan.
+    """
+
+    def __init__(self, parks: Iterable[Park]):
+        self.parks = list(parks)
+        extents = [park.border.extent if not park.border.empty else (np.nan,) * 4 for park in self.parks]
+        self.extents = np.array(extents, dtype=np.float64).reshape(-1, 4)
+        self._prepared = {}
+
+    def __len__(self):
+        return len(self.parks)
+
+    def candidates(self, border: Polygon) -> np.ndarray:
+        xmin, ymin, xmax, ymax = border.extent
+        e = self.extents
+        return np.flatnonzero((e[:, 0] <= xmax) & (e[:, 2] >= xmin) & (e[:, 1] <= ymax) & (e[:, 3] >= ymin))
+
+    def prepared(self, idx: int):
+        if idx not in self._prepared:
+            self._prepared[idx] = self.parks[idx].border.prepared
+        return self._prepared[idx]
+
+    def best_park_name(self, network_border: Polygon) -> Optional[str]:
+        """Name of the park overlapping the largest fraction of `network_border`, if any"""
+        network_area = network_border.area
+        (best_park, best_overlap) = None, 0
+        for idx in self.candidates(network_border):
+            park = self.parks[idx]
+            if not self.prepared(idx).intersects(network_border):
+                continue
+            try:
+                p_overlap = network_border.intersection(park.border).area / network_area
+                if p_overlap > best_overlap:
+                    best_park = park
+                    best_overlap = p_overlap
+            except GEOSException as err:
+                print(f'Error {err} for {park.name}')
+
+        if best_overlap > 0:
+            return best_park.name
+        return None
+
+
+_worker_park_index: Optional[ParkIndex] = None
+
+
+def _init_park_worker(parks: List[Park]):
+    # Prepared geometries can't be pickled, so each worker builds its own index
+    global _worker_park_index
+    _worker_park_index = ParkIndex(parks)
+
+
+def _worker_park_name(border: Polygon) -> Optional[str]:
+    return _worker_park_index.best_park_name(border)
+
+
 class OSMIngestor:
-    def __init__(self, ingest_settings: Optional[IngestSettings] = None, parallelism: int = 4) -> None:
+    """Builds trail networks from OSM extracts.
+
+    Parsing and segmentation are serial. `parallelism` processes are only used to name networks after parks
+    and to search loops from several trailheads at once; by default everything runs in this process.
+    """
+
+    def __init__(self, ingest_settings: Optional[IngestSettings] = None, parallelism: int = 1) -> None:
         if ingest_settings is None:
             ingest_settings = DefaultIngestSettings
         self.ingest_settings = ingest_settings
@@ -264,21 +717,28 @@ class OSMIngestor:
         self.trailnetwork_results: Dict[
             TrailNetwork, Dict[Trailhead, TrailheadResult]
         ] = {}
-        self.pool = Pool(parallelism)
+        self.parallelism = parallelism
 
-    def load_osm(self, filename: Path, extra_links: List[Tuple[int, int]] = None, no_road_crossings=True):
+    def load_osm(self, filename: Path, extra_links: List[Tuple[int, int]] = None, no_road_crossings=True,
+                 two_pass=False, cancel: Optional[threading.Event] = None):
+        """Raises ParseCancelled if `cancel` is set before the trails are in the graph"""
         if extra_links is None:
             extra_links = []
-        osm_loader = OsmiumTrailLoader(self.ingest_settings.location_filter)
+        osm_loader = OsmiumTrailLoader(self.ingest_settings.location_filter, cancel)
         print(f"Loading trails from {filename}")
-        osm_loader.apply_file(str(filename), locations=True, idx='flex_mem')
+        if two_pass:
+            osm_loader.stream_file(str(filename))
+        else:
+            osm_loader.apply_file(str(filename), locations=True, idx='flex_mem')
         print(f"Loaded from {filename}")
+        osm_loader.check_cancelled()
         trails = osm_loader.trails
         for node_ids in extra_links:
-            if not all(n in osm_loader.trail_nodes for n in node_ids):
+            nodes = [osm_loader.find_trail_node(n) for n in node_ids]
+            if not all(nodes):
                 continue
             trails[sum(node_ids)] = Trail(
-                nodes=[osm_loader.trail_nodes[n] for n in node_ids],
+                nodes=nodes,
                 way_id=f'extra-{node_ids[0]}-{node_ids[1]}',
                 name='Manually added trail',
                 manual=True
@@ -299,7 +759,7 @@ class OSMIngestor:
             )
             max_dist_km = self.ingest_settings.location_filter.radius_km
             for id, trail in trails.items():
-                trail_start = (trail.nodes[0].lat, trail.nodes[0].lon)
+                trail_start = tuple(trail.coords()[0])
                 dist_from_here = geopy.distance.great_circle(here, trail_start).km
                 if dist_from_here < max_dist_km:
                     res[id] = trail
@@ -316,76 +776,91 @@ class OSMIngestor:
         G = self.global_graph
         special = []
         for trail in segmented_trails:
-            special += [node for node in trail.nodes if 4583062189 == node.osm_id]
-            G.add_node(trail.nodes[0]),
-            G.add_node(trail.nodes[-1])
+            special += [trail.node(i) for i in np.flatnonzero(trail.node_ids == 4583062189)]
+            start, end = trail.end_points()
+            G.add_node(start),
+            G.add_node(end)
         print('\n  '.join([str(s) for s in special]))
         assert len(set(special)) == len(special)
 
         ids = set()
         for trail in segmented_trails:
             if no_road_crossings and all(
-                    node.osm_id in self.non_trail_nodes for node in (trail.nodes[0], trail.nodes[-1])):
+                    node_id in self.non_trail_nodes for node_id in (trail.node_ids[0], trail.node_ids[-1])):
                 continue
             ids.add(trail.id)
-            if trail.nodes[0] in special:
-                print(trail.nodes[0], trail.nodes[-1])
-            if trail.nodes[-1] in special:
-                print(trail.nodes[0], trail.nodes[-1])
+            start, end = trail.end_points()
+            if start in special:
+                print(start, end)
+            if end in special:
+                print(start, end)
             G.add_edge(
-                trail.nodes[0],
-                trail.nodes[-1],
+                start,
+                end,
                 weight=trail.length_m() / 1000,
                 name=trail.name,
                 trail=trail,
             )
 
     def trail_networks(self, already_processed: Set[str] = None):
+        if self.parallelism > 1:
+            # Park naming is the expensive part; it runs in workers that each hold a copy of the parks. The
+            # candidates are held until their names come back.
+            candidates = list(self.network_candidates(already_processed))
+            with Pool(self.parallelism, initializer=_init_park_worker, initargs=(list(self.parks.values()),)) as pool:
+                names = util.pmap(((border,) for _, _, border in candidates), _worker_park_name, pool,
+                                  chunksize=8, ordered=True)
+                for (digest, c, _), name in zip(candidates, names):
+                    yield self.build_network(digest, c, name)
+        else:
+            park_index = ParkIndex(self.parks.values())
+            for digest, c, border in self.network_candidates(already_processed):
+                yield self.build_network(digest, c, park_index.best_park_name(border))
+
+    def network_candidates(self, already_processed: Optional[Set[str]]) -> Iterator[Tuple[str, Set[Node], Polygon]]:
         G = self.global_graph
+        processed = ProcessedNetworks(already_processed) if already_processed is not None else None
         for c in nx.connected_components(G):
             # intersecting = [n for n in c if n.osm_id == 3268105766]
             # if intersecting:
             #    import pdb; pdb.set_trace()
             # print('intersection: ', len(intersecting), intersecting)
-            digest = hashlib.sha256(''.join(sorted(str(n) for n in c)).encode('utf-8')).hexdigest()
-            if already_processed is not None and digest in already_processed:
-                continue
             if len(c) < 3:
                 continue
+            digest = network_digest(c)
+            if processed is not None and (digest, c) in processed:
+                continue
             subgraph = G.subgraph(c)
             # ignore parks less than 1km long
             if subgraph.size(weight='weight') < 1:
                 continue
-            subgraph = subgraph.copy()
             network_border = MultiPoint([Point(x=n.lon, y=n.lat) for n in c]).convex_hull
             network_area = network_border.area
             if network_area == 0:
                 print('Warning: network with 0 area, ignoring')
                 continue
-            name = None
-            if network_border is not None:
-                (best_park, best_overlap) = None, 0
-                for park in self.parks.values():
-                    if not park.border.intersects(network_border):
-                        continue
-                    try:
-                        p_overlap = network_border.intersection(park.border).area / network_area
-                        if p_overlap > best_overlap:
-                            best_park = park
-                            best_overlap = p_overlap
-                    except GEOSException as err:
-                        print(f'Error {err} for {park.name}')
-
-                if best_overlap > 0:
-                    name = best_park.name
-            network = TrailNetwork(
-                subgraph,
-                self.non_trail_nodes,
-                self.ingest_settings.trailhead_distance_threshold,
-                digest=digest,
-                name=name
-            )
-            yield network
+            yield digest, c, network_border
+
+    def build_network(self, digest: str, component: Set[Node], name: Optional[str]) -> TrailNetwork:
+        return TrailNetwork(
+            self.global_graph.subgraph(component).copy(),
+            self.non_trail_nodes,
+            self.ingest_settings.trailhead_distance_threshold,
+            digest=digest,
+            name=name
+        )
+
+    def find_loops(self, trail_network: TrailNetwork) -> NetworkResult:
+        trailheads = trail_network.trailheads
+        if self.parallelism > 1 and len(trailheads) > 1:
+            with Pool(min(self.parallelism, len(trailheads)), initializer=_init_loop_worker,
+                      initargs=(trail_network, self.ingest_settings)) as pool:
+                results = list(util.pmap(((t,) for t in trailheads), _worker_trailhead_loops, pool, ordered=True))
+        else:
+            adjacency = oriented_adjacency(trail_network.graph)
+            results = [trailhead_loops(trail_network, t, self.ingest_settings, adjacency) for t in trailheads]
+        self.trailnetwork_results[trail_network] = dict(zip(trailheads, results))
+        return NetworkResult(trail_network, self.trailnetwork_results[trail_network])
 
     def trailheads(self) -> Iterator[Trailhead]:
         for network in self.trail_networks():
@@ -402,30 +877,41 @@ def build_derived_id(trail: Trail, node_id: int):
 def disconnect_road_crossings(trails: List[Trail], non_trail_nodes: Set[int], dont_touch: Set[int]):
     for trail in trails:
         for index in (0, -1):
-            node = trail.nodes[index]
-            if node.osm_id in dont_touch:
+            node_id = int(trail.node_ids[index])
+            if node_id in dont_touch:
                 continue
-            if node.osm_id in non_trail_nodes:
-                trail.nodes[index] = node._replace(derived_id=build_derived_id(trail, node.osm_id))
+            if node_id in non_trail_nodes:
+                trail.set_derived_id(index, build_derived_id(trail, node_id))
+
+
+def junction_nodes(trails: Iterable[Trail], non_trail_nodes: Set[int]) -> np.ndarray:
+    """Sorted node ids trails must be split at: nodes shared between (or repeated within) trails and road nodes"""
+    all_ids = [trail.node_ids for trail in trails]
+    if not all_ids:
+        return np.empty(0, dtype=np.int64)
+    node_ids, counts = np.unique(np.concatenate(all_ids), return_counts=True)
+    road = np.isin(node_ids, np.fromiter(non_trail_nodes, dtype=np.int64, count=len(non_trail_nodes)))
+    return node_ids[(counts > 1) | road]
+
+
+def split_trail(trail: Trail, junctions: np.ndarray) -> List[Trail]:
+    # `junctions` is sorted: a binary search per node rather than np.isin re-sorting all of it for every trail
+    inner = trail.node_ids[1:-1]
+    found = np.minimum(np.searchsorted(junctions, inner), max(len(junctions) - 1, 0))
+    split_idxs = (np.flatnonzero(junctions[found] == inner) + 1).tolist() if len(junctions) else []
+    if split_idxs:
+        return trail.split_at(split_idxs)
+    else:
+        return [trail]
 
 
 def segment_trails(trails: List[Trail], non_trail_nodes: Set[int]) -> List[Trail]:
     """Returns a new list of trails where all intersections are at the start or end"""
-    graph = InverseGraph()
-    for trail in trails:
-        graph.add_trail(trail)
-
+    trails = list(trails)
+    junctions = junction_nodes(trails, non_trail_nodes)
     flat_trails: List[Trail] = []
     for trail in trails:
-        split_idxs = []
-        for (i, node) in enumerate(trail.nodes[1:-1], 1):
-            if len(graph.node_trail_map[node.osm_id]) > 1 or node.osm_id in non_trail_nodes:
-                split_idxs.append(i)
-
-        if split_idxs:
-            flat_trails += trail.split_at(split_idxs)
-        else:
-            flat_trails.append(trail)
+        flat_trails += split_trail(trail, junctions)
     # verify_identical_nodes(trails, flat_trails)
     return flat_trails
 
@@ -1,208 +1,258 @@
-import copy
-import os
+import pickle
 import random
-import time
 from collections import defaultdict, Counter
+from io import BytesIO
 from typing import NamedTuple, List, Iterator, Dict, Optional, Tuple
 from typing import NewType
 
-import geopy.distance
-import gpxpy
-import gpxpy.gpx
-import srtm
 from django.contrib.gis.geos import Point
+import numpy as np
 from measurement.measures import Distance
 from networkx.classes.graphviews import SubGraph
-from srtm.main import FileHandler
 
 from osm import elevations
-from osm.util import memoize, window, verify_identical_nodes
-from trails.settings import SRTM_CACHE_DIR
+from osm.util import memoize, verify_identical_nodes, great_circle_m, greedy_cluster
 
 NodeId = NewType('NodeId', str)
 
 
-class CustomFileHandler(FileHandler):
-    def __init__(self, dir):
-        self.dir = dir
-        os.makedirs(dir, exist_ok=True)
-        super().__init__()
+class Node:
+    """An OSM node. `derived_id` differs from the osm id only for the road crossings rewritten by
+    `disconnect_road_crossings`, so it is only stored for those."""
+    __slots__ = ('osm_id', 'lat', 'lon', '_derived_id')
 
-    def get_srtm_dir(self):
-        return self.dir
+    def __init__(self, osm_id: int, lat: float, lon: float, derived_id: Optional[NodeId] = None):
+        self.osm_id = osm_id
+        self.lat = lat
+        self.lon = lon
+        if derived_id is not None and derived_id == str(osm_id):
+            derived_id = None
+        self._derived_id = derived_id
 
+    @property
+    def id(self):
+        return self.osm_id
 
-elevation = srtm.get_data(
-    file_handler=CustomFileHandler(SRTM_CACHE_DIR), batch_mode=True
-)
+    @property
+    def derived_id(self) -> NodeId:
+        return self._derived_id or NodeId(str(self.osm_id))
 
+    def __eq__(self, other):
+        return isinstance(other, Node) and self.osm_id == other.osm_id and self._derived_id == other._derived_id
 
-class Node(NamedTuple):
-    osm_id: int
-    derived_id: NodeId
-    lat: float
-    lon: float
+    def __hash__(self):
+        return hash((self.osm_id, self._derived_id))
 
-    @property
-    def id(self):
-        return self.osm_id
+    def __repr__(self):
+        # Same as the NamedTuple this class replaced: network digests are computed from it
+        return f"Node(osm_id={self.osm_id!r}, derived_id={self.derived_id!r}, lat={self.lat!r}, lon={self.lon!r})"
+
+    def __reduce__(self):
+        return _unpickle_node, (self.osm_id, self.lat, self.lon, self._derived_id)
 
     def elevation(self):
-        try:
-            return elevation.get_elevation(self.lat, self.lon)
-        except Exception as e:
-            time.sleep(1)
-            print("Failed to get elevation. Retrying in 1s", e)
-            return self.elevation()
+        return elevations.get_elevation(self.lat, self.lon)
 
     def distance(self, other: "Node") -> Distance:
-        return Distance(
-            m=geopy.distance.great_circle(
-                (self.lat, self.lon), (other.lat, other.lon)
-            ).m
-        )
+        return Distance(m=float(great_circle_m(self.lat, self.lon, other.lat, other.lon)))
 
     def to_point(self):
         return Point(x=self.lon, y=self.lat)
 
 
+def _unpickle_node(osm_id, lat, lon, derived_id):
+    return Node(osm_id, lat, lon, derived_id)
+
+
+class _LegacyNode:
+    """Graphs pickled before `Node` used __slots__ reference a NamedTuple of (osm_id, derived_id, lat, lon)"""
+
+    def __new__(cls, osm_id, derived_id, lat, lon):
+        return Node(osm_id, lat, lon, derived_id)
+
+
+class _GraphUnpickler(pickle.Unpickler):
+    def find_class(self, module, name):
+        if module == __name__ and name == 'Node':
+            return _LegacyNode
+        return super().find_class(module, name)
+
+
+def load_graph(data: bytes):
+    """Unpickles a stored trail network graph, including ones written with the old NamedTuple `Node`"""
+    return _GraphUnpickler(BytesIO(data)).load()
+
+
 class ElevationChange(NamedTuple):
     gain: float
     loss: float
+    # Fraction of the points the DEM tiles cover; the rest are interpolated
+    coverage: float = 1.
 
     @classmethod
-    def to_elevated_gps(cls, nodes: Iterator[Node], retries=5):
-        if retries == 0:
-            raise Exception("Failed to get gps for nodes")
-        gpx = gpxpy.gpx.GPX()
-
-        # Create first track in our GPX:
-        gpx_track = gpxpy.gpx.GPXTrack()
-        gpx.tracks.append(gpx_track)
-
-        # Create first segment in our GPX track:
-        gpx_segment = gpxpy.gpx.GPXTrackSegment()
-        gpx_track.segments.append(gpx_segment)
-
-        # Create points:
-        for node in nodes:
-            gpx_segment.points.append(
-                gpxpy.gpx.GPXTrackPoint(latitude=node.lat, longitude=node.lon)
-            )
-
-        try:
-            elevation.add_elevations(gpx, smooth=True)
-            missing_points = False
-            for point in gpx_segment.points:
-                if point.elevation is None:
-                    elevations.get_elevation(point.latitude, point.longitude)
-                    missing_points = True
-            if missing_points:
-                gpx.smooth(vertical=True)
-
-            return gpx_segment
-        except Exception:
-            for point in gpx_segment.points:
-                point.elevation = -1
-            return gpx_segment
+    def from_coords(cls, coords: np.ndarray) -> 'ElevationChange':
+        """From an (n, 2) array of [lat, lon]"""
+        elevated = elevations.elevate(coords[:, 0], coords[:, 1])
+        if elevated.missing_tiles:
+            print(f"No elevation data in {', '.join(elevated.missing_tiles)}")
+        gain, loss = elevations.uphill_downhill(elevated.elevations)
+        return cls(gain, loss, elevated.coverage)
 
     @classmethod
-    def elevations(cls, nodes: Iterator[Node]):
-        gpx_segment = cls.to_elevated_gps(nodes)
-        return [p.elevation for p in gpx_segment.points]
+    def from_nodes(cls, nodes: Iterator[Node]) -> 'ElevationChange':
+        return cls.from_coords(np.array([(n.lat, n.lon) for n in nodes], dtype=np.float64).reshape(-1, 2))
 
     @classmethod
-    def from_nodes(cls, nodes: Iterator[Node]):
-        gpx_segment = cls.to_elevated_gps(nodes)
-        (gain, loss) = gpx_segment.get_uphill_downhill()
-        return cls(gain, loss)
+    def elevations(cls, nodes: Iterator[Node]) -> np.ndarray:
+        coords = np.array([(n.lat, n.lon) for n in nodes], dtype=np.float64).reshape(-1, 2)
+        return elevations.elevate(coords[:, 0], coords[:, 1]).elevations
 
 
 class Trail:
-    def __init__(self, nodes: List[Node], way_id, name: Optional[str], derived_id=None, manual: bool = False):
+    """A way (or piece of one). Node ids and coordinates are kept in arrays; `Node` objects are only built on
+    access, and the derived ids of the few rewritten road crossings are kept in a sparse index -> id map."""
+    # Derived on first use and never pickled
+    _CACHED = ('_segment_lengths', '_cumulative')
+
+    def __init__(self, nodes: List[Node], way_id, name: Optional[str], derived_id=None, manual: bool = False,
+                 segment_lengths: Optional[np.ndarray] = None):
         self.nodes = nodes
         self.way_id: str = way_id
         self.id = derived_id or way_id
         self.name = name
         # Manually inserted fake segment to help with closing loops
         self.manual = manual
+        self._segment_lengths = segment_lengths
+        self._cumulative: Optional[np.ndarray] = None
+
+    @classmethod
+    def from_arrays(cls, node_ids: np.ndarray, coords: np.ndarray, way_id, name: Optional[str], derived_id=None,
+                    derived_ids: Optional[Dict[int, NodeId]] = None, segment_lengths: Optional[np.ndarray] = None):
+        trail = cls([], way_id=way_id, name=name, derived_id=derived_id, segment_lengths=segment_lengths)
+        trail.node_ids = node_ids
+        trail._coords = coords
+        trail._derived = derived_ids or {}
+        return trail
+
+    @property
+    def nodes(self) -> List[Node]:
+        derived = self._derived
+        return [
+            Node(osm_id, lat, lon, derived.get(i))
+            for i, (osm_id, (lat, lon)) in enumerate(zip(self.node_ids.tolist(), self._coords.tolist()))
+        ]
+
+    @nodes.setter
+    def nodes(self, nodes: List[Node]):
+        self.node_ids = np.array([int(n.osm_id) for n in nodes], dtype=np.int64)
+        self._coords = np.array([(float(n.lat), float(n.lon)) for n in nodes], dtype=np.float64).reshape(-1, 2)
+        self._derived = {i: n.derived_id for i, n in enumerate(nodes) if n.derived_id != str(n.osm_id)}
+        self._segment_lengths = None
+        self._cumulative = None
+
+    def node(self, index: int) -> Node:
+        index = range(len(self.node_ids))[index]
+        lat, lon = self._coords[index].tolist()
+        return Node(int(self.node_ids[index]), lat, lon, self._derived.get(index))
+
+    def set_derived_id(self, index: int, derived_id: NodeId):
+        self._derived[range(len(self.node_ids))[index]] = derived_id
+
+    def __getstate__(self):
+        return {k: v for k, v in self.__dict__.items() if k not in self._CACHED}
+
+    def __setstate__(self, state):
+        self.__dict__.update({k: None for k in self._CACHED})
+        if 'nodes' in state:
+            # Pickled before node arrays existed
+            state = dict(state)
+            self.nodes = state.pop('nodes')
+        self.__dict__.update(state)
 
     def end_points(self) -> Tuple[Node, Node]:
-        return self.nodes[0], self.nodes[-1]
+        return self.node(0), self.node(-1)
 
     def points(self):
-        return [n.to_point() for n in self.nodes]
+        return [Point(x=lon, y=lat) for lat, lon in self._coords.tolist()]
+
+    def coords(self) -> np.ndarray:
+        """(n, 2) array of the [lat, lon] of every node"""
+        return self._coords
+
+    def segment_lengths_m(self) -> np.ndarray:
+        """Great circle length of each node to node step, computed once per trail"""
+        if self._segment_lengths is None:
+            coords = self.coords()
+            self._segment_lengths = great_circle_m(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+        return self._segment_lengths
+
+    def cumulative_m(self) -> np.ndarray:
+        """Distance from the first node to every node along the trail"""
+        if self._cumulative is None:
+            self._cumulative = np.concatenate(([0.], np.cumsum(self.segment_lengths_m())))
+        return self._cumulative
 
     def length(self):
-        dists = [
-            geopy.distance.great_circle((a.lat, a.lon), (b.lat, b.lon)).m
-            for (a, b) in window(self.nodes)
-        ]
-        return Distance(m=sum(dists))
+        return Distance(m=self.length_m())
 
     def length_m(self):
-        dists = [
-            geopy.distance.great_circle((a.lat, a.lon), (b.lat, b.lon)).m
-            for (a, b) in window(self.nodes)
-        ]
-        return sum(dists)
+        return float(self.cumulative_m()[-1])
 
     @classmethod
     def from_way(cls, way):
-        nodes = [Node(osm_id=node.ref, derived_id=NodeId(str(node.ref)), lat=node.lat, lon=node.lon) for node in
-                 way.nodes]
+        node_ids = np.array([node.ref for node in way.nodes], dtype=np.int64)
+        coords = np.array([(node.lat, node.lon) for node in way.nodes], dtype=np.float64).reshape(-1, 2)
         id = str(way.id)
 
         if way.tags.get("name"):
             name = way.tags["name"]
         else:
             name = None
-        return cls(nodes=nodes, way_id=id, name=name)
+        return cls.from_arrays(node_ids, coords, way_id=id, name=name)
+
+    def _slice(self, start: int, end: int, derived_id: str) -> "Trail":
+        lengths = self._segment_lengths
+        return Trail.from_arrays(
+            self.node_ids[start:end],
+            self._coords[start:end],
+            way_id=self.way_id,
+            derived_id=derived_id,
+            name=self.name,
+            derived_ids={i - start: d for i, d in self._derived.items() if start <= i < end},
+            segment_lengths=None if lengths is None else lengths[start:end - 1],
+        )
 
     def split_at(self, idxs):
         start_idx = 0
         result = []
         for seg_num, idx in enumerate(idxs):
-            new_nodes = self.nodes[start_idx: idx + 1]
-            new_id = f"{self.way_id}-{seg_num}/{len(idxs)}"
-            result.append(
-                Trail(
-                    nodes=new_nodes,
-                    way_id=self.way_id,
-                    derived_id=new_id,
-                    name=self.name,
-                )
-            )
+            result.append(self._slice(start_idx, idx + 1, f"{self.way_id}-{seg_num}/{len(idxs)}"))
             start_idx = idx
 
-        final_nodes = self.nodes[start_idx:]
-        if not final_nodes:
+        if start_idx >= len(self.node_ids):
             assert "Unexpected empty final nodes"
-        result.append(
-            Trail(
-                nodes=final_nodes,
-                way_id=self.way_id,
-                derived_id=f"{self.way_id}-{len(idxs)}/{len(idxs)}",
-                name=self.name,
-            )
-        )
+        result.append(self._slice(start_idx, len(self.node_ids), f"{self.way_id}-{len(idxs)}/{len(idxs)}"))
         verify_identical_nodes([self], result)
         return result
 
     def elevation(self):
-        return ElevationChange.from_nodes(self.nodes)
+        return ElevationChange.from_coords(self.coords())
 
     def reverse(self):
-        return Trail(
-            nodes=list(reversed(self.nodes)),
+        last = len(self.node_ids) - 1
+        return Trail.from_arrays(
+            self.node_ids[::-1],
+            self._coords[::-1],
             way_id=self.way_id,
             derived_id=self.id,
             name=self.name,
+            derived_ids={last - i: d for i, d in self._derived.items()},
+            segment_lengths=self.segment_lengths_m()[::-1],
         )
 
     def draw(self, gmap, color=None):
-        lats = [n.lat for n in self.nodes]
-        lons = [n.lon for n in self.nodes]
+        lats = self._coords[:, 0].tolist()
+        lons = self._coords[:, 1].tolist()
         color = color or random.choice(list(gmap.html_color_codes.keys()))
         gmap.plot(lats, lons, color, edge_width=2)
 
@@ -236,20 +286,14 @@ class TrailNetwork:
         self.trailheads: List[Trailhead] = raw_trailheads[:max_trailheads]
 
     def cluster_trailheads(self, trailheads, distance_threshold: Distance):
-        if not trailheads:
-            return []
-        trailheads_to_keep = [trailheads[0]]
-        for trailhead in trailheads[1:]:
-            closest = min(
-                [
-                    trailhead.node.distance(existing.node)
-                    for existing in trailheads_to_keep
-                ]
-            )
-            if closest > distance_threshold:
-                trailheads_to_keep.append(trailhead)
-        return trailheads_to_keep
+        keep = greedy_cluster(
+            [trailhead.node.lat for trailhead in trailheads],
+            [trailhead.node.lon for trailhead in trailheads],
+            distance_threshold.m
+        )
+        return [trailheads[i] for i in keep]
 
+    @memoize
     def total_length_km(self):
         total_length = 0
         for edge in self.graph.edges:
@@ -294,7 +338,23 @@ def filt_neg(d):
     return {k: v for k, v in d.items() if v > 0}
 
 
+def _unpickle_subpath(segments, length_m, unique_length_m):
+    return Subpath(segments, length_m, unique_length_m)
+
+
+SPUR_PENALTY = 0.1
+OUT_AND_BACK_QUALITY = 0.49
+
+
 class Subpath:
+    """A path through a trail network, stored as its last segment plus a pointer to the path before it.
+
+    Paths are immutable, so every extension of a path shares it instead of copying it. Lengths, the spur
+    count and a bitmask of the segments used are carried forward so that `add_node` is O(1); the full
+    segment list and per-segment distances are only built when asked for. Segment ids are interned into
+    bit positions by a table shared by every path grown from the same root.
+    """
+
     def __init__(
             self,
             segments: List[Trail],
@@ -302,24 +362,81 @@ class Subpath:
             unique_length_m: int,
             segment_dist: Optional[Counter] = None,
     ) -> None:
-        self.start_node = segments[0].nodes[0]
-        self.trail_segments = segments
-        self.segment_dist = segment_dist or Counter()
-        if segment_dist is None:
-            for s in self.trail_segments:
-                self.segment_dist.update({s.id: s.length_m()})
-
+        parent = None
+        for segment in segments[:-1]:
+            parent = Subpath._extend(parent, segment)
+        self._link(parent, segments[-1], {} if parent is None else parent._bits)
         self.length_m = length_m
         self.unique_length_m = unique_length_m
+        if segment_dist is not None:
+            self._segment_dist = segment_dist
 
-        assert self.segment_dist.keys() == set([s.id for s in self.trail_segments])
+    @classmethod
+    def _extend(cls, parent: Optional["Subpath"], segment: Trail) -> "Subpath":
+        path = cls.__new__(cls)
+        path._link(parent, segment, {} if parent is None else parent._bits)
+        return path
+
+    def _link(self, parent: Optional["Subpath"], segment: Trail, bits: Dict[str, int]):
+        bit = 1 << bits.setdefault(segment.id, len(bits))
+        segment_length = segment.length_m()
+        self._parent = parent
+        self._segment = segment
+        self._bits = bits
+        self._segments: Optional[List[Trail]] = None
+        self._segment_dist: Optional[Counter] = None
+        if parent is None:
+            self.start_node = segment.node(0)
+            self._mask = bit
+            self._num_segments = 1
+            self._num_spurs = 0
+            self.length_m = segment_length
+            self.unique_length_m = segment_length
+        else:
+            self.start_node = parent.start_node
+            self._mask = parent._mask | bit
+            self._num_segments = parent._num_segments + 1
+            self._num_spurs = parent._num_spurs + (parent._segment.id == segment.id)
+            self.length_m = parent.length_m + segment_length
+            self.unique_length_m = parent.unique_length_m + (0 if parent._mask & bit else segment_length)
+
+    def __reduce__(self):
+        # Bit positions are only meaningful to paths grown from the same root; rebuild them on load
+        return _unpickle_subpath, (self.trail_segments, self.length_m, self.unique_length_m)
+
+    @property
+    def trail_segments(self) -> List[Trail]:
+        if self._segments is None:
+            segments = []
+            path = self
+            while path is not None:
+                segments.append(path._segment)
+                path = path._parent
+            self._segments = segments[::-1]
+        return self._segments
+
+    @property
+    def segment_dist(self) -> Counter:
+        """Total distance travelled on each segment of the path, by segment id"""
+        if self._segment_dist is None:
+            self._segment_dist = Counter()
+            for s in self.trail_segments:
+                self._segment_dist.update({s.id: s.length_m()})
+        return self._segment_dist
+
+    def __len__(self):
+        return self._num_segments
+
+    def contains_segment(self, segment_id: str) -> bool:
+        bit = self._bits.get(segment_id)
+        return bit is not None and bool(self._mask >> bit & 1)
 
     def compute_intersections(self):
         res = defaultdict(set)
         for segment in self.trail_segments:
-            res[segment.nodes[0].id].add(segment.id)
-            res[segment.nodes[-1].id].add(segment.id)
-        del res[self.trail_segments[0].nodes[0].id]
+            res[segment.node(0).id].add(segment.id)
+            res[segment.node(-1).id].add(segment.id)
+        del res[self.start_node.id]
         return res
 
     def name(self):
@@ -342,19 +459,18 @@ class Subpath:
         return Subpath(segments, length, length)
 
     def similarity(self, other: "Subpath"):
-        assert self.segment_dist.keys() == set([s.id for s in self.trail_segments])
-        unique_paths = copy.deepcopy(self.segment_dist)  # Counter()
-        # unique_paths += self.segment_dist
-        unique_paths.subtract(other.segment_dist)
-
-        unique_distance = sum([abs(v) for v in unique_paths.values()])
+        ours, theirs = self.segment_dist, other.segment_dist
+        unique_distance = sum(abs(v - theirs.get(k, 0)) for k, v in ours.items())
+        unique_distance += sum(abs(v) for k, v in theirs.items() if k not in ours)
 
         total_distance = self.length_m + other.length_m
         return 1 - unique_distance / total_distance
 
     def is_pure_out_and_back(self):
         ts_ids = [ts.id for ts in self.trail_segments]
-        return ts_ids == ts_ids[::-1] and self.quality() > 0.49
+        # Turning around at the far end is a spur every even out and back has, so it isn't held against it
+        turnaround = SPUR_PENALTY if len(ts_ids) % 2 == 0 else 0
+        return ts_ids == ts_ids[::-1] and self.quality() + turnaround > OUT_AND_BACK_QUALITY
 
     @memoize
     def quality(self, repeat_weight=1):
@@ -365,7 +481,7 @@ class Subpath:
         repeat_quality = self.unique_length_m / self.length_m
         assert repeat_weight <= 1
 
-        spur_quality = self.num_spurs() * -0.1
+        spur_quality = self.num_spurs() * -SPUR_PENALTY
 
         graph_complexity = sum(
             [
@@ -391,42 +507,23 @@ class Subpath:
         ]
         return cls(trail_segments, 0, 0)
 
-    @memoize
     def num_spurs(self):
-        n = 0
-        for (t1, t2) in window(self.trail_segments):
-            if t1.id == t2.id:
-                n += 1
-        return n
+        return self._num_spurs
 
     def add_node(self, trail_segment: Trail, mutate=False) -> "Subpath":
-        current_final = self.last_node()
-        if trail_segment.nodes[0] == current_final:
+        if trail_segment.node(0) == self.last_node():
             new_segment = trail_segment
         else:
             new_segment = trail_segment.reverse()
 
-        if new_segment.id not in self.segment_dist:
-            unique_length = new_segment.length_m()
-        else:
-            unique_length = 0
-
         if mutate:
-            self.trail_segments.append(new_segment)
-            self.segment_dist.update({trail_segment.id: trail_segment.length_m()})
-            self.unique_length_m += unique_length
-            self.length_m += new_segment.length_m()
+            # Keep the current state reachable as the parent before this object becomes the extension
+            parent = Subpath.__new__(Subpath)
+            parent.__dict__.update(self.__dict__)
+            self.__dict__.clear()
+            self._link(parent, new_segment, parent._bits)
             return self
-        else:
-            new_segment_dist = copy.deepcopy(self.segment_dist)
-            new_segment_dist.update({trail_segment.id: trail_segment.length_m()})
-
-            return Subpath(
-                list(self.trail_segments) + [new_segment],
-                length_m=self.length_m + new_segment.length_m(),
-                unique_length_m=self.unique_length_m + unique_length,
-                segment_dist=new_segment_dist,
-            )
+        return Subpath._extend(self, new_segment)
 
     def nodes(self) -> Iterator[Node]:
         for seg in self.trail_segments:
@@ -434,17 +531,20 @@ class Subpath:
                 yield node
 
     def is_complete(self):
-        return self.trail_segments[0].nodes[0] == self.last_node()
+        return self.start_node == self.last_node()
 
     @memoize
     def elevation_change(self) -> ElevationChange:
         return ElevationChange.from_nodes(self.nodes())
 
     def first_node(self):
-        return self.trail_segments[0].nodes[0]
+        return self.start_node
+
+    def last_segment(self) -> Trail:
+        return self._segment
 
     def last_node(self):
-        return self.trail_segments[-1].nodes[-1]
+        return self._segment.node(-1)
 
     def __repr__(self):
         names = [seg.name or "noname" for seg in self.trail_segments]
@@ -464,5 +564,5 @@ class InverseGraph:
 
     def add_trail(self, trail: Trail):
         self.trails[trail.id] = trail
-        for node in trail.nodes:
-            self.node_trail_map[node.id].append(trail.id)
+        for node_id in trail.node_ids.tolist():
+            self.node_trail_map[node_id].append(trail.id)
@@ -0,0 +1,194 @@
+"""Columnar binary encoding of a trail network graph.
+
+Layout: a fixed header (magic, version, flags, metadata length), a JSON metadata block holding the string
+dictionary and the column table, then the column body. Every column is an aligned, fixed-width array so it
+loads as a NumPy view of the stored buffer; with FLAG_ZLIB the body is compressed and is inflated once on
+read. Rows written before this format existed hold a pickled networkx graph and are still readable.
+"""
+import json
+import struct
+import zlib
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+import networkx as nx
+import numpy as np
+
+from osm.model import Node, Trail, load_graph
+from osm.util import great_circle_m
+
+MAGIC = b'TRLG'
+VERSION = 1
+FLAG_ZLIB = 1
+HEADER = struct.Struct('<4sBBxxI')
+ALIGNMENT = 8
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+
+def is_compact(data: Buffer) -> bool:
+    return bytes(data[:len(MAGIC)]) == MAGIC
+
+
+class _StringTable:
+    def __init__(self):
+        self.strings: List = []
+        self.index: Dict = {}
+
+    def add(self, s) -> int:
+        if s is None:
+            return -1
+        if s not in self.index:
+            self.index[s] = len(self.strings)
+            self.strings.append(s)
+        return self.index[s]
+
+
+def dump_graph(graph: nx.MultiGraph, compress: bool = False) -> bytes:
+    """Encode a trail network graph whose edges carry a `trail`"""
+    strings = _StringTable()
+    node_index = {node: i for i, node in enumerate(graph.nodes)}
+    nodes = list(node_index)
+    edges = list(graph.edges.data('trail'))
+    trails = [trail for _, _, trail in edges]
+    offsets = np.zeros(len(trails) + 1, dtype=np.int64)
+    np.cumsum([len(trail.node_ids) for trail in trails], out=offsets[1:])
+    derived = [
+        (offset + i, strings.add(derived_id))
+        for offset, trail in zip(offsets.tolist(), trails)
+        for i, derived_id in sorted(trail._derived.items())
+    ]
+
+    columns = dict(
+        node_osm_ids=np.array([node.osm_id for node in nodes], dtype=np.int64),
+        node_coords=np.array([(node.lat, node.lon) for node in nodes], dtype=np.float64).reshape(-1, 2),
+        node_derived_ids=np.array([strings.add(node._derived_id) for node in nodes], dtype=np.int32),
+        edge_starts=np.array([node_index[start] for start, _, _ in edges], dtype=np.int32),
+        edge_ends=np.array([node_index[end] for _, end, _ in edges], dtype=np.int32),
+        edge_lengths_m=np.array([trail.length_m() for trail in trails], dtype=np.float64),
+        edge_ids=np.array([strings.add(trail.id) for trail in trails], dtype=np.int32),
+        edge_way_ids=np.array([strings.add(trail.way_id) for trail in trails], dtype=np.int32),
+        edge_names=np.array([strings.add(trail.name) for trail in trails], dtype=np.int32),
+        edge_manual=np.array([trail.manual for trail in trails], dtype=np.uint8),
+        point_offsets=offsets,
+        point_node_ids=np.concatenate([trail.node_ids for trail in trails] or [np.zeros(0)]).astype(np.int64),
+        point_coords=np.concatenate([trail.coords() for trail in trails] or [np.zeros((0, 2))]).astype(np.float64),
+        derived_points=np.array([p for p, _ in derived], dtype=np.int64),
+        derived_ids=np.array([s for _, s in derived], dtype=np.int32),
+    )
+
+    body = bytearray()
+    layout = {}
+    for name, column in columns.items():
+        body += bytes(-len(body) % ALIGNMENT)
+        layout[name] = [column.dtype.str, list(column.shape), len(body)]
+        body += np.ascontiguousarray(column).tobytes()
+    meta = json.dumps(dict(strings=strings.strings, columns=layout)).encode('utf-8')
+    meta += b' ' * (-(HEADER.size + len(meta)) % ALIGNMENT)
+
+    flags = 0
+    if compress:
+        body = zlib.compress(bytes(body))
+        flags |= FLAG_ZLIB
+    return HEADER.pack(MAGIC, VERSION, flags, len(meta)) + meta + bytes(body)
+
+
+class CompactGraph:
+    """Read side of the columnar format.
+
+    Columns are NumPy views of the stored buffer. Lengths, endpoints and coordinates can be read without
+    building anything; `Trail` objects and the networkx graph are only built on request.
+    """
+
+    def __init__(self, data: Buffer):
+        magic, version, flags, meta_len = HEADER.unpack_from(data)
+        if magic != MAGIC:
+            raise ValueError('Not a compact trail graph')
+        if version > VERSION:
+            raise ValueError(f'Unsupported trail graph version {version}')
+        meta = json.loads(bytes(data[HEADER.size:HEADER.size + meta_len]).decode('utf-8'))
+        body = memoryview(data)[HEADER.size + meta_len:]
+        if flags & FLAG_ZLIB:
+            body = zlib.decompress(body)
+        self.strings: List = meta['strings']
+        for name, (dtype, shape, offset) in meta['columns'].items():
+            dtype = np.dtype(dtype)
+            count = int(np.prod(shape))
+            setattr(self, name, np.frombuffer(body, dtype=dtype, count=count, offset=offset).reshape(shape))
+        self._graph: Optional[nx.MultiGraph] = None
+
+    def __len__(self):
+        return len(self.edge_starts)
+
+    def string(self, idx: int):
+        return None if idx < 0 else self.strings[idx]
+
+    def total_length_m(self) -> float:
+        return float(self.edge_lengths_m.sum())
+
+    def measure_lengths_m(self) -> np.ndarray:
+        """Great circle length of every edge recomputed from its coordinates, ignoring the stored lengths"""
+        coords = self.point_coords
+        if len(coords) < 2:
+            return np.zeros(len(self))
+        steps = great_circle_m(coords[:-1, 0], coords[:-1, 1], coords[1:, 0], coords[1:, 1])
+        # Steps from the last point of one edge to the first point of the next aren't part of either
+        steps[self.point_offsets[1:-1] - 1] = 0
+        cumulative = np.concatenate(([0.], np.cumsum(steps)))
+        starts, ends = self.point_offsets[:-1], self.point_offsets[1:] - 1
+        return cumulative[ends] - cumulative[starts]
+
+    def node(self, idx: int) -> Node:
+        lat, lon = self.node_coords[idx].tolist()
+        return Node(int(self.node_osm_ids[idx]), lat, lon, self.string(int(self.node_derived_ids[idx])))
+
+    def end_points(self, edge: int) -> Tuple[Node, Node]:
+        return self.node(int(self.edge_starts[edge])), self.node(int(self.edge_ends[edge]))
+
+    def trail(self, edge: int) -> Trail:
+        start, end = self.point_offsets[edge:edge + 2].tolist()
+        lo, hi = np.searchsorted(self.derived_points, [start, end])
+        trail = Trail.from_arrays(
+            self.point_node_ids[start:end],
+            self.point_coords[start:end],
+            way_id=self.string(int(self.edge_way_ids[edge])),
+            name=self.string(int(self.edge_names[edge])),
+            derived_id=self.string(int(self.edge_ids[edge])),
+            derived_ids={
+                int(p) - start: self.strings[s]
+                for p, s in zip(self.derived_points[lo:hi].tolist(), self.derived_ids[lo:hi].tolist())
+            },
+        )
+        trail.manual = bool(self.edge_manual[edge])
+        return trail
+
+    def segments(self) -> Iterator[Trail]:
+        """Every distinct trail in the network, like `osm.model.segments_for_graph`"""
+        seen = set()
+        for edge, trail_id in enumerate(self.edge_ids.tolist()):
+            if trail_id not in seen:
+                seen.add(trail_id)
+                yield self.trail(edge)
+
+    @property
+    def graph(self) -> nx.MultiGraph:
+        """The networkx graph, built on first use"""
+        if self._graph is None:
+            graph = nx.MultiGraph()
+            nodes = [self.node(i) for i in range(len(self.node_osm_ids))]
+            graph.add_nodes_from(nodes)
+            for edge, (start, end) in enumerate(zip(self.edge_starts.tolist(), self.edge_ends.tolist())):
+                trail = self.trail(edge)
+                graph.add_edge(nodes[start], nodes[end], weight=float(self.edge_lengths_m[edge]) / 1000,
+                               name=trail.name, trail=trail)
+            self._graph = graph
+        return self._graph
+
+
+def read_graph(data: Buffer) -> CompactGraph:
+    """Read a stored network graph in either the columnar format or the legacy pickle"""
+    if is_compact(data):
+        return CompactGraph(data)
+    graph = load_graph(bytes(data))
+    compact = CompactGraph(dump_graph(graph))
+    compact._graph = graph
+    return compact
@@ -0,0 +1,76 @@
+import collections
+import csv
+import random
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+
+import pytest
+from postman_problems import solver
+from postman_problems.stats import calculate_postman_solution_stats
+
+from osm import cpp
+from osm.loader import OSMIngestor
+from osm.tests.test_loader import TestSettings
+
+
+def network_edges(network):
+    edges = []
+    for segment in network.trail_segments():
+        start, end = segment.end_points()
+        edges.append((start.derived_id, end.derived_id, segment.id, segment.length_m()))
+    return edges
+
+
+def postman_problems_distance(edges):
+    with NamedTemporaryFile(suffix='.csv', mode='w') as f:
+        writer = csv.DictWriter(f, fieldnames=['start', 'end', 'id', 'distance'])
+        writer.writeheader()
+        for start, end, edge_id, distance in edges:
+            writer.writerow(dict(start=start, end=end, id=edge_id, distance=distance))
+        f.flush()
+        circuit, _ = solver.cpp(f.name)
+    return calculate_postman_solution_stats(circuit)['distance_walked']
+
+
+def test_cpp_matches_postman_problems():
+    ingestor = OSMIngestor(TestSettings)
+    ingestor.load_osm(Path(__file__).parent / "data" / "huddart.osm")
+    for network in ingestor.trail_networks():
+        edges = network_edges(network)
+        circuit = cpp.cpp(edges)
+
+        assert circuit[0][0] == circuit[-1][1]
+        for (_, end, _, _), (start, _, _, _) in zip(circuit, circuit[1:]):
+            assert end == start
+        walked_once = collections.Counter(e[3]['id'] for e in circuit if not e[3].get('augmented'))
+        assert walked_once == collections.Counter(edge_id for _, _, edge_id, _ in edges)
+
+        distance = calculate_postman_solution_stats(circuit)['distance_walked']
+        assert distance == pytest.approx(postman_problems_distance(edges))
+
+
+def test_cpp_self_loops_and_parallel_edges():
+    edges = [('a', 'a', 'loop', 2.), ('a', 'b', 'ab1', 1.), ('a', 'b', 'ab2', 3.), ('b', 'c', 'bc', 1.)]
+    circuit = cpp.cpp(edges)
+    assert calculate_postman_solution_stats(circuit)['distance_walked'] == 2. + 1. + 3. + 1. + 1.
+    assert [e[3]['id'] for e in circuit if e[3].get('augmented')] == ['bc']
+
+
+def random_edges(rng: random.Random, num_nodes: int):
+    # A random spanning tree keeps the graph connected
+    edges = [(str(rng.randrange(n)), str(n), f'tree{n}', rng.uniform(1, 100)) for n in range(1, num_nodes)]
+    for i in range(num_nodes // 2):
+        edges.append((str(rng.randrange(num_nodes)), str(rng.randrange(num_nodes)), f'extra{i}', rng.uniform(1, 100)))
+    return edges
+
+
+def test_cpp_random_graphs():
+    rng = random.Random(4)
+    for _ in range(15):
+        edges = random_edges(rng, rng.randrange(20, 60))
+        exact = calculate_postman_solution_stats(cpp.cpp(edges))['distance_walked']
+        assert exact == pytest.approx(postman_problems_distance(edges))
+        # The sparse candidate graph is a heuristic: never shorter than the exact matching
+        for k in (1, 3, 12):
+            sparse = calculate_postman_solution_stats(cpp.cpp(edges, k_nearest=k))['distance_walked']
+            assert sparse >= exact - 1e-6
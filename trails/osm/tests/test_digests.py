@@ -0,0 +1,41 @@
+import hashlib
+from pathlib import Path
+
+from osm.digests import FileDigest, is_legacy, legacy_network_digest, network_digest, stored_file_digests
+from osm.loader import OSMIngestor
+from osm.model import Node
+from osm.tests.test_loader import TestSettings
+
+HUDDART = Path(__file__).parent / "data" / "huddart.osm"
+
+
+def test_file_digest():
+    expected = hashlib.sha256(HUDDART.read_bytes()).hexdigest()
+    assert FileDigest(str(HUDDART)).hexdigest() == expected
+    # `sha256sum` output used to be stored as the str of its bytes
+    assert stored_file_digests(expected) == [expected, f"b'{expected}'"]
+
+
+def test_network_digest():
+    nodes = [Node(3, 37.1, -122.1), Node(1, 37.2, -122.2), Node(2, 37.3, -122.3)]
+    digest = network_digest(nodes)
+    assert network_digest(list(reversed(nodes))) == digest
+    assert network_digest(nodes[:2]) != digest
+    assert network_digest(nodes[:2] + [Node(2, 37.3, -122.3, derived_id='2-1')]) != digest
+    assert not is_legacy(digest)
+    assert is_legacy(legacy_network_digest(nodes))
+
+
+def test_resume_with_legacy_digests():
+    ingestor = OSMIngestor(TestSettings)
+    ingestor.load_osm(str(HUDDART))
+    candidates = list(ingestor.network_candidates(None))
+    assert candidates
+    components = {digest: c for digest, c, _ in candidates}
+    legacy = {legacy_network_digest(c) for c in components.values()}
+    assert list(ingestor.network_candidates(legacy)) == []
+    assert list(ingestor.network_candidates(set(components))) == []
+    # Imports resumed across the change hold digests in both formats
+    first, *rest = components
+    mixed = {first} | {legacy_network_digest(components[digest]) for digest in rest[1:]}
+    assert [digest for digest, _, _ in ingestor.network_candidates(mixed)] == rest[:1]
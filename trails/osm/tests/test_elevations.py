@@ -0,0 +1,88 @@
+import numpy as np
+import pytest
+import rasterio
+from gpxpy.geo import calculate_uphill_downhill
+from rasterio.transform import from_origin
+
+from osm import elevations
+from osm.elevations import TileCache, srtm3_tile_ilonlat, tile_name, uphill_downhill, fill_gaps
+from osm.model import ElevationChange
+
+
+def write_tile(directory, data, compress=None):
+    # srtm_12_05 covers lon -125..-120, lat 35..40
+    profile = dict(driver='GTiff', width=data.shape[1], height=data.shape[0], count=1, dtype='int16',
+                   nodata=-32768, transform=from_origin(-125, 40, 5 / data.shape[1], 5 / data.shape[0]))
+    if compress:
+        profile['compress'] = compress
+    with rasterio.open(str(directory / 'srtm_12_05.tif'), 'w', **profile) as ds:
+        ds.write(data, 1)
+
+
+@pytest.mark.parametrize('compress', [None, 'deflate'])
+def test_tile_cache_bilinear(tmp_path, compress):
+    data = np.arange(50 * 50, dtype=np.int16).reshape(50, 50)
+    data[10, 10] = -32768
+    write_tile(tmp_path, data, compress)
+    assert tile_name(*srtm3_tile_ilonlat(-122.3, 37.4)) == 'srtm_12_05.tif'
+
+    cache = TileCache(str(tmp_path), max_bytes=1 << 20)
+    # Pixel centers sample exactly
+    rows, cols = np.array([0, 3, 49, 20]), np.array([0, 7, 49, 30])
+    lats, lons = 40 - (rows + 0.5) * 0.1, -125 + (cols + 0.5) * 0.1
+    assert np.allclose(cache.elevations(lats, lons), data[rows, cols])
+    # Halfway between four centers is their mean
+    assert cache.elevations([40 - 0.1 * 21], [-125 + 0.1 * 31])[0] == pytest.approx(data[20:22, 30:32].mean())
+    # Nodata and points without a tile are NaN
+    elevations = cache.elevations([40 - 0.1 * 10.5, 10.0], [-125 + 0.1 * 10.5, 10.0])
+    assert np.isnan(elevations).all()
+    assert isinstance(cache.get('srtm_12_05.tif').data, np.memmap) == (compress is None)
+
+
+def test_tile_cache_evicts(tmp_path):
+    write_tile(tmp_path, np.ones((50, 50), dtype=np.int16))
+    (tmp_path / 'srtm_12_04.tif').write_bytes((tmp_path / 'srtm_12_05.tif').read_bytes())
+    cache = TileCache(str(tmp_path), max_bytes=50 * 50 * 2)
+    first = cache.get('srtm_12_05.tif')
+    cache.get('srtm_12_04.tif')
+    assert list(cache._tiles) == ['srtm_12_04.tif']
+    assert cache.get('srtm_12_05.tif') is not first
+
+
+def test_tile_cache_retries_missing(tmp_path, monkeypatch):
+    cache = TileCache(str(tmp_path), max_bytes=1 << 20, missing_ttl_s=60)
+    now = [1000.]
+    monkeypatch.setattr(elevations.time, 'monotonic', lambda: now[0])
+    assert cache.get('srtm_12_05.tif') is None
+    write_tile(tmp_path, np.ones((50, 50), dtype=np.int16))
+    assert cache.get('srtm_12_05.tif') is None
+    now[0] += 61
+    assert cache.get('srtm_12_05.tif') is not None
+
+
+def test_uphill_downhill_matches_gpxpy():
+    rng = np.random.RandomState(0)
+    elevations = np.cumsum(rng.normal(size=500)) * 10
+    expected = calculate_uphill_downhill(list(elevations))
+    assert uphill_downhill(elevations) == pytest.approx(expected)
+    assert uphill_downhill([12.]) == (0., 0.)
+
+
+def test_fill_gaps():
+    assert list(fill_gaps([np.nan, 1., np.nan, 3., np.nan])) == [1., 1., 2., 3., 3.]
+    assert list(fill_gaps([np.nan, np.nan])) == [0., 0.]
+
+
+def test_elevation_change_reports_gaps(tmp_path, monkeypatch):
+    data = np.zeros((50, 50), dtype=np.int16)
+    data[:, 25:] = 100
+    write_tile(tmp_path, data)
+    monkeypatch.setattr(elevations, '_tiles', TileCache(str(tmp_path), max_bytes=1 << 20))
+
+    # West to east across the step, then into srtm_13_05 which has no file
+    coords = np.array([(37.5, lon) for lon in (-124, -123, -122, -121, -119, -118)])
+    change = ElevationChange.from_coords(coords)
+    assert change.gain == pytest.approx(100)
+    assert change.loss == 0
+    assert change.coverage == pytest.approx(4 / 6)
+    assert elevations.elevate(coords[:, 0], coords[:, 1]).missing_tiles == ['srtm_13_05.tif']
@@ -0,0 +1,82 @@
+import re
+from pathlib import Path
+
+from pytest import fixture
+
+from osm import incremental
+from osm.incremental import IngestState, NetworkFingerprint, ParkFingerprint
+from osm.loader import OSMIngestor
+from osm.tests.test_loader import TestSettings
+
+HUDDART = Path(__file__).parent / "data" / "huddart.osm"
+
+
+def ingest(path) -> IngestState:
+    loader = OSMIngestor(TestSettings)
+    loader.load_osm(str(path))
+    return incremental.ingest_state(loader)
+
+
+def write_changes(path, action: str, objects: str):
+    path.write_text(
+        f'<?xml version="1.0" encoding="UTF-8"?>\n<osmChange version="0.6">\n <{action}>\n{objects} </{action}>\n'
+        f'</osmChange>\n'
+    )
+
+
+def way_xml(way_id: int) -> str:
+    return re.search(rf' <way id="{way_id}".*?</way>\n', HUDDART.read_text(), re.S).group(0)
+
+
+@fixture(scope='module')
+def full_state():
+    yield ingest(HUDDART)
+
+
+@fixture
+def extract(tmp_path):
+    path = tmp_path / 'huddart.osm.pbf'
+    incremental.write_ingest_extract(str(HUDDART), str(path))
+    yield path
+
+
+def test_extract_builds_the_same_networks(extract, full_state):
+    assert extract.stat().st_size < HUDDART.stat().st_size / 10
+    assert ingest(extract) == full_state
+
+
+def test_deleted_trail(tmp_path, extract, full_state):
+    changes = tmp_path / 'delete.osc'
+    write_changes(changes, 'delete', '  <way id="173524715" version="2" timestamp="2020-01-01T00:00:00Z"/>\n')
+    incremental.apply_changes(str(extract), str(changes), str(tmp_path / 'next.osm.pbf'))
+    state = ingest(tmp_path / 'next.osm.pbf')
+    # The trail was a network of its own
+    assert len(state.networks) == len(full_state.networks) - 1
+    assert incremental.unchanged_networks(full_state, state) == set(state.networks)
+
+
+def test_renamed_trail(tmp_path, extract, full_state):
+    way = way_xml(113507121).replace('version="1"', 'version="2"').replace(
+        '  <tag k="highway" v="path"/>\n', '  <tag k="highway" v="path"/>\n  <tag k="name" v="Renamed Trail"/>\n'
+    )
+    changes = tmp_path / 'rename.osc'
+    write_changes(changes, 'modify', way)
+    incremental.apply_changes(str(extract), str(changes), str(tmp_path / 'next.osm.pbf'))
+    state = ingest(tmp_path / 'next.osm.pbf')
+    # Same nodes, so the same digests, but the network holding the trail has to be rebuilt
+    assert set(state.networks) == set(full_state.networks)
+    assert len(set(state.networks) - incremental.unchanged_networks(full_state, state)) == 1
+
+
+def test_changed_parks(tmp_path):
+    previous = IngestState(
+        parks={'1': ParkFingerprint('a', (0, 0, 1, 1)), '2': ParkFingerprint('b', (5, 5, 6, 6))},
+        networks={'n1': NetworkFingerprint('x', (0.5, 0.5, 0.6, 0.6)), 'n2': NetworkFingerprint('y', (8, 8, 9, 9))},
+    )
+    current = previous._replace(parks={'1': ParkFingerprint('changed', (0, 0, 1, 1)), '2': previous.parks['2']})
+    assert incremental.changed_park_extents(previous.parks, current.parks) == [(0, 0, 1, 1), (0, 0, 1, 1)]
+    assert incremental.unchanged_networks(previous, current) == {'n2'}
+
+    path = tmp_path / 'state.json'
+    current.save(str(path))
+    assert IngestState.load(str(path)) == current
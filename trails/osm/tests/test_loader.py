@@ -1,5 +1,10 @@
+import itertools
+import random
+import threading
 from pathlib import Path
 
+import geopy.distance
+import networkx as nx
 import pytest
 # from gmplot import gmplot
 from measurement.measures import Distance
@@ -9,8 +14,13 @@ from osm.loader import (
     OsmiumTrailLoader,
     OSMIngestor,
     IngestSettings,
+    ParseCancelled,
+    ParkIndex,
+    worth_keeping,
+    diversity,
+    trailhead_loops,
     DefaultQualitySettings)
-from osm.model import Node, ElevationChange
+from osm.model import Node, ElevationChange, Subpath, Trail, TrailNetwork, Trailhead
 
 
 @fixture
@@ -65,6 +75,19 @@ def test_loader(huddart_trails):
     assert trail_names == expected
 
 
+def test_trail_length_matches_geopy(huddart_trails):
+    for trail in huddart_trails.trails.values():
+        expected = sum(
+            geopy.distance.great_circle((a.lat, a.lon), (b.lat, b.lon)).m
+            for a, b in zip(trail.nodes, trail.nodes[1:])
+        )
+        assert trail.length_m() == pytest.approx(expected, abs=1e-6)
+        assert trail.reverse().length_m() == pytest.approx(expected, abs=1e-6)
+        if len(trail.nodes) > 2:
+            halves = trail.split_at([len(trail.nodes) // 2])
+            assert sum(half.length_m() for half in halves) == pytest.approx(expected, abs=1e-6)
+
+
 TestSettings = IngestSettings(
     max_segments=20,
     max_distance=Distance(km=20),
@@ -103,6 +126,120 @@ def test_trail_network(test_data, huddart_trails):
     assert 462124623 not in trailhead_ids
 
 
+def test_two_pass_matches_single_pass(test_data):
+    def summary(two_pass):
+        ingestor = OSMIngestor(TestSettings)
+        ingestor.load_osm(test_data / "walden-pond.osm", two_pass=two_pass)
+        return [(n.digest, n.name, sorted(t.node.id for t in n.trailheads)) for n in ingestor.trail_networks()]
+
+    assert summary(two_pass=True) == summary(two_pass=False)
+
+
+@pytest.mark.parametrize('two_pass', [False, True])
+def test_cancelled_load(test_data, two_pass):
+    cancel = threading.Event()
+    cancel.set()
+    ingestor = OSMIngestor(TestSettings)
+    with pytest.raises(ParseCancelled):
+        ingestor.load_osm(test_data / "walden-pond.osm", two_pass=two_pass, cancel=cancel)
+    assert not ingestor.trails
+
+
+def test_parallel_ingest_matches_serial(test_data):
+    def summary(parallelism):
+        ingestor = OSMIngestor(TestSettings, parallelism=parallelism)
+        ingestor.load_osm(test_data / "walden-pond.osm")
+        return [
+            (n.digest, n.name, sorted(t.id for t in n.trail_segments()))
+            for n in ingestor.trail_networks()
+        ]
+
+    assert summary(parallelism=2) == summary(parallelism=1)
+
+
+def test_park_index_matches_linear_scan(test_data):
+    def linear_scan(parks, border):
+        overlaps = [(border.intersection(p.border).area, p.name) for p in parks if p.border.intersects(border)]
+        best = max(overlaps, key=lambda o: o[0], default=(0, None))
+        return best[1] if best[0] > 0 else None
+
+    ingestor = OSMIngestor(TestSettings)
+    ingestor.load_osm(test_data / "walden-pond.osm")
+    index = ParkIndex(ingestor.parks.values())
+    borders = [border for _, _, border in ingestor.network_candidates(None)]
+    assert borders and len(index) > 0
+    for border in borders:
+        assert index.best_park_name(border) == linear_scan(ingestor.parks.values(), border)
+
+
+def test_find_loops(test_data):
+    # Serial and parallel runs only agree if the deadline never cuts a search short
+    settings = TestSettings._replace(timeout_s=3600)
+
+    def loops(parallelism):
+        ingestor = OSMIngestor(settings, parallelism=parallelism)
+        ingestor.load_osm(test_data / "huddart.osm")
+        return {
+            (network.digest, trailhead.node): result
+            for network in ingestor.trail_networks()
+            for trailhead, result in ingestor.find_loops(network).loops.items()
+        }
+
+    serial = loops(parallelism=1)
+    assert sum(result.meta.num_loops for result in serial.values()) > 0
+    for (_, start), result in serial.items():
+        assert result.meta.num_loops == len(result.loops)
+        for loop in result.loops:
+            assert loop.first_node() == start and loop.is_complete()
+            assert worth_keeping(loop)
+            assert loop.length_m <= TestSettings.max_distance.m
+
+    def names(results):
+        return {key: [loop.name() for loop in result.loops] for key, result in results.items()}
+
+    assert names(loops(parallelism=2)) == names(serial)
+
+
+def test_out_and_back_on_spurs():
+    # A trailhead on a trail that forks into two dead ends
+    start, fork = Node(1, 37.0, -122.0), Node(2, 37.015, -122.0)
+    ends = [Node(3, 37.025, -122.0), Node(4, 37.015, -121.99)]
+    graph = nx.MultiGraph()
+    for way_id, (a, b) in enumerate([(start, fork), (fork, ends[0]), (fork, ends[1])]):
+        trail = Trail([a, b], way_id=way_id, name=f'Trail {way_id}')
+        graph.add_edge(a, b, weight=trail.length_m() / 1000, trail=trail)
+    network = TrailNetwork(graph, {start.id: 'Road'}, Distance(m=300), 'spurs')
+
+    result = trailhead_loops(network, Trailhead(start, 'Road'), TestSettings)
+    assert sorted(tuple(s.id for s in loop.trail_segments) for loop in result.loops) == [(0, 1, 1, 0), (0, 2, 2, 0)]
+    for loop in result.loops:
+        assert loop.is_complete() and loop.is_pure_out_and_back() and worth_keeping(loop)
+
+
+def test_find_loops_deadline(test_data):
+    settings = TestSettings._replace(timeout_s=0)
+    ingestor = OSMIngestor(settings)
+    ingestor.load_osm(test_data / "huddart.osm")
+    for network in ingestor.trail_networks():
+        for trailhead, result in ingestor.find_loops(network).loops.items():
+            # Gives up after the first round, keeping whatever closed in it
+            assert result.meta.ingest_time < 1
+            for loop in result.loops:
+                assert loop.first_node() == trailhead.node and loop.is_complete()
+                assert worth_keeping(loop)
+
+
+def test_diversity_matches_pairwise_similarity(huddart_trails):
+    rng = random.Random(7)
+    trails = list(huddart_trails.trails.values())
+    loops = [Subpath.from_segments(rng.choices(trails, k=rng.randint(1, 6))) for _ in range(30)]
+    pairs = list(itertools.combinations(loops, 2))
+    expected = sum(1 - a.similarity(b) for a, b in pairs) / len(pairs)
+    assert diversity(loops) == pytest.approx(expected)
+    assert diversity(loops[:1]) == 1
+    assert 0 <= diversity(loops, sample_size=10) <= 1
+
+
 def test_road_splitting(test_data):
     ingestor = OSMIngestor(TestSettings)
     ingestor.load_osm(test_data / "walden-pond.osm")
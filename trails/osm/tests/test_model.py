@@ -0,0 +1,50 @@
+import pickle
+from typing import NamedTuple
+
+import networkx as nx
+
+from osm import model
+from osm.model import Node, Trail, load_graph
+
+
+class LegacyNode(NamedTuple):
+    osm_id: int
+    derived_id: str
+    lat: float
+    lon: float
+
+
+LegacyNode.__module__ = model.__name__
+LegacyNode.__name__ = LegacyNode.__qualname__ = 'Node'
+
+
+def test_trail_round_trips_through_pickle():
+    trail = Trail([Node(1, 1.0, 2.0), Node(2, 1.1, 2.1), Node(3, 1.2, 2.2)], way_id='10', name='A')
+    trail.set_derived_id(-1, '3-10-road-extra')
+    graph = nx.MultiGraph()
+    graph.add_edge(trail.node(0), trail.node(-1), trail=trail)
+
+    loaded = load_graph(pickle.dumps(graph))
+    (start, end, loaded_trail), = loaded.edges.data('trail')
+    assert {start, end} == {Node(1, 1.0, 2.0), Node(3, 1.2, 2.2, '3-10-road-extra')}
+    assert loaded_trail.nodes == trail.nodes
+    assert loaded_trail.length_m() == trail.length_m()
+
+
+def test_load_graph_reads_legacy_namedtuple_nodes(monkeypatch):
+    legacy_nodes = [LegacyNode(1, '1', 1.0, 2.0), LegacyNode(2, '2-10-road-extra', 1.1, 2.1)]
+    trail = Trail([Node(1, 1.0, 2.0), Node(2, 1.1, 2.1)], way_id='10', name='A')
+    monkeypatch.setattr(model, 'Node', LegacyNode)
+    monkeypatch.setattr(Trail, '__getstate__', lambda self: dict(
+        nodes=legacy_nodes, way_id='10', id='10', name='A', manual=False
+    ))
+    graph = nx.MultiGraph()
+    graph.add_edge(legacy_nodes[0], legacy_nodes[1], trail=trail)
+    data = pickle.dumps(graph)
+    monkeypatch.undo()
+
+    loaded = load_graph(data)
+    (start, end, loaded_trail), = loaded.edges.data('trail')
+    assert {start, end} == {Node(1, 1.0, 2.0), Node(2, 1.1, 2.1, '2-10-road-extra')}
+    assert loaded_trail.node(-1).derived_id == '2-10-road-extra'
+    assert repr(loaded_trail.node(0)) == repr(legacy_nodes[0])
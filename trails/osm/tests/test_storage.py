@@ -0,0 +1,49 @@
+import pickle
+from pathlib import Path
+
+import pytest
+
+from osm.loader import OSMIngestor
+from osm.storage import dump_graph, read_graph, is_compact
+from osm.tests.test_loader import TestSettings
+
+
+@pytest.fixture(scope='module')
+def networks():
+    ingestor = OSMIngestor(TestSettings)
+    ingestor.load_osm(Path(__file__).parent / "data" / "walden-pond.osm")
+    return list(ingestor.trail_networks())
+
+
+def total_length_m(graph):
+    return sum(trail.length_m() for _, _, trail in graph.edges.data('trail'))
+
+
+def edge_summary(graph):
+    return sorted(
+        (repr(start), repr(end), trail.id, trail.way_id, trail.name, weight, repr(trail.nodes))
+        for start, end, weight, trail in (
+            (u, v, d['weight'], d['trail']) for u, v, d in graph.edges(data=True)
+        )
+    )
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_compact_graph_round_trip(networks, compress):
+    for network in networks:
+        data = dump_graph(network.graph, compress=compress)
+        assert is_compact(data)
+        compact = read_graph(memoryview(data))
+        assert len(compact) == network.graph.number_of_edges()
+        assert compact.total_length_m() == pytest.approx(total_length_m(network.graph))
+        assert compact.measure_lengths_m() == pytest.approx(compact.edge_lengths_m)
+        assert list(compact.graph.nodes) == list(network.graph.nodes)
+        assert edge_summary(compact.graph) == edge_summary(network.graph)
+        assert {t.id for t in compact.segments()} == {t.id for t in network.trail_segments()}
+
+
+def test_read_graph_accepts_pickles(networks):
+    network = networks[0]
+    compact = read_graph(pickle.dumps(network.graph))
+    assert edge_summary(compact.graph) == edge_summary(network.graph)
+    assert compact.total_length_m() == pytest.approx(total_length_m(network.graph))
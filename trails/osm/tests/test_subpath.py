@@ -5,7 +5,7 @@ from geopy.distance import Distance
 from osm.model import Trail, Subpath, Node
 
 
-def mock_trail(id, length, start_node_id=None, end_node_id=None):
+def mock_trail(id, length, start_node_id=0, end_node_id=0):
     trail = Trail([MagicMock()], id, f"trail{id}")
     trail.length = MagicMock(return_value=Distance(meters=length))
     trail.length_m = MagicMock(return_value=length)
@@ -75,3 +75,18 @@ def test_subpath_intersections():
     for segment in segments:
         s = s.add_node(segment)
     assert s.compute_intersections() == {2: {0, 1, 3}, 3: {1, 2}, 4: {2, 3}}
+
+
+def test_subpath_extensions_share_parent():
+    trail_1 = mock_trail(1, 5)
+    trail_2 = mock_trail(2, 6)
+
+    base = Subpath.from_segments([trail_1])
+    spur = base.add_node(trail_1)
+    onward = base.add_node(trail_2)
+    assert [t.id for t in base.trail_segments] == [1]
+    assert [t.id for t in spur.trail_segments] == [1, 1]
+    assert [t.id for t in onward.trail_segments] == [1, 2]
+    assert spur.num_spurs() == 1 and onward.num_spurs() == 0
+    assert spur.segment_dist == {1: 10} and onward.segment_dist == {1: 5, 2: 6}
+    assert onward.contains_segment(2) and not spur.contains_segment(2)
@@ -0,0 +1,27 @@
+import random
+
+from osm.util import greedy_cluster, great_circle_m
+
+
+def brute_force_cluster(points, threshold_m):
+    keep = []
+    for i, (lat, lon) in enumerate(points):
+        if all(great_circle_m(lat, lon, points[j][0], points[j][1]) > threshold_m for j in keep):
+            keep.append(i)
+    return keep
+
+
+def test_greedy_cluster_matches_brute_force():
+    rng = random.Random(4)
+    for center_lat, center_lon, spread in [(37.4, -122.3, 0.05), (78.2, 15.6, 0.2), (-16.5, 179.99, 0.02)]:
+        points = [
+            (center_lat + rng.uniform(-spread, spread), (center_lon + rng.uniform(-spread, spread) + 180) % 360 - 180)
+            for _ in range(200)
+        ]
+        for threshold_m in (50, 300, 2000):
+            expected = brute_force_cluster(points, threshold_m)
+            assert greedy_cluster([p[0] for p in points], [p[1] for p in points], threshold_m) == expected
+
+
+def test_greedy_cluster_empty():
+    assert greedy_cluster([], [], 300) == []
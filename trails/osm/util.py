@@ -1,20 +1,71 @@
 import functools
+import math
+from collections import defaultdict
 from functools import partial
 from multiprocessing.pool import Pool
+from typing import Dict, List, Tuple
 
+import geopy.distance
+import numpy as np
 
-def verify_identical_nodes(trails_in, trails_out):
-    nodes_in = set()
-    for trail in trails_in:
-        for node in trail.nodes:
-            nodes_in.add(node)
+EARTH_RADIUS_M = geopy.distance.EARTH_RADIUS * 1000
 
-    nodes_out = set()
-    for trail in trails_out:
-        for node in trail.nodes:
-            nodes_out.add(node)
 
-    assert nodes_out == nodes_in
+def verify_identical_nodes(trails_in, trails_out):
+    nodes_in = np.unique(np.concatenate([trail.node_ids for trail in trails_in]))
+    nodes_out = np.unique(np.concatenate([trail.node_ids for trail in trails_out]))
+    assert np.array_equal(nodes_out, nodes_in)
+
+
+def great_circle_m(lat1, lon1, lat2, lon2):
+    """Vectorized `geopy.distance.great_circle` in meters; accepts scalars or arrays of degrees"""
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    sin_lat1, cos_lat1 = np.sin(lat1), np.cos(lat1)
+    sin_lat2, cos_lat2 = np.sin(lat2), np.cos(lat2)
+    delta_lon = lon2 - lon1
+    cos_delta_lon, sin_delta_lon = np.cos(delta_lon), np.sin(delta_lon)
+    d = np.arctan2(
+        np.sqrt((cos_lat2 * sin_delta_lon) ** 2 + (cos_lat1 * sin_lat2 - sin_lat1 * cos_lat2 * cos_delta_lon) ** 2),
+        sin_lat1 * sin_lat2 + cos_lat1 * cos_lat2 * cos_delta_lon
+    )
+    return EARTH_RADIUS_M * d
+
+
+def greedy_cluster(lats, lons, threshold_m: float) -> List[int]:
+    """Indices of the points kept by a greedy scan that drops any point within `threshold_m` of one already kept
+
+    Kept points are hashed into a grid whose cells are at least `threshold_m` across at the most poleward
+    latitude in the input, so each point only needs to be compared against the 3x3 block of cells around it.
+    """
+    lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+    if len(lats) == 0:
+        return []
+    angle = threshold_m / EARTH_RADIUS_M
+    lat_cell = np.degrees(angle) * (1 + 1e-9)
+    # Two points within `angle` of each other differ in longitude by at most 2 * asin(sin(angle / 2) / cos(lat))
+    max_cos = np.cos(np.radians(min(np.abs(lats).max() + lat_cell, 90.0)))
+    spread = math.sin(angle / 2) / max_cos if max_cos > 0 else math.inf
+    lon_cell = np.degrees(2 * math.asin(spread)) * (1 + 1e-9) if spread < 1 else 360.0
+    # Uniform columns so neighbours wrap cleanly across the antimeridian
+    num_cols = max(int(360.0 // lon_cell), 1)
+    rows = np.floor(lats / lat_cell).astype(np.int64)
+    cols = np.floor((lons + 180.0) / (360.0 / num_cols)).astype(np.int64) % num_cols
+
+    grid: Dict[Tuple[int, int], List[int]] = defaultdict(list)
+    keep = []
+    for i in range(len(lats)):
+        row, col = rows[i], cols[i]
+        neighbours = [
+            j
+            for r in (row - 1, row, row + 1)
+            for c in {(col - 1) % num_cols, col, (col + 1) % num_cols}
+            for j in grid.get((r, c), ())
+        ]
+        if neighbours and great_circle_m(lats[i], lons[i], lats[neighbours], lons[neighbours]).min() <= threshold_m:
+            continue
+        keep.append(i)
+        grid[(row, col)].append(i)
+    return keep
 
 
 def window(iterable, size=2):
@@ -32,10 +83,12 @@ def splat(tup, f):
     return f(*tup)
 
 
-def pmap(iter, func, pool: Pool, chunksize=1):
+def pmap(iter, func, pool: Pool, chunksize=1, ordered=False):
     func = functools.partial(splat, f=func)
     if pool._processes == 1:  # type: ignore
         return list(map(func, iter))
+    elif ordered:
+        return pool.imap(func, iter, chunksize=chunksize)
     else:
         return pool.imap_unordered(func, iter, chunksize=chunksize)
 
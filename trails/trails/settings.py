@@ -60,8 +60,9 @@ if IS_PROD:
         'default': dj_database_url.config(conn_max_age=600, ssl_require=True,
                                           engine="django.contrib.gis.db.backends.postgis")
     }
-    SRTM_CACHE_DIR = "/osm/srtm"
     SRTMV4_BASE_DIR = "/osm/srtmv4"
+    TILE_CACHE_DIR = "/osm/tiles"
+    INGEST_STATE_DIR = "/osm/state"
     sentry_sdk.init(
         dsn="https://df55f3928ccf4b39bbb6942d2a4b99d2@o416116.ingest.sentry.io/5309799",
         integrations=[DjangoIntegration()],
@@ -81,8 +82,16 @@ else:
             "POST": "5432",
         }
     }
-    SRTM_CACHE_DIR = os.path.expanduser("~/.cache/srtm")
     SRTMV4_BASE_DIR = "/trail-data/srtm/"
+    TILE_CACHE_DIR = os.path.expanduser("~/.cache/trail-tiles")
+    INGEST_STATE_DIR = os.path.expanduser("~/.cache/trail-ingest-state")
+
+# Memory budget of the SRTMv4 tiles kept open by osm.elevations (each is ~70MB)
+SRTM_TILE_CACHE_MB = int(os.environ.get("SRTM_TILE_CACHE_MB", 512))
+
+# Shared secret other instances send in X-Import-Token to push networks here, see export_networks. Imports
+# are refused without it unless the request comes from a staff login.
+IMPORT_TOKEN = os.environ.get("IMPORT_TOKEN", "")
 
 REST_FRAMEWORK = {
     # Use Django's standard `django.contrib.auth` permissions,
@@ -181,6 +190,32 @@ STATIC_URL = "/static/"
 # Celery settings
 CELERY_BROKER_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379')
 
+# The network detail payloads are shared between processes through Redis when it's available
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "networks": {
+        "BACKEND": "est.cache.RedisCache" if os.environ.get('REDIS_URL') else
+        "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": os.environ.get('REDIS_URL', 'networks'),
+        "KEY_PREFIX": "est",
+        # Bounds how stale the relative "since" time of a cached circuit can get
+        "TIMEOUT": 15 * 60,
+        "OPTIONS": {"MAX_ENTRIES": 5000},
+    },
+    # Rendered vector tiles; keys include the active import set so they never need invalidating. Without Redis
+    # they go to disk, where every set lists the whole directory to cull it, so only a few are kept.
+    "tiles": {
+        "BACKEND": "est.cache.RedisCache" if os.environ.get('REDIS_URL') else
+        "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ.get('REDIS_URL', TILE_CACHE_DIR),
+        "KEY_PREFIX": "tiles",
+        "TIMEOUT": 7 * 24 * 60 * 60,
+        "OPTIONS": {"MAX_ENTRIES": 2000},
+    },
+}
+
 import structlog
 
 LOGGING = {
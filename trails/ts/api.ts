@@ -10,11 +10,18 @@ interface CompleteCircuit extends CircuitBase {
   status: "complete";
   total_length: string;
   download_url: string;
+  elevation_gain?: string;
+  elevation_loss?: string;
+  // Percent of the route with elevation data, when some of it is missing
+  elevation_coverage?: number;
+  profile_url?: string;
 }
 
 interface InProgressCircuit extends CircuitBase {
   status: "in_progress";
   since: string;
+  phase: "queued" | "loading_graph" | "solving" | "building_route";
+  eta: string | null;
 }
 
 interface ErrorCircuit extends CircuitBase {
@@ -23,6 +23,7 @@ const loadVisibleParks = async (map: mapboxgl.Map) => {
   const bounds = map.getBounds();
   const visibleAreas = await api("/api/areas", "POST", {
     sw: bounds.getSouthWest(),
+    zoom: map.getZoom(),
     ne: bounds.getNorthEast(),
   }, controller.signal);
   const { data } = await visibleAreas.json();
@@ -35,6 +35,13 @@ const circuitInfo = (
     return (
       <div className="info-row">
         <span>Full tour: {circuit.total_length} miles</span>
+        {circuit.elevation_gain != null && (
+          <span>
+            +{circuit.elevation_gain} / -{circuit.elevation_loss} ft
+            {circuit.elevation_coverage != null &&
+              ` (elevation data for ${circuit.elevation_coverage}% of the route)`}
+          </span>
+        )}
         <a href={circuit.download_url}>Download GPX</a>
         <button
           type="button"
@@ -46,7 +53,14 @@ const circuitInfo = (
       </div>
     );
   } else if (circuit.status == "in_progress") {
-    return <div>Calcuating tour...({circuit.since})</div>;
+    const phase = circuit.phase.replace("_", " ");
+    const eta = circuit.eta ? `, done ${circuit.eta}` : "";
+    return (
+      <div>
+        Calcuating tour...({circuit.since}: {phase}
+        {eta})
+      </div>
+    );
   } else {
     return (
       <div>